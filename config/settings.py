@@ -45,8 +45,10 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'django_filters',
     'django_daraja',
+    'django_celery_beat',
     'rest_framework',
     'drf_spectacular',
 
@@ -100,6 +102,16 @@ MPESA_CONSUMER_SECRET = os.getenv('MPESA_CONSUMER_SECRET')
 MPESA_PASSKEY = os.getenv('MPESA_PASSKEY')
 MPESA_INITIATOR_SECURITY_CREDENTIAL = os.getenv('MPESA_INITIATOR_SECURITY_CREDENTIAL')
 MPESA_SHORTCODE_TYPE = os.getenv('MPESA_SHORTCODE_TYPE')
+MPESA_CALLBACK_URL = os.getenv(
+    'MPESA_CALLBACK_URL',
+    'https://nexus-qura.onrender.com/api/payments/mpesa/callback/',
+)
+# Overrides the sandbox/production base URL, e.g. for a local simulator
+MPESA_API_BASE_URL = os.getenv('MPESA_API_BASE_URL')
+# Daraja calls share a keep-alive pool; the token is refreshed this many
+# seconds before it expires
+MPESA_HTTP_POOL_SIZE = 10
+MPESA_TOKEN_REFRESH_MARGIN = 300
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -174,10 +186,30 @@ AUTHENTICATION_BACKENDS = [
     "core.auth_backends.PhoneOrIDBackend",
 ]
 
+# Login lookups, see core/auth_backends.py. Identifiers matching no user are
+# cached for AUTH_UNKNOWN_LOGIN_TIMEOUT seconds; an identifier with
+# AUTH_LOGIN_MAX_FAILURES failed logins is locked out for the rest of the
+# AUTH_LOGIN_FAILURE_WINDOW that began with its first failure.
+AUTH_LOGIN_CACHE_ALIAS = "default"
+AUTH_UNKNOWN_LOGIN_TIMEOUT = 60
+AUTH_LOGIN_MAX_FAILURES = 5
+AUTH_LOGIN_FAILURE_WINDOW = 60 * 15
+
+# PBKDF2 cost of new password hashes, Django's default when unset. Stored
+# hashes with another count are rehashed when their user next logs in.
+PASSWORD_HASHERS = [
+    "core.hashers.PBKDF2PasswordHasher",
+    "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
+    "django.contrib.auth.hashers.Argon2PasswordHasher",
+    "django.contrib.auth.hashers.BCryptSHA256PasswordHasher",
+    "django.contrib.auth.hashers.ScryptPasswordHasher",
+]
+PASSWORD_PBKDF2_ITERATIONS = int(os.getenv("PASSWORD_PBKDF2_ITERATIONS", "0")) or None
+
 REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': "drf_spectacular.openapi.AutoSchema",
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'core.authentication.ClaimsJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -198,8 +230,17 @@ SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=15),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
     'AUTH_HEADER_TYPES': ('Bearer',),
+    # Access tokens carry the role and active flag, see core/authentication.py
+    'TOKEN_OBTAIN_SERIALIZER': 'core.authentication.ClaimsTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'core.authentication.ClaimsTokenRefreshSerializer',
 }
 
+# How long the current token version of a user is cached; role changes,
+# deactivation and password changes made with save() apply right away,
+# other writes to those fields within this many seconds
+AUTH_TOKEN_CACHE_ALIAS = "default"
+AUTH_TOKEN_VERSION_TIMEOUT = 60 * 5
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -219,6 +260,61 @@ CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_BACKEND = "django-db"
 
+# Mpesa callbacks are stored in an inbox and applied by a drain task.
+# Callbacks arriving within the delay (seconds) share one drain. One that
+# matches no payment yet is kept pending for the timeout (seconds).
+MPESA_CALLBACK_DRAIN_DELAY = 1
+MPESA_CALLBACK_BATCH_SIZE = 500
+MPESA_CALLBACK_UNMATCHED_TIMEOUT = 60 * 10
+
+# Emails are sent from the EmailNotification outbox by a task on its own
+# queue, so a slow SMTP server never holds up payment processing. Run a
+# worker for it with: celery -A config worker -Q notifications
+# Image processing is CPU bound and gets the media queue for the same reason.
+CELERY_TASK_ROUTES = {
+    "core.tasks.send_email_notifications": {"queue": "notifications"},
+    "core.tasks.process_id_photo": {"queue": "media"},
+}
+EMAIL_NOTIFICATION_DELAY = 2
+EMAIL_NOTIFICATION_BATCH_SIZE = 100
+EMAIL_NOTIFICATION_MAX_ATTEMPTS = 5
+# Seconds a run owns the emails it is sending, and before the first retry
+# of a failed one (doubled for each further attempt)
+EMAIL_NOTIFICATION_CLAIM_TIMEOUT = 60 * 5
+EMAIL_NOTIFICATION_RETRY_DELAY = 30
+
+# STK pushes are sent by a worker from the StkPushRequest outbox
+STK_PUSH_CLAIM_TIMEOUT = 60
+STK_PUSH_MAX_ATTEMPTS = 3
+
+# Payments still processing this many seconds after the push are queried
+# from Daraja by reconcile_payments, with at most MPESA_RECONCILE_CONCURRENCY
+# queries in flight (keep it within MPESA_HTTP_POOL_SIZE)
+MPESA_RECONCILE_AFTER = 120
+MPESA_RECONCILE_CONCURRENCY = MPESA_HTTP_POOL_SIZE
+MPESA_RECONCILE_BATCH_SIZE = 200
+MPESA_RECONCILE_LIMIT = 5000
+
+# Payment status events reach SSE clients through Redis pub/sub when
+# EVENTS_REDIS_URL is set (e.g. redis://127.0.0.1:6379/0), which is needed
+# once Celery workers publish them; otherwise they are delivered within the
+# process only, for development and tests
+EVENTS_REDIS_URL = os.getenv('EVENTS_REDIS_URL')
+PAYMENT_EVENTS_TIMEOUT = 120
+PAYMENT_EVENTS_KEEPALIVE = 15
+
+CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
+CELERY_BEAT_SCHEDULE = {
+    "reconcile-payments": {
+        "task": "core.tasks.reconcile_payments",
+        "schedule": 60.0,
+    },
+    "dispatch-pending-stk-pushes": {
+        "task": "core.tasks.dispatch_pending_stk_pushes",
+        "schedule": 60.0,
+    },
+}
+
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 EMAIL_HOST = "smtp.gmail.com"
 EMAIL_PORT = 587
@@ -251,3 +347,60 @@ SPECTACULAR_SETTINGS = {
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
 
+# Media is served by ProtectedMediaView, see core/media.py. Behind nginx set
+# MEDIA_ACCEL_REDIRECT=/protected-media/ to hand the transfer to its
+# internal location; unset, files are sent by Django.
+MEDIA_ACCEL_REDIRECT = os.getenv("MEDIA_ACCEL_REDIRECT")
+MEDIA_CACHE_MAX_AGE = 60 * 60
+
+# Uploads always go to a temporary file in chunks, never into memory, so a
+# large ID photo costs the same memory as a small one
+FILE_UPLOAD_HANDLERS = [
+    "django.core.files.uploadhandler.TemporaryFileUploadHandler",
+]
+
+# ID photos are stored as uploaded and processed by the process_id_photo
+# task on the media queue, see core/photos.py
+ID_PHOTO_MAX_UPLOAD_SIZE = 15 * 1024 * 1024
+ID_PHOTO_MAX_SIZE = 1600
+ID_PHOTO_THUMBNAIL_SIZE = 256
+ID_PHOTO_JPEG_QUALITY = 85
+
+
+# Caches: Redis when CACHE_URL is set (e.g. redis://127.0.0.1:6379/1),
+# otherwise per-process local memory for development and tests
+CACHE_URL = os.getenv("CACHE_URL")
+
+if CACHE_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# Cached PropertyViewSet list/retrieve responses, see core/caching.py
+RESPONSE_CACHE_ALIAS = "default"
+RESPONSE_CACHE_TIMEOUT = 60 * 5
+RESPONSE_CACHE_STALE_TIMEOUT = 60
+
+# Rate rules and stay discounts of a property, cached for quotes, and the
+# limits of one batch quote request, see core/pricing.py
+PRICING_CACHE_ALIAS = "default"
+PRICING_CACHE_TIMEOUT = 60 * 60
+PRICING_MAX_QUOTES = 200
+PRICING_MAX_NIGHTS = 365
+
+# Per-property index of booked nights, see core/availability.py
+AVAILABILITY_CACHE_ALIAS = "default"
+AVAILABILITY_INDEX_TIMEOUT = 60 * 60 * 24
+
+# Python-side double-booking checks before a booking is saved. Defaults to
+# off on PostgreSQL, where the booking_no_overlap constraint enforces it.
+# BOOKING_OVERLAP_PRECHECK = True
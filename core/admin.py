@@ -1,7 +1,7 @@
 from django.contrib import admin
 
 from django.contrib.auth.admin import UserAdmin
-from .models import CustomUser
+from .models import CustomUser, LengthOfStayDiscount, RateRule
 
 
 @admin.register(CustomUser)
@@ -26,3 +26,16 @@ class CustomUserAdmin(UserAdmin):
     )
 
     search_fields = ("phone_number",)
+
+
+@admin.register(RateRule)
+class RateRuleAdmin(admin.ModelAdmin):
+    list_display = ("property", "name", "start_date", "end_date", "weekdays", "price_per_night", "priority")
+    list_filter = ("weekdays",)
+    raw_id_fields = ("property",)
+
+
+@admin.register(LengthOfStayDiscount)
+class LengthOfStayDiscountAdmin(admin.ModelAdmin):
+    list_display = ("property", "min_nights", "percent")
+    raw_id_fields = ("property",)
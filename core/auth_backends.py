@@ -1,26 +1,110 @@
-from django.contrib.auth.backends import BaseBackend
+"""
+Login by user id or phone number.
+
+The user is found with one query on either column. Identifiers that
+match nobody are remembered in the cache for AUTH_UNKNOWN_LOGIN_TIMEOUT
+seconds, so repeated attempts with them don't reach the database; the
+signal handler in core/signals.py forgets them once a user takes one.
+
+Failed attempts are counted per identifier. After AUTH_LOGIN_MAX_FAILURES
+within AUTH_LOGIN_FAILURE_WINDOW seconds, further attempts fail without
+a lookup or password check until the window runs out, and
+LoginIdentifierThrottle answers them on the API with 429.
+"""
+
+import hashlib
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import BaseBackend
+from django.core.cache import caches
+from django.db.models import Q
+from rest_framework.throttling import BaseThrottle
 
 User = get_user_model()
 
+UNKNOWN_PREFIX = "login:unknown"
+FAILURES_PREFIX = "login:failures"
+
+
+def _cache():
+    return caches[getattr(settings, "AUTH_LOGIN_CACHE_ALIAS", "default")]
+
+
+def unknown_timeout():
+    return getattr(settings, "AUTH_UNKNOWN_LOGIN_TIMEOUT", 60)
+
+
+def max_failures():
+    return getattr(settings, "AUTH_LOGIN_MAX_FAILURES", 5)
+
+
+def failure_window():
+    return getattr(settings, "AUTH_LOGIN_FAILURE_WINDOW", 60 * 15)
+
+
+def _key(prefix, identifier):
+    # Phone numbers stay out of cache keys
+    digest = hashlib.sha256(str(identifier).encode()).hexdigest()
+    return f"{prefix}:{digest}"
+
+
+def forget_unknown(*identifiers):
+    _cache().delete_many([_key(UNKNOWN_PREFIX, identifier) for identifier in identifiers if identifier])
+
+
+def failed_attempts(identifier):
+    return _cache().get(_key(FAILURES_PREFIX, identifier), 0)
+
+
+def is_locked_out(identifier):
+    return failed_attempts(identifier) >= max_failures()
+
+
+def record_failure(identifier):
+    key = _key(FAILURES_PREFIX, identifier)
+    # The window starts at the first failure and isn't extended by later ones
+    if not _cache().add(key, 1, failure_window()):
+        try:
+            _cache().incr(key)
+        except ValueError:
+            # Expired between add() and incr()
+            _cache().add(key, 1, failure_window())
+
+
+def clear_failures(identifier):
+    _cache().delete(_key(FAILURES_PREFIX, identifier))
+
+
+def find_user(identifier):
+    """The user whose id, or else phone number, is ``identifier``"""
+    cache = _cache()
+    unknown_key = _key(UNKNOWN_PREFIX, identifier)
+    if cache.get(unknown_key):
+        return None
+    users = list(User.objects.filter(Q(id=identifier) | Q(phone_number=identifier))[:2])
+    if not users:
+        cache.set(unknown_key, True, unknown_timeout())
+        return None
+    # One user's id can be another's phone number; the id wins
+    return next((user for user in users if user.pk == identifier), users[0])
+
 
 class PhoneOrIDBackend(BaseBackend):
     def authenticate(self, request, username=None, password=None, **kwargs):
-        if username is None or password is None:
+        # simplejwt's login serializer passes the USERNAME_FIELD, ``id``
+        identifier = username if username is not None else kwargs.get(User.USERNAME_FIELD)
+        if identifier is None or password is None:
+            return None
+        identifier = str(identifier)
+        if is_locked_out(identifier):
             return None
 
-        try:
-            # Try id first
-            user = User.objects.get(id=username)
-        except User.DoesNotExist:
-            try:
-                # Try phone number
-                user = User.objects.get(phone_number=username)
-            except User.DoesNotExist:
-                return None
-
-        if user.check_password(password):
+        user = find_user(identifier)
+        if user is not None and user.check_password(password):
+            clear_failures(identifier)
             return user
+        record_failure(identifier)
         return None
 
     def get_user(self, user_id):
@@ -28,3 +112,14 @@ class PhoneOrIDBackend(BaseBackend):
             return User.objects.get(pk=user_id)
         except User.DoesNotExist:
             return None
+
+
+class LoginIdentifierThrottle(BaseThrottle):
+    """Turns away logins for an identifier that failed too often, with 429"""
+
+    def allow_request(self, request, view):
+        identifier = request.data.get(User.USERNAME_FIELD) or request.data.get("username")
+        return not identifier or not is_locked_out(str(identifier))
+
+    def wait(self):
+        return failure_window()
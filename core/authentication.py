@@ -0,0 +1,163 @@
+"""
+JWT authentication without a user query on every request.
+
+Access tokens carry the user's ``role``, ``is_active`` flag and
+``token_version``. ClaimsJWTAuthentication builds ``request.user`` from
+those claims as a ClaimsUser instead of loading the CustomUser row, and
+the role checks in core/permissions.py read them from there.
+
+Revocation goes through the version: CustomUser.save bumps
+``token_version`` when the role, active flag or password changes, and
+the signal handler in core/signals.py drops the cached copy once that
+commits. A token whose version doesn't match the current one is refused,
+so a demoted, deactivated or re-passworded user loses access on their
+next request. The current version is cached per user for
+AUTH_TOKEN_VERSION_TIMEOUT seconds; changes made around save(), such as
+``QuerySet.update``, take at most that long to apply.
+
+Tokens issued before the claims existed fall back to loading the user.
+"""
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+
+CustomUser = get_user_model()
+
+KEY_PREFIX = "auth:token-version"
+VERSION_CLAIM = "ver"
+# Never matches a token, cached for users that are gone or inactive
+NO_VERSION = -1
+
+
+def _cache():
+    return caches[getattr(settings, "AUTH_TOKEN_CACHE_ALIAS", "default")]
+
+
+def version_timeout():
+    return getattr(settings, "AUTH_TOKEN_VERSION_TIMEOUT", 60 * 5)
+
+
+def _key(user_id):
+    return f"{KEY_PREFIX}:{user_id}"
+
+
+def remember_token_version(user):
+    _cache().set(_key(user.pk), user.token_version if user.is_active else NO_VERSION, version_timeout())
+
+
+def forget_token_version(user_id):
+    _cache().delete(_key(user_id))
+
+
+def current_token_version(user_id):
+    """The version a token of ``user_id`` needs, from the cache or the database"""
+    version = _cache().get(_key(user_id))
+    if version is None:
+        row = CustomUser.objects.filter(pk=user_id).values_list("token_version", "is_active").first()
+        version = row[0] if row is not None and row[1] else NO_VERSION
+        _cache().set(_key(user_id), version, version_timeout())
+    return version
+
+
+def add_user_claims(token, user):
+    token["role"] = user.role
+    token["is_active"] = user.is_active
+    token[VERSION_CLAIM] = user.token_version
+    # Issuing a token is when the current version is known for sure
+    remember_token_version(user)
+    return token
+
+
+def access_token_for(user):
+    """An access token with the claims ClaimsJWTAuthentication reads"""
+    return add_user_claims(AccessToken.for_user(user), user)
+
+
+class ClaimsUser(TokenUser):
+    """
+    ``request.user`` for a token with claims. Has the ``pk``, ``role`` and
+    ``is_active`` of the user, not its other fields; compare it by ``pk``.
+    """
+
+    @property
+    def role(self):
+        return self.token.get("role")
+
+    @property
+    def is_active(self):
+        return self.token.get("is_active", False)
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        if VERSION_CLAIM not in validated_token or "role" not in validated_token:
+            return super().get_user(validated_token)
+
+        user = ClaimsUser(validated_token)
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if validated_token[VERSION_CLAIM] != current_token_version(user.pk):
+            raise AuthenticationFailed(_("Token has been revoked"), code="token_revoked")
+        return user
+
+
+class QueryTokenJWTAuthentication(ClaimsJWTAuthentication):
+    """
+    Reads the access token from ``?token=``, for clients that can't set
+    an Authorization header, like ``<img src>``
+    """
+
+    def authenticate(self, request):
+        raw_token = request.query_params.get("token")
+        if not raw_token:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+        return self.get_user(validated_token), validated_token
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        return add_user_claims(super().get_token(user), user)
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    Checks the user behind the refresh token and gives the new access
+    token their current claims, rather than the ones the refresh token
+    was issued with.
+    """
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs["refresh"])
+        user = CustomUser.objects.filter(pk=refresh.get(api_settings.USER_ID_CLAIM)).first()
+        if user is None or not api_settings.USER_AUTHENTICATION_RULE(user):
+            raise AuthenticationFailed(self.error_messages["no_active_account"], "no_active_account")
+        if refresh.get(VERSION_CLAIM, user.token_version) != user.token_version:
+            raise AuthenticationFailed(_("Token has been revoked"), code="token_revoked")
+
+        access = add_user_claims(refresh.access_token, user)
+        data = {"access": str(access)}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                try:
+                    refresh.blacklist()
+                except AttributeError:
+                    pass
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            add_user_claims(refresh, user)
+            refresh.outstand()
+            data["refresh"] = str(refresh)
+        return data
+
@@ -0,0 +1,152 @@
+"""
+Maintains a per-property index of booked nights, so that a property whose
+version is already at hand can be checked for a date range without a
+query.
+
+Each property is stored in the cache as a ``(base, bits)`` pair where
+``base`` is the ordinal of the earliest booked night and bit ``i`` of
+``bits`` is set when the night ``base + i`` is held by a booking that
+hasn't been canceled. A date range is then free when none of its bits
+are set, which is a couple of integer operations.
+
+Entries are cached under the property's ``availability_version``, which
+the booking signals in core/signals.py move forward after each booking
+write that can change the nights held, in the same transaction when
+there is one. An entry is built from bookings read after the version was,
+so the bookings behind a version are always in its entry, and a write no
+process has seen yet simply lands under a key nobody has asked for. Every
+process sees a change once it commits, whatever cache it uses, and
+nothing is ever written back over a newer entry. A check costs no query
+when the caller has the property (``Property.is_available`` passes its
+version), one query to read the versions otherwise, and one more to build
+any entry not cached yet.
+
+Like the plain overlap query this replaces, a check made from a property
+loaded before another booking committed can miss that booking; the
+overlap constraint on the bookings table is what turns such a race away.
+Writes that bypass model signals (``bulk_create``, ``QuerySet.update``)
+must call ``bump_version`` for the properties they touch.
+"""
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+
+from .models import Booking, Property
+
+
+KEY_PREFIX = "availability"
+
+
+def _cache():
+    return caches[getattr(settings, "AVAILABILITY_CACHE_ALIAS", "default")]
+
+
+def _timeout():
+    return getattr(settings, "AVAILABILITY_INDEX_TIMEOUT", 60 * 60 * 24)
+
+
+def _key(property_id, version):
+    return f"{KEY_PREFIX}:{property_id}:{version}"
+
+
+def bump_version(*property_ids):
+    """Retire the cached entries of properties whose bookings changed"""
+    Property.objects.filter(pk__in=property_ids).update(
+        availability_version=F("availability_version") + 1
+    )
+
+
+def _add_range(entry, check_in, check_out):
+    """Return a new entry with the nights in [check_in, check_out) set"""
+    base, bits = entry
+    start = check_in.toordinal()
+    nights = check_out.toordinal() - start
+    if nights <= 0:
+        return entry
+
+    if not bits:
+        base = start
+    elif start < base:
+        # Rebase so that the earliest night stays at bit 0
+        bits <<= base - start
+        base = start
+
+    bits |= ((1 << nights) - 1) << (start - base)
+    return base, bits
+
+
+def _is_free(entry, start_date, end_date):
+    base, bits = entry
+    if not bits:
+        return True
+
+    low = start_date.toordinal() - base
+    high = end_date.toordinal() - base
+    if high <= 0:
+        return True
+    low = max(low, 0)
+    return not (bits >> low) & ((1 << (high - low)) - 1)
+
+
+def _build(property_ids):
+    """Build entries for the given properties with a single query"""
+    entries = {property_id: (0, 0) for property_id in property_ids}
+    bookings = (
+        Booking.objects
+        .filter(property_id__in=property_ids)
+        .exclude(status=Booking.BookingStatus.CANCELED)
+        .values_list("property_id", "check_in", "check_out")
+    )
+    for property_id, check_in, check_out in bookings:
+        entries[property_id] = _add_range(entries[property_id], check_in, check_out)
+    return entries
+
+
+
+def get_entries(versions):
+    """
+    Return ``{property_id: (base, bits)}`` for the properties of
+    ``versions``, a ``{property_id: availability_version}`` mapping,
+    building any that are missing from the cache in one query.
+    """
+    keys = {_key(property_id, version): property_id for property_id, version in versions.items()}
+    cached = _cache().get_many(keys.keys())
+    entries = {keys[key]: entry for key, entry in cached.items()}
+
+    missing = [property_id for property_id in versions if property_id not in entries]
+    if missing:
+        built = _build(missing)
+        _cache().set_many(
+            {_key(property_id, versions[property_id]): entry for property_id, entry in built.items()},
+            timeout=_timeout(),
+        )
+        entries.update(built)
+    return entries
+
+
+def is_available(property_id, start_date, end_date, version=None):
+    """
+    Check if a single property is free for [start_date, end_date). Pass
+    the ``availability_version`` of a property already loaded to skip
+    reading it.
+    """
+    versions = None if version is None else {property_id: version}
+    return bool(available_property_ids([property_id], start_date, end_date, versions))
+
+
+def available_property_ids(property_ids, start_date, end_date, versions=None):
+    """
+    Return the subset of ``property_ids`` free for [start_date, end_date).
+    ``versions`` maps them to their ``availability_version`` and is read
+    in one query when not given.
+    """
+    if versions is None:
+        versions = dict(
+            Property.objects.filter(pk__in=list(property_ids)).values_list("pk", "availability_version")
+        )
+    return {
+        property_id
+        for property_id, entry in get_entries(versions).items()
+        if _is_free(entry, start_date, end_date)
+    }
@@ -0,0 +1,77 @@
+"""
+Small helpers shared by the benchmark management commands in
+core/management/commands/.
+"""
+
+import statistics
+import time
+from contextlib import contextmanager
+
+from django.db import transaction
+
+
+class Rollback(Exception):
+    """Raised to undo the data seeded for a benchmark run"""
+
+
+@contextmanager
+def rolled_back():
+    """Run a block in a transaction that is always rolled back"""
+    try:
+        with transaction.atomic():
+            yield
+            raise Rollback
+    except Rollback:
+        pass
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not samples:
+        return 0.0
+    index = max(0, min(len(samples) - 1, round(pct / 100 * len(samples)) - 1))
+    return samples[index]
+
+
+def summarize(samples, elapsed=None):
+    """Summarize a list of per-call durations (in seconds) in milliseconds"""
+    samples = sorted(samples)
+    elapsed = elapsed if elapsed is not None else sum(samples)
+    return {
+        "calls": len(samples),
+        "mean_ms": statistics.fmean(samples) * 1000 if samples else 0.0,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p95_ms": percentile(samples, 95) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "max_ms": samples[-1] * 1000 if samples else 0.0,
+        "per_second": len(samples) / elapsed if elapsed else 0.0,
+    }
+
+
+def time_calls(func, args_list):
+    """Call ``func(*args)`` for each entry of ``args_list`` and summarize"""
+    samples = []
+    started = time.perf_counter()
+    for args in args_list:
+        call_started = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - call_started)
+    return summarize(samples, time.perf_counter() - started)
+
+
+# Id prefix of the users written by the seed_benchmark_data command; every
+# other seeded row hangs off one of them
+SEED_PREFIX = "seed-"
+
+
+def seeded_users():
+    """The first seeded user of each role, keyed by role"""
+    from django.contrib.auth import get_user_model
+
+    users = {}
+    queryset = get_user_model().objects.filter(id__startswith=SEED_PREFIX).order_by("id")
+    for role in ("admin", "host", "guest"):
+        user = queryset.filter(role=role).first()
+        if user is not None:
+            users[role] = user
+    return users
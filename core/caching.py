@@ -0,0 +1,195 @@
+"""
+Response caching for read-heavy, public viewset actions.
+
+Cached responses are keyed on the action, the object (for retrieve), the
+query string and a set of generation counters. Writes never delete
+responses; the signal handlers in core/signals.py bump the counters they
+affect instead, so every response that depended on them stops being
+looked up and simply expires.
+
+Responses carry an ETag hashed from their content and a Last-Modified of
+when they were built, both stored with the entry, so conditional
+requests are answered from the cache as well.
+
+Each entry is stored with a soft expiry. Once it passes, one request takes
+a short lock and rebuilds the response while the others keep serving the
+stale copy, so a popular page expiring doesn't send every worker to the
+database at once.
+"""
+
+import hashlib
+import json
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.http import http_date, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from .conditional import is_not_modified
+
+
+KEY_PREFIX = "response"
+
+
+def _cache():
+    return caches[getattr(settings, "RESPONSE_CACHE_ALIAS", "default")]
+
+
+def _timeout():
+    return getattr(settings, "RESPONSE_CACHE_TIMEOUT", 60 * 5)
+
+
+def _stale_timeout():
+    """How long an expired response may still be served while it's rebuilt"""
+    return getattr(settings, "RESPONSE_CACHE_STALE_TIMEOUT", 60)
+
+
+LOCK_TIMEOUT = 10
+LOCK_WAIT = 2
+LOCK_POLL_INTERVAL = 0.05
+
+
+def _initial_generation():
+    # Counters start from the clock, so one that was evicted and created
+    # again can't collide with a value already used in a cached key
+    return time.time_ns() // 1000
+
+
+def generation(name):
+    """Current value of a generation counter"""
+    key = f"{KEY_PREFIX}:generation:{name}"
+    value = _cache().get(key)
+    if value is None:
+        _cache().add(key, _initial_generation(), timeout=None)
+        value = _cache().get(key)
+    return value
+
+
+def bump_generation(*names):
+    """Invalidate every cached response that depends on any of ``names``"""
+    for name in names:
+        key = f"{KEY_PREFIX}:generation:{name}"
+        try:
+            _cache().incr(key)
+        except ValueError:
+            _cache().set(key, _initial_generation(), timeout=None)
+
+
+def get_or_build(key, build):
+    """
+    Return the cached value for ``key``, calling ``build()`` to make it
+    when it is missing or stale, with at most one builder per key.
+    A ``None`` from ``build()`` is returned but not cached.
+    """
+    cache = _cache()
+    entry = cache.get(key)
+    now = time.time()
+    if entry is not None and entry["expires"] > now:
+        return entry["value"]
+
+    lock_key = f"{key}:lock"
+    if cache.add(lock_key, 1, timeout=LOCK_TIMEOUT):
+        try:
+            value = build()
+            if value is not None:
+                cache.set(
+                    key,
+                    {"value": value, "expires": time.time() + _timeout()},
+                    timeout=_timeout() + _stale_timeout(),
+                )
+            return value
+        finally:
+            cache.delete(lock_key)
+
+    if entry is not None:
+        # Someone else is rebuilding it, the stale copy will do meanwhile
+        return entry["value"]
+
+    # Cold miss while another request builds it: wait for its result
+    deadline = now + LOCK_WAIT
+    while time.time() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry["value"]
+    return build()
+
+
+class CachedResponseMixin:
+    """
+    Caches successful responses of ``cached_actions`` on a viewset.
+
+    - ``cache_namespace`` names the generation bumped when any object of
+      the viewset changes; list responses depend on it
+    - retrieve responses depend on the per-object generation
+      ``<cache_namespace>:<pk>`` instead, with UUID primary keys in their
+      canonical lowercase form
+    - ``get_cache_dependencies`` can add further generations, e.g. when a
+      filter reads another table
+
+    Cached responses carry an ETag and Last-Modified stored with them and
+    answer ``If-None-Match``/``If-Modified-Since`` with a 304, so the
+    viewset doesn't need ConditionalGetMixin for these actions.
+    """
+    cached_actions = ('list', 'retrieve')
+    cache_namespace = None
+
+    def get_cache_dependencies(self, request):
+        if self.action == 'retrieve':
+            lookup = self.kwargs[self.lookup_url_kwarg or self.lookup_field]
+            try:
+                # The signals bump the canonical form; the URL may have any case
+                lookup = str(uuid.UUID(lookup))
+            except ValueError:
+                pass
+            return [f"{self.cache_namespace}:{lookup}"]
+        return [self.cache_namespace]
+
+    def get_cache_key(self, request):
+        query = sorted(request.query_params.lists())
+        versions = [
+            f"{name}={generation(name)}"
+            for name in self.get_cache_dependencies(request)
+        ]
+        digest = hashlib.md5(
+            repr((self.action, self.kwargs, query, versions)).encode()
+        ).hexdigest()
+        return f"{KEY_PREFIX}:{self.cache_namespace}:{self.action}:{digest}"
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if self.action not in self.cached_actions:
+            return handler(request, *args, **kwargs)
+
+        uncached = {}
+
+        def build():
+            response = handler(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                # Don't cache errors; hand the response back as-is
+                uncached['response'] = response
+                return None
+            content = json.dumps(response.data, cls=DjangoJSONEncoder, sort_keys=True)
+            etag = quote_etag(hashlib.sha256(content.encode()).hexdigest()[:32])
+            return response.data, etag, int(time.time())
+
+        entry = get_or_build(self.get_cache_key(request), build)
+        if 'response' in uncached:
+            return uncached['response']
+
+        # The ETag follows the content and Last-Modified the time it was
+        # built, which only changes after a generation it depends on
+        data, etag, last_modified = entry
+        headers = {'ETag': etag, 'Last-Modified': http_date(last_modified)}
+        if is_not_modified(request, etag, last_modified):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(data, headers=headers)
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
@@ -0,0 +1,166 @@
+"""
+Conditional GET (ETag / Last-Modified) for viewset list and retrieve.
+
+Before the real query and serialization run, a cheap version lookup reads
+only the ``updated_at`` timestamps the response depends on. The ETag is a
+hash of those versions, the request (path, query string, user) and the
+serializer, so a client sending it back in ``If-None-Match`` gets a 304
+without the response ever being built.
+
+Viewsets whose responses are cached by core/caching.py get their ETag
+and Last-Modified from the cached entry instead, so a cache hit, 304 or
+not, runs no queries at all.
+"""
+
+import hashlib
+
+from django.core.exceptions import ValidationError
+from django.db.models import Count, F, Max
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+
+class ConditionalGetMixin:
+    """
+    Adds ETag and Last-Modified headers to list and retrieve responses and
+    answers matching ``If-None-Match``/``If-Modified-Since`` with a 304.
+
+    - ``etag_fields`` are single-valued timestamps (the object's and those
+      of related objects it embeds) read for both actions
+    - ``etag_detail_fields`` are extra timestamps for retrieve only, such
+      as many-to-many relations that would duplicate list rows
+    """
+    etag_fields = ('updated_at',)
+    etag_detail_fields = ()
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(self.get_list_version, super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(self.get_detail_version, super().retrieve, request, *args, **kwargs)
+
+    def get_list_version(self, request):
+        """Versions of the rows on the requested page, without serializing them"""
+        queryset = (
+            self.filter_queryset(self.get_queryset())
+            .select_related(None)
+            .prefetch_related(None)
+            .annotate(**{
+                f'etag_{index}': F(field)
+                for index, field in enumerate(self.etag_fields)
+            })
+        )
+        ordering = getattr(self.paginator, 'ordering', None) or ()
+        queryset = queryset.only('pk', *[field.lstrip('-') for field in ordering])
+
+        rows = self.paginate_queryset(queryset)
+        if rows is None:
+            rows = list(queryset)
+        versions = [
+            (row.pk, *[getattr(row, f'etag_{index}') for index in range(len(self.etag_fields))])
+            for row in rows
+        ]
+        page = getattr(self.paginator, 'page', None)
+        total = getattr(getattr(page, 'paginator', None), 'count', None)
+        # Keyset pages carry their count, when asked for, in headers
+        count_headers = getattr(self.paginator, 'count_headers', None)
+        if count_headers:
+            total = sorted(count_headers.items())
+        return versions, total
+
+    def get_detail_version(self, request):
+        """Versions of a single object, or None if it doesn't exist"""
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        fields = (*self.etag_fields, *self.etag_detail_fields)
+        # Aggregate outside the filtered queryset, so a filter through a
+        # many-to-many relation doesn't also narrow the versions read from it
+        try:
+            visible = (
+                self.filter_queryset(self.get_queryset())
+                .filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+            )
+            version = (
+                visible.model._default_manager
+                .filter(pk__in=visible.values('pk'))
+                .aggregate(
+                    etag_count=Count('pk', distinct=True),
+                    **{f'etag_{index}': Max(field) for index, field in enumerate(fields)},
+                )
+            )
+        except (TypeError, ValueError, ValidationError):
+            # A malformed lookup; let retrieve() answer it with its 404
+            return None
+        if not version.pop('etag_count'):
+            return None
+        return [version[f'etag_{index}'] for index in range(len(fields))]
+
+    def get_etag(self, request, version):
+        user = getattr(request, 'user', None)
+        key = repr((
+            type(self).__name__,
+            self.action,
+            sorted(self.kwargs.items()),
+            sorted(request.query_params.lists()),
+            getattr(user, 'pk', None),
+            self.get_serializer_class().__name__,
+            version,
+        ))
+        return quote_etag(hashlib.sha256(key.encode()).hexdigest()[:32])
+
+    def get_last_modified(self, version):
+        timestamps = []
+
+        def collect(value):
+            if isinstance(value, (list, tuple)):
+                for item in value:
+                    collect(item)
+            elif hasattr(value, 'timestamp'):
+                timestamps.append(value.timestamp())
+
+        collect(version)
+        return int(max(timestamps)) if timestamps else None
+
+    def conditional_response(self, version_lookup, handler, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return handler(request, *args, **kwargs)
+
+        version = version_lookup(request)
+        if version is None:
+            return handler(request, *args, **kwargs)
+
+        etag = self.get_etag(request, version)
+        last_modified = self.get_last_modified(version)
+        headers = {'ETag': etag}
+        if last_modified is not None:
+            headers['Last-Modified'] = http_date(last_modified)
+
+        if self.is_not_modified(request, etag, last_modified):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        response = handler(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            for header, value in headers.items():
+                response[header] = value
+        return response
+
+    def is_not_modified(self, request, etag, last_modified):
+        return is_not_modified(request, etag, last_modified)
+
+
+def is_not_modified(request, etag, last_modified):
+    """Whether the request's If-None-Match or If-Modified-Since calls for a 304"""
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        # Weak comparison, as RFC 9110 asks for If-None-Match
+        return '*' in etags or etag.removeprefix('W/') in {
+            tag.removeprefix('W/') for tag in etags
+        }
+
+    if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    return (
+        if_modified_since is not None
+        and last_modified is not None
+        and last_modified <= if_modified_since
+    )
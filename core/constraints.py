@@ -0,0 +1,48 @@
+"""
+Database constraints used by the models in core/models.py that need more
+than the built-in check and unique constraints.
+"""
+
+from django.contrib.postgres.constraints import ExclusionConstraint
+from django.contrib.postgres.fields import DateRangeField
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Func
+
+
+class DateRange(Func):
+    """``daterange(start, end)`` with the default ``[)`` bounds"""
+    function = 'DATERANGE'
+    output_field = DateRangeField()
+
+
+class PostgresExclusionConstraint(ExclusionConstraint):
+    """
+    An ExclusionConstraint that is only created and validated on PostgreSQL.
+
+    Other backends (SQLite for local development) can't express it, so the
+    constraint is left out of their schema and Python-side checks have to
+    stand in for it there.
+    """
+
+    def _is_postgres(self, connection):
+        return connection.vendor == 'postgresql'
+
+    def constraint_sql(self, model, schema_editor):
+        if not self._is_postgres(schema_editor.connection):
+            return None
+        return super().constraint_sql(model, schema_editor)
+
+    def create_sql(self, model, schema_editor):
+        if not self._is_postgres(schema_editor.connection):
+            return None
+        return super().create_sql(model, schema_editor)
+
+    def remove_sql(self, model, schema_editor):
+        if not self._is_postgres(schema_editor.connection):
+            return None
+        return super().remove_sql(model, schema_editor)
+
+    def validate(self, model, instance, exclude=None, using=DEFAULT_DB_ALIAS):
+        if not self._is_postgres(connections[using]):
+            return
+        return super().validate(model, instance, exclude=exclude, using=using)
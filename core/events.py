@@ -0,0 +1,162 @@
+"""
+Publish/subscribe for payment status changes, used by the Server-Sent
+Events stream in core/views.py.
+
+Code that changes a payment calls ``publish_payment_status`` and the
+message goes out once the transaction commits. Waiting clients are
+asyncio queues, so a process can hold thousands of them.
+
+With EVENTS_REDIS_URL set, messages travel over Redis pub/sub, which is
+needed when the publisher is a Celery worker. Each process keeps a single
+pattern subscription and fans messages out to its local queues. Without
+it, an in-process broker is used, which is enough for tests and for
+single-process development.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+from contextlib import asynccontextmanager
+
+import redis
+import redis.asyncio as aioredis
+from django.conf import settings
+from django.db import transaction
+
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_PREFIX = "nexus:events:"
+
+
+def payment_channel(payment_id):
+    return f"payment:{payment_id}"
+
+
+class LocalBroker:
+    """Delivers messages to subscribers in the same process"""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def _deliver(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for loop, queue in subscribers:
+            # publish() may run in any thread; the queue belongs to its loop
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+
+    def publish(self, channel, message):
+        self._deliver(channel, message)
+
+    async def _listen(self):
+        """Hook for brokers that have to start reading from elsewhere"""
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        """An asyncio.Queue receiving every message published on ``channel``"""
+        await self._listen()
+        entry = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(entry)
+        try:
+            yield entry[1]
+        finally:
+            with self._lock:
+                subscribers = self._subscribers.get(channel)
+                subscribers.discard(entry)
+                if not subscribers:
+                    del self._subscribers[channel]
+
+
+class RedisBroker(LocalBroker):
+    """
+    Publishes through Redis. One pattern subscription per process and
+    event loop reads every channel and hands messages to local queues.
+    """
+
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+        self._client = None
+        self._listeners = {}
+
+    def publish(self, channel, message):
+        if self._client is None:
+            self._client = redis.Redis.from_url(self.url)
+        self._client.publish(CHANNEL_PREFIX + channel, json.dumps(message))
+
+    async def _listen(self):
+        loop = asyncio.get_running_loop()
+        task, ready = self._listeners.get(loop, (None, None))
+        if task is None or task.done():
+            ready = asyncio.Event()
+            task = loop.create_task(self._read(ready))
+            self._listeners[loop] = (task, ready)
+        await ready.wait()
+
+    async def _read(self, ready):
+        client = aioredis.Redis.from_url(self.url)
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.psubscribe(CHANNEL_PREFIX + "*")
+            ready.set()
+            async for item in pubsub.listen():
+                channel = item["channel"].decode().removeprefix(CHANNEL_PREFIX)
+                try:
+                    message = json.loads(item["data"])
+                except ValueError:
+                    continue
+                self._deliver(channel, message)
+        except Exception:
+            logger.exception("Event subscription to %s dropped", self.url)
+        finally:
+            ready.set()
+            await pubsub.aclose()
+            await client.aclose()
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                url = getattr(settings, "EVENTS_REDIS_URL", None)
+                _broker = RedisBroker(url) if url else LocalBroker()
+    return _broker
+
+
+def payment_status(payment, booking=None):
+    """The message sent to clients waiting on ``payment``"""
+    booking = booking or payment.booking
+    return {
+        "payment_id": str(payment.pk),
+        "status": payment.status,
+        "mpesa_ref": payment.mpesa_ref,
+        "booking_id": str(booking.pk),
+        "booking_status": booking.status,
+        "balance_due": str(booking.balance_due),
+    }
+
+
+def publish_payment_status(payments):
+    """Publish the status of ``payments`` once the current transaction commits"""
+    messages = [(payment_channel(payment.pk), payment_status(payment)) for payment in payments]
+    if not messages:
+        return
+
+    def publish():
+        for channel, message in messages:
+            try:
+                broker().publish(channel, message)
+            except Exception:
+                # Clients fall back to polling; never fail the payment over it
+                logger.exception("Couldn't publish %s", channel)
+
+    transaction.on_commit(publish)
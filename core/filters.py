@@ -1,11 +1,140 @@
 """
 Used to filter data based on specific criteria,
 such as filtering properties by location or price range,
-or filtering bookings by date or status. 
-This allows for more efficient querying and retrieval of 
+or filtering bookings by date or status.
+This allows for more efficient querying and retrieval of
 relevant data from the database.
 """
 
 
-from rest_framework.filters import filters
+import django_filters
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connections
+from django.db.models import Exists, F, OuterRef
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import SearchFilter
 
+from . import geo
+from .models import Property, Booking
+
+
+class PropertyFilter(django_filters.FilterSet):
+    """
+    Filters for listing properties
+
+    - ``check_in`` and ``check_out`` only return properties with no
+      active booking overlapping [check_in, check_out)
+    - ``location`` matches part of the property's location
+    - ``min_price`` and ``max_price`` bound the price per night
+    - ``near=<lat>,<lng>`` with ``radius_km`` (default 5) keeps properties
+      within that distance, nearest first
+    - ``bbox=<min_lng>,<min_lat>,<max_lng>,<max_lat>`` keeps properties
+      inside the box, which crosses the antimeridian when min_lng > max_lng
+    """
+    check_in = django_filters.DateFilter(method='filter_dates')
+    check_out = django_filters.DateFilter(method='filter_dates')
+    location = django_filters.CharFilter(field_name='location', lookup_expr='icontains')
+    min_price = django_filters.NumberFilter(field_name='price_per_night', lookup_expr='gte')
+    max_price = django_filters.NumberFilter(field_name='price_per_night', lookup_expr='lte')
+    near = django_filters.CharFilter(method='filter_near')
+    radius_km = django_filters.NumberFilter(method='filter_near')
+    bbox = django_filters.CharFilter(method='filter_bbox')
+
+    default_radius_km = 5
+    max_radius_km = 500
+
+    class Meta:
+        model = Property
+        fields = [
+            'check_in', 'check_out', 'location', 'min_price', 'max_price',
+            'near', 'radius_km', 'bbox',
+        ]
+
+    def filter_dates(self, queryset, name, value):
+        # Both dates are applied together in filter_queryset
+        return queryset
+
+    def filter_near(self, queryset, name, value):
+        if name == 'radius_km':
+            # Applied together with near below
+            return queryset
+
+        latitude, longitude = parse_floats(value, 2, 'near')
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValidationError("near must be a valid latitude,longitude.")
+
+        radius = self.form.cleaned_data.get('radius_km')
+        radius = float(radius) if radius is not None else self.default_radius_km
+        if not 0 < radius <= self.max_radius_km:
+            raise ValidationError(
+                f"radius_km must be between 0 and {self.max_radius_km}."
+            )
+        return geo.within_radius(queryset, latitude, longitude, radius)
+
+    def filter_bbox(self, queryset, name, value):
+        min_lng, min_lat, max_lng, max_lat = parse_floats(value, 4, 'bbox')
+        # min_lng > max_lng is a box across the antimeridian
+        if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lng <= 180 and -180 <= max_lng <= 180):
+            raise ValidationError("bbox must be min_lng,min_lat,max_lng,max_lat.")
+        return geo.within_box(queryset, min_lat, min_lng, max_lat, max_lng)
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+
+        check_in = self.form.cleaned_data.get('check_in')
+        check_out = self.form.cleaned_data.get('check_out')
+        if check_in is None and check_out is None:
+            return queryset
+
+        if check_in is None or check_out is None:
+            raise ValidationError(
+                "Both check_in and check_out are required to filter by availability."
+            )
+        if check_out <= check_in:
+            raise ValidationError("Check-out date must be after check-in date.")
+
+        return queryset.filter(~Exists(overlapping_bookings(check_in, check_out)))
+
+
+def parse_floats(value, count, name):
+    """Parse a comma separated list of ``count`` numbers from a query param"""
+    try:
+        numbers = [float(part) for part in value.split(',')]
+    except ValueError:
+        numbers = []
+    if len(numbers) != count:
+        raise ValidationError(f"{name} must be {count} comma separated numbers.")
+    return numbers
+
+
+def overlapping_bookings(check_in, check_out):
+    """Active bookings of the outer property that overlap [check_in, check_out)"""
+    return Booking.objects.filter(
+        property=OuterRef('pk'),
+        check_in__lt=check_out,
+        check_out__gt=check_in,
+    ).exclude(status=Booking.BookingStatus.CANCELED)
+
+
+class PropertySearchFilter(SearchFilter):
+    """
+    ``?search=`` for properties.
+
+    On PostgreSQL the terms are matched against the GIN indexed
+    ``search_vector`` and results are ordered by ``ts_rank``. Other
+    databases fall back to SearchFilter's ILIKE over ``search_fields``.
+    """
+    search_config = 'english'
+
+    def filter_queryset(self, request, queryset, view):
+        terms = request.query_params.get(self.search_param, '').strip()
+        if not terms or connections[queryset.db].vendor != 'postgresql':
+            return super().filter_queryset(request, queryset, view)
+
+        query = SearchQuery(terms, search_type='websearch', config=self.search_config)
+        return (
+            queryset
+            .filter(search_vector=query)
+            .annotate(rank=SearchRank(F('search_vector'), query))
+            .order_by('-rank', '-created_at')
+        )
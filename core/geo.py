@@ -0,0 +1,124 @@
+"""
+Helpers for radius and bounding-box searches over property coordinates
+without a spatial database extension.
+
+Every property with coordinates is assigned a grid cell of
+``CELL_DEGREES`` x ``CELL_DEGREES``. A search first narrows the rows to the
+cells covering its bounding box with an indexed ``geo_cell IN (...)``,
+then applies the exact box and, for radius searches, the haversine
+distance. Boxes crossing the antimeridian are split in two. The same SQL
+runs on PostgreSQL and SQLite.
+
+Property.save and the bulk_create/bulk_update of PropertyQuerySet keep
+``geo_cell`` in step with the coordinates.
+"""
+
+import math
+
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+CELL_DEGREES = 0.05
+CELLS_PER_ROW = round(360 / CELL_DEGREES)
+
+# Bigger boxes skip the cell filter and use the latitude/longitude index
+MAX_CELLS = 400
+
+
+def _row(latitude):
+    return math.floor((latitude + 90) / CELL_DEGREES)
+
+
+def _column(longitude):
+    return min(math.floor((longitude + 180) / CELL_DEGREES), CELLS_PER_ROW - 1)
+
+
+def cell_for(latitude, longitude):
+    """Grid cell of a coordinate, or None when it has no coordinates"""
+    if latitude is None or longitude is None:
+        return None
+    return _row(latitude) * CELLS_PER_ROW + _column(longitude)
+
+
+def cells_for_box(min_lat, min_lng, max_lat, max_lng):
+    """Cells covering a box, or None if there are more than MAX_CELLS"""
+    rows = range(_row(min_lat), _row(max_lat) + 1)
+    columns = range(_column(min_lng), _column(max_lng) + 1)
+    if len(rows) * len(columns) > MAX_CELLS:
+        return None
+    return [row * CELLS_PER_ROW + column for row in rows for column in columns]
+
+
+def box_around(latitude, longitude, radius_km):
+    """
+    ``(min_lat, min_lng, max_lat, max_lng)`` enclosing a circle. Longitudes
+    are wrapped into [-180, 180], so ``min_lng > max_lng`` when the circle
+    crosses the antimeridian.
+    """
+    angular = radius_km / EARTH_RADIUS_KM
+    delta_lat = math.degrees(angular)
+    min_lat, max_lat = latitude - delta_lat, latitude + delta_lat
+    if min_lat <= -90 or max_lat >= 90:
+        # The circle takes in a pole, and with it every longitude
+        return max(min_lat, -90), -180, min(max_lat, 90), 180
+
+    # Widest at the latitude where the circle touches its meridians
+    delta_lng = math.degrees(math.asin(min(math.sin(angular) / math.cos(math.radians(latitude)), 1)))
+    min_lng, max_lng = longitude - delta_lng, longitude + delta_lng
+    if max_lng - min_lng >= 360:
+        return min_lat, -180, max_lat, 180
+    if min_lng < -180:
+        min_lng += 360
+    if max_lng > 180:
+        max_lng -= 360
+    return min_lat, min_lng, max_lat, max_lng
+
+
+def _box(min_lat, min_lng, max_lat, max_lng):
+    cells = cells_for_box(min_lat, min_lng, max_lat, max_lng)
+    condition = Q(
+        latitude__gte=min_lat,
+        latitude__lte=max_lat,
+        longitude__gte=min_lng,
+        longitude__lte=max_lng,
+    )
+    if cells is not None:
+        condition &= Q(geo_cell__in=cells)
+    return condition
+
+
+def within_box(queryset, min_lat, min_lng, max_lat, max_lng):
+    """
+    Properties whose coordinates fall inside the box. A box with
+    ``min_lng > max_lng`` crosses the antimeridian and is searched as the
+    two boxes on either side of it.
+    """
+    if min_lng <= max_lng:
+        return queryset.filter(_box(min_lat, min_lng, max_lat, max_lng))
+    return queryset.filter(
+        _box(min_lat, min_lng, max_lat, 180) | _box(min_lat, -180, max_lat, max_lng)
+    )
+
+
+def distance_km(latitude, longitude):
+    """Haversine distance in km from a point to each row's coordinates"""
+    lat = Radians(F('latitude'))
+    lat0 = Radians(Value(latitude, output_field=FloatField()))
+    half_dlat = (lat - lat0) / 2
+    half_dlng = Radians(F('longitude') - Value(longitude, output_field=FloatField())) / 2
+    a = Power(Sin(half_dlat), 2) + Cos(lat0) * Cos(lat) * Power(Sin(half_dlng), 2)
+    return 2 * EARTH_RADIUS_KM * ASin(Sqrt(a))
+
+
+def within_radius(queryset, latitude, longitude, radius_km):
+    """Properties within ``radius_km``, annotated with ``distance`` and nearest first"""
+    queryset = within_box(queryset, *box_around(latitude, longitude, radius_km))
+    return (
+        queryset
+        .annotate(distance=distance_km(latitude, longitude))
+        .filter(distance__lte=radius_km)
+        .order_by('distance')
+    )
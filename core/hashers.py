@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    """
+    Django's PBKDF2 hasher with PASSWORD_PBKDF2_ITERATIONS iterations,
+    Django's default when unset. check_password rehashes a password stored
+    with any other count on the next successful login, so changing the
+    setting moves every active user to the new cost.
+    """
+
+    @property
+    def iterations(self):
+        return getattr(settings, "PASSWORD_PBKDF2_ITERATIONS", None) or hashers.PBKDF2PasswordHasher.iterations
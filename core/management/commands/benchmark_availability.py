@@ -0,0 +1,153 @@
+"""
+Compares the availability index in core/availability.py with the plain
+overlapping-bookings query as the number of bookings per property grows.
+
+    python manage.py benchmark_availability --sizes 10 100 1000 10000
+
+Seeded data is rolled back once the run finishes.
+"""
+
+import random
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth import get_user_model
+
+from core import availability
+from core.benchmarks import rolled_back, time_calls
+from core.models import Property, Booking
+
+
+CustomUser = get_user_model()
+
+
+def orm_is_available(property_id, start_date, end_date):
+    return not Booking.objects.filter(
+        property_id=property_id,
+        check_in__lt=end_date,
+        check_out__gt=start_date,
+    ).exclude(status=Booking.BookingStatus.CANCELED).exists()
+
+
+class Command(BaseCommand):
+    help = "Benchmark the availability index against the ORM overlap query"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", nargs="+", type=int, default=[10, 100, 1000, 10000],
+            help="Bookings per property to benchmark",
+        )
+        parser.add_argument(
+            "--lookups", type=int, default=500,
+            help="Availability checks per size",
+        )
+        parser.add_argument(
+            "--properties", type=int, default=50,
+            help="Properties checked at once for the batch lookup",
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        self.stdout.write(
+            f"{'bookings':>9} {'orm p50':>9} {'orm p95':>9} "
+            f"{'index p50':>10} {'index p95':>10} "
+            f"{'free orm':>9} {'free idx':>9} {'cold ms':>8} "
+            f"{'batch orm':>10} {'batch idx':>10}"
+        )
+        for size in options["sizes"]:
+            with rolled_back():
+                row = self._run(size, options["lookups"], options["properties"], rng)
+            self.stdout.write(
+                f"{size:>9} {row['orm']['p50_ms']:>9.3f} {row['orm']['p95_ms']:>9.3f} "
+                f"{row['index']['p50_ms']:>10.3f} {row['index']['p95_ms']:>10.3f} "
+                f"{row['free_orm']['p50_ms']:>9.3f} {row['free_index']['p50_ms']:>9.3f} "
+                f"{row['cold_ms']:>8.2f} {row['batch_orm_ms']:>10.2f} "
+                f"{row['batch_index_ms']:>10.2f}"
+            )
+
+    def _run(self, size, lookups, property_count, rng):
+        owner = CustomUser.objects.create(
+            id="bench-owner",
+            name="Benchmark Owner",
+            phone_number="+0000000000",
+            id_photo="users/photos/bench.jpg",
+            role=CustomUser.Roles.HOST,
+        )
+        properties = Property.objects.bulk_create([
+            Property(
+                owner=owner,
+                name=f"Benchmark {index}",
+                description="",
+                location="",
+                amenities="",
+                price_per_night=100,
+            )
+            for index in range(property_count)
+        ])
+
+        # Two-night stays with a free night in between, starting today
+        start = date.today()
+        bookings = []
+        for prop in properties:
+            for index in range(size):
+                check_in = start + timedelta(days=index * 3)
+                bookings.append(Booking(
+                    property=prop,
+                    check_in=check_in,
+                    check_out=check_in + timedelta(days=2),
+                    price_per_night=100,
+                    total_price=200,
+                ))
+        Booking.objects.bulk_create(bookings, batch_size=5000)
+
+        horizon = size * 3
+        target = properties[0]
+        version = target.availability_version
+        ranges = []
+        for _ in range(lookups):
+            check_in = start + timedelta(days=rng.randrange(horizon))
+            ranges.append((target.pk, check_in, check_in + timedelta(days=rng.randint(1, 7))))
+        # Random ranges mostly cross a booked night; these are the free
+        # nights between stays, so the free answer is measured on its own
+        free_ranges = []
+        for _ in range(lookups):
+            check_in = start + timedelta(days=rng.randrange(size) * 3 + 2)
+            free_ranges.append((target.pk, check_in, check_in + timedelta(days=1)))
+
+        def index_is_available(property_id, start_date, end_date):
+            return availability.is_available(property_id, start_date, end_date, version)
+
+        availability._cache().delete_many(
+            [availability._key(prop.pk, prop.availability_version) for prop in properties]
+        )
+        cold = time_calls(index_is_available, ranges[:1])
+        orm = time_calls(orm_is_available, ranges)
+        index = time_calls(index_is_available, ranges)
+        free_orm = time_calls(orm_is_available, free_ranges)
+        free_index = time_calls(index_is_available, free_ranges)
+        if not all(index_is_available(*args) for args in free_ranges):
+            raise CommandError("The index reported a free night as taken.")
+
+        versions = {prop.pk: prop.availability_version for prop in properties}
+        _, check_in, check_out = ranges[0]
+        availability.get_entries(versions)
+        batch_orm = time_calls(
+            lambda: [orm_is_available(pk, check_in, check_out) for pk in versions],
+            [()],
+        )
+        batch_index = time_calls(
+            availability.available_property_ids,
+            [(list(versions), check_in, check_out, versions)],
+        )
+        availability._cache().delete_many(
+            [availability._key(pk, version) for pk, version in versions.items()]
+        )
+        return {
+            "orm": orm,
+            "index": index,
+            "free_orm": free_orm,
+            "free_index": free_index,
+            "cold_ms": cold["max_ms"],
+            "batch_orm_ms": batch_orm["max_ms"],
+            "batch_index_ms": batch_index["max_ms"],
+        }
@@ -0,0 +1,241 @@
+"""
+Latency and throughput of every read route in core/urls.py, for each role.
+
+    python manage.py seed_benchmark_data
+    python manage.py benchmark_endpoints --requests 200 --output before.json
+    ... change something ...
+    python manage.py benchmark_endpoints --requests 200 --compare before.json
+
+Requests go through the whole middleware, authentication and view stack
+with a JWT for the first seeded admin, host and guest, and detail routes
+use an object that role can see. Routes that write (payment
+creation, the Mpesa callback) and the event stream are covered by
+benchmark_payments instead.
+
+``--output`` writes the results as JSON, tagged with the current git
+commit. ``--compare`` prints the p95 change against such a file and fails
+when a route got slower than ``--threshold`` percent.
+"""
+
+import json
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.utils import timezone
+
+from core.authentication import access_token_for
+from core.benchmarks import seeded_users, summarize
+from core.models import Booking, Payment, Property
+
+
+CustomUser = get_user_model()
+
+# (name, path); "{pk}" is an object from detail_targets
+ROUTES = [
+    ("users-list", "/api/users/"),
+    ("users-detail", "/api/users/{self}/"),
+    ("properties-list", "/api/properties/"),
+    ("properties-search", "/api/properties/?search=ocean+villa"),
+    ("properties-price", "/api/properties/?ordering=price_per_night&max_price=100"),
+    ("properties-near", "/api/properties/?near=-1.29,36.82&radius_km=10"),
+    ("properties-detail", "/api/properties/{pk}/"),
+    ("bookings-list", "/api/bookings/"),
+    ("bookings-detail", "/api/bookings/{pk}/"),
+    ("payments-list", "/api/payments/"),
+    ("payments-detail", "/api/payments/{pk}/"),
+]
+
+NO_CACHE = {"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+
+
+def detail_targets(user):
+    """Objects each role can open, as the viewsets scope them"""
+    properties = Property.objects.all()
+    bookings = Booking.objects.all()
+    payments = Payment.objects.all()
+    if user.role == "host":
+        properties = properties.filter(owner=user)
+        bookings = bookings.filter(property__owner=user)
+    if user.role != "admin":
+        payments = payments.for_guest(user)
+    if user.role == "guest":
+        bookings = bookings.with_guest(user)
+    return {"properties": properties, "bookings": bookings, "payments": payments}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "Benchmark the API routes per role against the seeded dataset"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=100, help="Timed requests per route and role")
+        parser.add_argument("--warmup", type=int, default=5)
+        parser.add_argument("--concurrency", type=int, default=1)
+        parser.add_argument("--roles", nargs="+", default=["admin", "host", "guest"])
+        parser.add_argument("--routes", nargs="+", help="Only these routes, by name")
+        parser.add_argument("--no-cache", action="store_true", help="Disable the response cache")
+        parser.add_argument("--output", help="Write the results to this JSON file")
+        parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+        parser.add_argument("--threshold", type=float, default=10.0, help="p95 slowdown, in percent, that fails --compare")
+
+    def handle(self, *args, **options):
+        users = seeded_users()
+        missing = set(options["roles"]) - set(users)
+        if missing:
+            raise CommandError(f"No seeded {', '.join(sorted(missing))} user, run seed_benchmark_data first.")
+
+        routes = [route for route in ROUTES if not options["routes"] or route[0] in options["routes"]]
+        overrides = {"DEBUG": False}
+        if options["no_cache"]:
+            overrides["CACHES"] = NO_CACHE
+
+        results = []
+        self.pool = None
+        if options["concurrency"] > 1:
+            self.pool = ThreadPoolExecutor(max_workers=options["concurrency"])
+        with override_settings(**overrides):
+            for role in options["roles"]:
+                user = users[role]
+                token = str(access_token_for(user))
+                for name, path in routes:
+                    path = self._resolve(path, user)
+                    if path is None:
+                        self.stderr.write(f"{name}: nothing visible to the {role}, skipped")
+                        continue
+                    row = self._measure(path, token, options)
+                    results.append({"route": name, "role": role, "method": "GET", "path": path, **row})
+                    self._print_row(name, role, row)
+        if self.pool is not None:
+            self._close_pool(options["concurrency"])
+
+        report = {
+            "commit": git_commit(),
+            "created": timezone.now().isoformat(),
+            "database": connection.vendor,
+            "dataset": {
+                "users": CustomUser.objects.count(),
+                "properties": Property.objects.count(),
+                "bookings": Booking.objects.count(),
+                "payments": Payment.objects.count(),
+            },
+            "requests": options["requests"],
+            "concurrency": options["concurrency"],
+            "response_cache": not options["no_cache"],
+            "results": results,
+        }
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(f"Wrote {options['output']}")
+        if options["compare"]:
+            self._compare(report, options["compare"], options["threshold"])
+
+    def _client(self, token):
+        # 127.0.0.1 is in ALLOWED_HOSTS, testserver isn't outside tests
+        return Client(SERVER_NAME="127.0.0.1", HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def _resolve(self, path, user):
+        """Fill in a detail route with an object the role can see"""
+        if "{self}" in path:
+            return path.format(self=user.pk)
+        if "{pk}" not in path:
+            return path
+        model = path.split("/")[2]
+        pk = detail_targets(user)[model].values_list("pk", flat=True).first()
+        return None if pk is None else path.format(pk=pk)
+
+    def _measure(self, path, token, options):
+        local = threading.local()
+        statuses = {}
+        lock = threading.Lock()
+
+        def get(_):
+            client = getattr(local, "client", None)
+            if client is None:
+                client = local.client = self._client(token)
+            started = time.perf_counter()
+            response = client.get(path)
+            elapsed = time.perf_counter() - started
+            with lock:
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            return elapsed
+
+        for _ in range(options["warmup"]):
+            get(None)
+        statuses.clear()
+
+        started = time.perf_counter()
+        if self.pool is not None:
+            samples = list(self.pool.map(get, range(options["requests"])))
+        else:
+            samples = [get(None) for _ in range(options["requests"])]
+        row = summarize(samples, time.perf_counter() - started)
+        row["statuses"] = {str(code): count for code, count in sorted(statuses.items())}
+        return row
+
+    def _close_pool(self, size):
+        """Close the database connection each worker thread opened"""
+        barrier = threading.Barrier(size)
+
+        def close(_):
+            # Holds every thread until all of them have a task
+            barrier.wait()
+            connections.close_all()
+
+        list(self.pool.map(close, range(size)))
+        self.pool.shutdown()
+
+    def _print_row(self, name, role, row):
+        if not hasattr(self, "_header"):
+            self._header = True
+            self.stdout.write(
+                f"{'route':<20} {'role':<6} {'status':>8} {'p50 ms':>8} {'p95 ms':>8} "
+                f"{'p99 ms':>8} {'req/s':>8}"
+            )
+        codes = ",".join(row["statuses"])
+        self.stdout.write(
+            f"{name:<20} {role:<6} {codes:>8} {row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} "
+            f"{row['p99_ms']:>8.2f} {row['per_second']:>8.1f}"
+        )
+
+    def _compare(self, report, path, threshold):
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+        before = {(row["route"], row["role"]): row for row in baseline["results"]}
+
+        for setting in ("database", "dataset", "concurrency", "response_cache"):
+            if baseline.get(setting) != report[setting]:
+                self.stderr.write(f"{setting} differs from {path}: {baseline.get(setting)} vs {report[setting]}")
+        self.stdout.write(f"p95 against {baseline.get('commit') or path}:")
+        regressions = []
+        for row in report["results"]:
+            old = before.get((row["route"], row["role"]))
+            if old is None or not old["p95_ms"]:
+                continue
+            change = (row["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100
+            flag = ""
+            if change > threshold:
+                flag = "  slower"
+                regressions.append(f"{row['route']} ({row['role']})")
+            self.stdout.write(
+                f"{row['route']:<20} {row['role']:<6} {old['p95_ms']:>8.2f} -> "
+                f"{row['p95_ms']:>8.2f} ms {change:>+7.1f}%{flag}"
+            )
+        if regressions:
+            raise CommandError(f"p95 regressed more than {threshold:g}%: {', '.join(regressions)}")
@@ -0,0 +1,108 @@
+"""
+Login throughput of PhoneOrIDBackend against the lookup it replaced,
+which queried by id and then by phone number.
+
+    python manage.py benchmark_login --users 1000 --logins 200 \
+        --iterations 100000 600000 1000000
+
+For each PBKDF2 iteration count, users are seeded with a password hashed
+at that cost and logged in by phone number, by id, with a wrong password
+and with identifiers that match nobody. Wrong passwords run into the
+per-identifier lockout after AUTH_LOGIN_MAX_FAILURES attempts. Seeded
+data is rolled back once the run finishes.
+"""
+
+import random
+
+from django.contrib.auth import authenticate, get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from core import auth_backends
+from core.benchmarks import rolled_back, time_calls
+from core.querycount import QueryRecorder
+
+
+CustomUser = get_user_model()
+
+PREFIX = "bench-login"
+PASSWORD = "correct horse battery staple"
+
+
+def legacy_authenticate(username, password):
+    """The id-then-phone lookup PhoneOrIDBackend used to run"""
+    try:
+        user = CustomUser.objects.get(id=username)
+    except CustomUser.DoesNotExist:
+        try:
+            user = CustomUser.objects.get(phone_number=username)
+        except CustomUser.DoesNotExist:
+            return None
+    return user if user.check_password(password) else None
+
+
+def backend_authenticate(username, password):
+    return authenticate(None, username=username, password=password)
+
+
+class Command(BaseCommand):
+    help = "Benchmark logins through PhoneOrIDBackend"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--logins", type=int, default=200, help="Logins per scenario")
+        parser.add_argument(
+            "--iterations", nargs="+", type=int,
+            help="PBKDF2 iteration counts to compare, PASSWORD_PBKDF2_ITERATIONS by default",
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        self.stdout.write(
+            f"{'iterations':>10} {'scenario':<16} {'lookup':<8} {'queries':>8} "
+            f"{'p50 ms':>8} {'p95 ms':>8} {'logins/s':>9}"
+        )
+        for iterations in options["iterations"] or [None]:
+            with override_settings(PASSWORD_PBKDF2_ITERATIONS=iterations), rolled_back():
+                self._run(iterations, options["users"], options["logins"], rng)
+
+    def _run(self, iterations, count, logins, rng):
+        encoded = make_password(PASSWORD)
+        CustomUser.objects.bulk_create([
+            CustomUser(
+                id=f"{PREFIX}-{index}",
+                name=f"Login User {index}",
+                phone_number=f"+25479{index:07d}",
+                email=f"{PREFIX}-{index}@example.com",
+                id_photo="users/photos/bench.jpg",
+                password=encoded,
+            )
+            for index in range(count)
+        ])
+        picks = [rng.randrange(count) for _ in range(logins)]
+        scenarios = [
+            ("phone", [(f"+25479{index:07d}", PASSWORD) for index in picks]),
+            ("id", [(f"{PREFIX}-{index}", PASSWORD) for index in picks]),
+            ("wrong password", [(f"+25479{index % 10:07d}", "wrong") for index in picks]),
+            # Ten identifiers tried over and over, as credential stuffing does
+            ("unknown", [(f"+25478{index % 10:07d}", PASSWORD) for index in picks]),
+        ]
+        label = iterations or "default"
+        for name, calls in scenarios:
+            for lookup, func in (("legacy", legacy_authenticate), ("backend", backend_authenticate)):
+                self._forget(calls)
+                with QueryRecorder() as recorder:
+                    row = time_calls(func, calls)
+                self.stdout.write(
+                    f"{label:>10} {name:<16} {lookup:<8} {recorder.count / len(calls):>8.2f} "
+                    f"{row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} {row['per_second']:>9.1f}"
+                )
+            self._forget(calls)
+
+    def _forget(self, calls):
+        """Drop the failure counts and unknown identifiers of an earlier scenario"""
+        identifiers = {username for username, _ in calls}
+        auth_backends.forget_unknown(*identifiers)
+        for identifier in identifiers:
+            auth_backends.clear_failures(identifier)
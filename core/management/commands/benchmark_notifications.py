@@ -0,0 +1,136 @@
+"""
+Compares sending confirmation emails one ``send_mail`` at a time, each on
+its own connection, with the batched outbox delivery in
+core/notifications.py that reuses one connection.
+
+    python manage.py benchmark_notifications --messages 500 --connect-ms 150
+
+By default both run against a local SMTP sink started by the command.
+``--connect-ms`` delays its greeting to stand in for the TCP and TLS
+handshake of a remote server. ``--use-settings`` sends through the
+configured EMAIL_BACKEND instead. Outbox rows are rolled back afterwards.
+"""
+
+import socketserver
+import threading
+import time
+
+from django.core.mail import get_connection, send_mail
+from django.core.management.base import BaseCommand
+
+from core.benchmarks import rolled_back, summarize
+from core.notifications import deliver_pending, queue_emails
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP to accept and discard messages"""
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        time.sleep(self.server.connect_delay)
+        self.reply("220 sink ready")
+        in_data = False
+        for raw in self.rfile:
+            line = raw.decode(errors="replace").rstrip("\r\n")
+            if in_data:
+                if line == ".":
+                    in_data = False
+                    self.reply("250 queued")
+                continue
+            command = line[:4].upper()
+            if command == "EHLO":
+                self.reply("250 sink")
+            elif command == "DATA":
+                in_data = True
+                self.reply("354 go ahead")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, connect_delay):
+        super().__init__(("127.0.0.1", 0), SMTPSinkHandler)
+        self.connect_delay = connect_delay
+
+
+class Command(BaseCommand):
+    help = "Benchmark batched outbox email delivery against send_mail per message"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=200)
+        parser.add_argument(
+            "--connect-ms", type=float, default=100,
+            help="Simulated connection setup time of the SMTP sink",
+        )
+        parser.add_argument(
+            "--use-settings", action="store_true",
+            help="Send through the configured EMAIL_BACKEND instead of the sink",
+        )
+
+    def handle(self, *args, **options):
+        count = options["messages"]
+        emails = [
+            (
+                f"guest{index}@example.com",
+                f"Payment Confirmation for Booking: {index}",
+                f"Payment of KES {1000 + index} received. Receipt: BENCH{index:06d}",
+            )
+            for index in range(count)
+        ]
+
+        sink = None
+        if options["use_settings"]:
+            def connection():
+                return get_connection(fail_silently=False)
+        else:
+            sink = SMTPSink(options["connect_ms"] / 1000)
+            threading.Thread(target=sink.serve_forever, daemon=True).start()
+
+            def connection():
+                return get_connection(
+                    "django.core.mail.backends.smtp.EmailBackend",
+                    host="127.0.0.1",
+                    port=sink.server_address[1],
+                    use_tls=False,
+                    use_ssl=False,
+                    username="",
+                    password="",
+                    fail_silently=False,
+                )
+
+        try:
+            samples = []
+            started = time.perf_counter()
+            for recipient, subject, body in emails:
+                call_started = time.perf_counter()
+                send_mail(subject, body, None, [recipient], connection=connection())
+                samples.append(time.perf_counter() - call_started)
+            per_message = summarize(samples, time.perf_counter() - started)
+
+            with rolled_back():
+                queue_emails(emails)
+                started = time.perf_counter()
+                sent, failed = deliver_pending(connection=connection())
+                elapsed = time.perf_counter() - started
+        finally:
+            if sink is not None:
+                sink.shutdown()
+                sink.server_close()
+
+        self.stdout.write(f"{count} messages")
+        self.stdout.write(f"{'':>12} {'total s':>9} {'msg/s':>9}")
+        self.stdout.write(
+            f"{'send_mail':>12} {sum(samples):>9.2f} {per_message['per_second']:>9.1f}"
+        )
+        self.stdout.write(
+            f"{'outbox':>12} {elapsed:>9.2f} {sent / elapsed if elapsed else 0:>9.1f}"
+            + (f"  ({failed} failed)" if failed else "")
+        )
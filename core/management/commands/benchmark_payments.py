@@ -0,0 +1,243 @@
+"""
+End-to-end payment load test against the Daraja simulator.
+
+    python manage.py benchmark_payments --payments 500 --concurrency 16 \
+        --callback-delay 0.5 --failure-rate 0.1 --duplicate-rate 0.2
+
+Serves the app on a local port and posts payments to /api/payments/ from
+``--concurrency`` clients. The simulator receives the STK pushes and posts
+its callbacks back to the app. Reports API latency, the time from a
+payment being created to it settling, and settled payments per second.
+
+Celery tasks run eagerly in this process, with results neither stored
+nor sent to a result backend, so the API latency includes the STK push a
+worker would normally send. The run fails if any payment isn't accepted
+with 202 or any callback isn't acknowledged with 200, rather than report
+numbers for requests that errored. Seeded rows are deleted afterwards.
+"""
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import requests
+from celery import current_app
+from django.contrib.auth import get_user_model
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.db import connections
+from django.test import override_settings
+
+from core.authentication import access_token_for
+from core.benchmarks import summarize
+from core.models import Booking, EmailNotification, MpesaCallback, Payment, Property
+from core.simulator import DarajaSimulator
+
+
+CustomUser = get_user_model()
+
+PREFIX = "bench-pay"
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = "Load test the payment flow end to end against the Daraja simulator"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--payments", type=int, default=200)
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument("--latency-ms", type=float, default=50, help="Simulated Daraja API latency")
+        parser.add_argument("--callback-delay", type=float, default=0.5)
+        parser.add_argument("--failure-rate", type=float, default=0.1)
+        parser.add_argument("--duplicate-rate", type=float, default=0.1)
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        count = options["payments"]
+        server = ThreadedWSGIServer(("127.0.0.1", 0), QuietRequestHandler)
+        server.set_app(WSGIHandler())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        app_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        simulator = DarajaSimulator(
+            latency=options["latency_ms"] / 1000,
+            callback_delay=options["callback_delay"],
+            failure_rate=options["failure_rate"],
+            duplicate_rate=options["duplicate_rate"],
+            seed=42,
+        )
+        overrides = {
+            **simulator.settings(),
+            "MPESA_CALLBACK_URL": f"{app_url}/api/payments/mpesa/callback/",
+            "MPESA_CALLBACK_DRAIN_DELAY": 0,
+            "EMAIL_BACKEND": "django.core.mail.backends.dummy.EmailBackend",
+            "EVENTS_REDIS_URL": None,
+        }
+        # Eager tasks still load the result backend; the configured one may
+        # not be installed, and a benchmark has no use for the results. The
+        # app reads its settings with the CELERY_ namespace, see config/celery.py
+        celery_overrides = {
+            "CELERY_TASK_ALWAYS_EAGER": True,
+            "CELERY_TASK_STORE_EAGER_RESULT": False,
+            "CELERY_TASK_IGNORE_RESULT": True,
+            "CELERY_RESULT_BACKEND": "disabled",
+        }
+        celery_saved = {name: current_app.conf.get(name) for name in celery_overrides}
+        current_app.conf.update(celery_overrides)
+
+        try:
+            with simulator, override_settings(**overrides):
+                # Rows left behind by an interrupted run
+                self._cleanup()
+                requests_ = self._seed(count)
+                started = time.perf_counter()
+                api_samples, errors = self._post_payments(app_url, requests_, options["concurrency"])
+                simulator.wait_for_callbacks(timeout=max(60, count))
+                elapsed = time.perf_counter() - started
+                results = self._results(count, api_samples, elapsed, simulator.stats())
+        finally:
+            current_app.conf.update(celery_saved)
+            server.shutdown()
+            server.server_close()
+            self._cleanup()
+
+        if errors:
+            raise CommandError(
+                f"{len(errors)} of {count} payments were not accepted, first: {errors[0]}"
+            )
+        if results["callback_errors"]:
+            raise CommandError(
+                f"{results['callback_errors']} Mpesa callbacks were not acknowledged with 200"
+            )
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(f"{count} payments, {options['concurrency']} concurrent clients")
+        self.stdout.write(f"{'':>16} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for name in ("api", "settle", "callback"):
+            row = results[name]
+            self.stdout.write(
+                f"{name:>16} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+                f"{row['p99_ms']:>9.1f} {row['max_ms']:>9.1f}"
+            )
+        self.stdout.write(
+            f"settled {results['settled']}/{count} "
+            f"({results['successful']} successful, {results['failed']} failed) "
+            f"at {results['settled_per_second']:.1f}/s; "
+            f"{results['callbacks_sent']} callbacks for {results['callbacks_stored']} inbox rows, "
+            f"{results['emails_queued']} emails queued"
+        )
+
+    def _seed(self, count):
+        host = CustomUser.objects.create(
+            id=f"{PREFIX}-host",
+            name="Benchmark Host",
+            phone_number="0700000000",
+            id_photo="users/photos/bench.jpg",
+            role=CustomUser.Roles.HOST,
+        )
+        guests = CustomUser.objects.bulk_create([
+            CustomUser(
+                id=f"{PREFIX}-guest-{index}",
+                name=f"Benchmark Guest {index}",
+                phone_number=f"07{index:08d}",
+                email=f"{PREFIX}-{index}@example.com",
+                id_photo="users/photos/bench.jpg",
+                role=CustomUser.Roles.GUEST,
+            )
+            for index in range(1, count + 1)
+        ])
+        prop = Property.objects.create(
+            owner=host, name="Benchmark", description="", location="", amenities="",
+            price_per_night=100,
+        )
+        start = date.today() + timedelta(days=1)
+        bookings = Booking.objects.bulk_create([
+            Booking(
+                property=prop,
+                check_in=start + timedelta(days=index * 2),
+                check_out=start + timedelta(days=index * 2 + 1),
+                price_per_night=100,
+                total_price=100,
+                balance_due=100,
+            )
+            for index in range(count)
+        ])
+        Booking.guests.through.objects.bulk_create([
+            Booking.guests.through(booking_id=booking.pk, customuser_id=guest.pk)
+            for booking, guest in zip(bookings, guests)
+        ])
+        return [
+            (
+                str(access_token_for(guest)),
+                {"payer": guest.pk, "booking": str(booking.pk), "amount": "100.00", "payment_method": "mpesa"},
+            )
+            for booking, guest in zip(bookings, guests)
+        ]
+
+    def _post_payments(self, app_url, requests_, concurrency):
+        """Latency of each POST, and the responses that weren't a 202"""
+        local = threading.local()
+        errors = []
+
+        def post(token, body):
+            client = getattr(local, "session", None)
+            if client is None:
+                client = local.session = requests.Session()
+            started = time.perf_counter()
+            response = client.post(
+                f"{app_url}/api/payments/",
+                json=body,
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=60,
+            )
+            if response.status_code != 202:
+                errors.append(f"POST /api/payments/ -> {response.status_code}: {response.text[:200]}")
+            return time.perf_counter() - started
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            samples = list(pool.map(lambda args: post(*args), requests_))
+        return samples, errors
+
+    def _results(self, count, api_samples, elapsed, simulator_stats):
+        payments = Payment.objects.filter(payer__id__startswith=PREFIX)
+        settled = payments.exclude(status=Payment.Status.PROCESSING)
+        settle_samples = [
+            (updated_at - payment_date).total_seconds()
+            for payment_date, updated_at in settled.values_list("payment_date", "updated_at")
+        ]
+        checkout_ids = payments.values_list("checkout_request_id", flat=True)
+        return {
+            "payments": count,
+            "api": summarize(api_samples),
+            "settle": summarize(settle_samples),
+            "callback": simulator_stats["callback_latency"],
+            "settled": len(settle_samples),
+            "successful": payments.filter(status=Payment.Status.SUCCESSFUL).count(),
+            "failed": payments.filter(status=Payment.Status.FAILED).count(),
+            "settled_per_second": len(settle_samples) / elapsed if elapsed else 0.0,
+            "elapsed_s": elapsed,
+            "callbacks_sent": simulator_stats["callback_latency"]["calls"],
+            "callback_errors": simulator_stats["callback_errors"],
+            "callbacks_stored": MpesaCallback.objects.filter(checkout_request_id__in=checkout_ids).count(),
+            "emails_queued": EmailNotification.objects.filter(recipient__startswith=PREFIX).count(),
+            "daraja_calls": simulator_stats["calls"],
+        }
+
+    def _cleanup(self):
+        checkout_ids = list(
+            Payment.objects.filter(payer__id__startswith=PREFIX).values_list("checkout_request_id", flat=True)
+        )
+        MpesaCallback.objects.filter(checkout_request_id__in=checkout_ids).delete()
+        EmailNotification.objects.filter(recipient__startswith=PREFIX).delete()
+        CustomUser.objects.filter(id__startswith=PREFIX).delete()
+        connections.close_all()
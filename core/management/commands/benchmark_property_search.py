@@ -0,0 +1,116 @@
+"""
+Compares the ranked tsvector property search with the ILIKE search that
+SearchFilter runs over name, description, location and amenities.
+
+    python manage.py benchmark_property_search --listings 100000
+
+Needs PostgreSQL. Seeded listings are rolled back once the run finishes.
+"""
+
+import random
+
+from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import F, Q
+
+from core.benchmarks import rolled_back, time_calls
+from core.models import Property
+
+
+CustomUser = get_user_model()
+
+TOWNS = [
+    "Nairobi", "Mombasa", "Kisumu", "Nakuru", "Eldoret", "Malindi", "Naivasha",
+    "Nanyuki", "Diani", "Lamu", "Kilifi", "Thika", "Machakos", "Nyeri", "Kericho",
+]
+KINDS = ["apartment", "cottage", "villa", "studio", "bungalow", "cabin", "loft", "townhouse"]
+AMENITIES = [
+    "wifi", "pool", "parking", "kitchen", "garden", "gym", "balcony", "fireplace",
+    "workspace", "washer", "beachfront", "breakfast", "security", "generator",
+]
+WORDS = [
+    "quiet", "spacious", "modern", "cozy", "bright", "family", "friendly",
+    "central", "secluded", "luxury", "budget", "view", "ocean", "lake", "forest",
+    "city", "walk", "market", "airport", "restaurants", "safari", "hiking",
+]
+
+
+class Command(BaseCommand):
+    help = "Benchmark tsvector property search against ILIKE"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--listings", type=int, default=100000)
+        parser.add_argument("--queries", type=int, default=50)
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("The tsvector search needs PostgreSQL.")
+
+        rng = random.Random(42)
+        with rolled_back():
+            self._seed(options["listings"], rng)
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE core_property")
+
+            terms = [
+                " ".join(rng.sample(TOWNS + KINDS + AMENITIES + WORDS, rng.randint(1, 2)))
+                for _ in range(options["queries"])
+            ]
+            ilike = time_calls(self._ilike_page, [(term,) for term in terms])
+            fts = time_calls(self._fts_page, [(term,) for term in terms])
+
+        self.stdout.write(f"{options['listings']} listings, {len(terms)} queries (page + count)")
+        self.stdout.write(f"{'':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'q/s':>8}")
+        for name, row in (("ilike", ilike), ("tsvector", fts)):
+            self.stdout.write(
+                f"{name:>8} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} "
+                f"{row['p99_ms']:>9.2f} {row['per_second']:>8.1f}"
+            )
+
+    def _seed(self, count, rng):
+        owner = CustomUser.objects.create(
+            id="bench-owner",
+            name="Benchmark Owner",
+            phone_number="+0000000000",
+            id_photo="users/photos/bench.jpg",
+            role=CustomUser.Roles.HOST,
+        )
+        batch = []
+        for index in range(count):
+            town = rng.choice(TOWNS)
+            kind = rng.choice(KINDS)
+            batch.append(Property(
+                owner=owner,
+                name=f"{rng.choice(WORDS).title()} {kind} in {town}",
+                description=" ".join(rng.choices(WORDS, k=30)),
+                location=f"{town}, Kenya",
+                amenities=", ".join(rng.sample(AMENITIES, 5)),
+                price_per_night=rng.randint(20, 500),
+            ))
+            if len(batch) == 5000:
+                Property.objects.bulk_create(batch)
+                batch = []
+        Property.objects.bulk_create(batch)
+
+    def _ilike_page(self, terms):
+        condition = Q()
+        for term in terms.split():
+            term_condition = Q()
+            for field in ("name", "description", "location", "amenities"):
+                term_condition |= Q(**{f"{field}__icontains": term})
+            condition &= term_condition
+        queryset = Property.objects.filter(condition)
+        list(queryset[:20])
+        queryset.count()
+
+    def _fts_page(self, terms):
+        query = SearchQuery(terms, search_type="websearch", config="english")
+        queryset = Property.objects.filter(search_vector=query)
+        list(
+            queryset
+            .annotate(rank=SearchRank(F("search_vector"), query))
+            .order_by("-rank")[:20]
+        )
+        queryset.count()
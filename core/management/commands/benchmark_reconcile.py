@@ -0,0 +1,135 @@
+"""
+Measures how many stale payments reconcile_stale_payments settles per
+minute against the local Daraja simulator, at several concurrency limits.
+
+    python manage.py benchmark_reconcile --payments 2000 --latency-ms 150 --concurrency 1 8 32
+
+Each run seeds fresh PROCESSING payments and rolls them back afterwards.
+"""
+
+import random
+from datetime import date, timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.utils import timezone
+
+from core import service
+from core.benchmarks import rolled_back
+from core.models import Booking, Payment, Property
+from core.reconciliation import reconcile_stale_payments
+from core.simulator import DarajaSimulator
+
+
+CustomUser = get_user_model()
+
+# ResultCodes Daraja reports for finished pushes, and how often
+OUTCOMES = [("0", 70), ("1032", 15), ("1037", 10), ("2001", 5)]
+
+
+class Command(BaseCommand):
+    help = "Benchmark stale payment reconciliation against the Daraja simulator"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--payments", type=int, default=1000)
+        parser.add_argument(
+            "--latency-ms", type=float, default=100,
+            help="Simulated Daraja response time per status query",
+        )
+        parser.add_argument(
+            "--concurrency", nargs="+", type=int, default=[1, 4, 16],
+            help="Concurrent status queries to benchmark",
+        )
+        parser.add_argument(
+            "--pending-rate", type=float, default=0.1,
+            help="Share of payments Daraja still reports as in progress",
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        self.stdout.write(
+            f"{options['payments']} stale payments, "
+            f"{options['latency_ms']:.0f} ms per Daraja query"
+        )
+        self.stdout.write(
+            f"{'workers':>8} {'seconds':>9} {'per min':>10} "
+            f"{'success':>8} {'failed':>7} {'pending':>8}"
+        )
+
+        with DarajaSimulator(latency=options["latency_ms"] / 1000) as daraja:
+            for workers in options["concurrency"]:
+                overrides = {**daraja.settings(), "MPESA_HTTP_POOL_SIZE": workers}
+                with override_settings(**overrides):
+                    # The pool is sized when the session is created
+                    service.reset_session()
+                    with rolled_back():
+                        checkout_ids = self._seed(options["payments"])
+                        daraja.results = self._outcomes(checkout_ids, options["pending_rate"], rng)
+                        metrics = reconcile_stale_payments(max_age=0, workers=workers)
+                service.reset_session()
+
+                self.stdout.write(
+                    f"{workers:>8} {metrics['elapsed_s']:>9.2f} {metrics['per_minute']:>10.0f} "
+                    f"{metrics['successful']:>8} {metrics['failed']:>7} {metrics['pending']:>8}"
+                )
+
+    def _outcomes(self, checkout_ids, pending_rate, rng):
+        codes = [code for code, _ in OUTCOMES]
+        weights = [weight for _, weight in OUTCOMES]
+        return {
+            checkout_id: rng.choices(codes, weights)[0]
+            for checkout_id in checkout_ids
+            if rng.random() >= pending_rate
+        }
+
+    def _seed(self, count):
+        host = CustomUser.objects.create(
+            id="bench-host",
+            name="Benchmark Host",
+            phone_number="+0000000000",
+            id_photo="users/photos/bench.jpg",
+            role=CustomUser.Roles.HOST,
+        )
+        guest = CustomUser.objects.create(
+            id="bench-guest",
+            name="Benchmark Guest",
+            phone_number="+0000000001",
+            id_photo="users/photos/bench.jpg",
+            role=CustomUser.Roles.GUEST,
+        )
+        prop = Property.objects.create(
+            owner=host,
+            name="Benchmark",
+            description="",
+            location="",
+            amenities="",
+            price_per_night=100,
+        )
+        booking = Booking.objects.create(
+            property=prop,
+            check_in=date.today() + timedelta(days=1),
+            check_out=date.today() + timedelta(days=2),
+            price_per_night=100,
+            total_price=100 * count,
+            balance_due=100 * count,
+        )
+        checkout_ids = [f"ws_CO_bench_{index:07d}" for index in range(count)]
+        Payment.objects.bulk_create(
+            [
+                Payment(
+                    payer=guest,
+                    booking=booking,
+                    amount=100,
+                    payment_method="mpesa",
+                    checkout_request_id=checkout_id,
+                )
+                for checkout_id in checkout_ids
+            ],
+            batch_size=5000,
+        )
+        # Make them look like pushes that never got a callback
+        Payment.objects.filter(booking=booking).update(
+            payment_date=timezone.now() - timedelta(minutes=10),
+        )
+        return checkout_ids
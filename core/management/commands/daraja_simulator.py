@@ -0,0 +1,49 @@
+"""
+Runs the fake Daraja server from core/simulator.py in the foreground.
+
+    python manage.py daraja_simulator --port 8900 --callback-delay 2 --failure-rate 0.1
+
+Point the app at it with MPESA_API_BASE_URL=http://127.0.0.1:8900/ and any
+non-empty MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET, MPESA_PASSKEY and
+MPESA_EXPRESS_SHORTCODE. Stop it with Ctrl+C to print its statistics.
+"""
+
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.simulator import DarajaSimulator
+
+
+class Command(BaseCommand):
+    help = "Run a local Daraja simulator for load testing"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8900)
+        parser.add_argument("--latency-ms", type=float, default=0, help="Added to every API call")
+        parser.add_argument("--callback-delay", type=float, default=1.0, help="Seconds from push to callback")
+        parser.add_argument("--failure-rate", type=float, default=0.0)
+        parser.add_argument("--duplicate-rate", type=float, default=0.0)
+        parser.add_argument("--callback-workers", type=int, default=16)
+
+    def handle(self, *args, **options):
+        simulator = DarajaSimulator(
+            host=options["host"],
+            port=options["port"],
+            latency=options["latency_ms"] / 1000,
+            callback_delay=options["callback_delay"],
+            failure_rate=options["failure_rate"],
+            duplicate_rate=options["duplicate_rate"],
+            callback_workers=options["callback_workers"],
+        )
+        with simulator:
+            self.stdout.write(f"Daraja simulator listening on {simulator.url}")
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                pass
+            stats = simulator.stats()
+        self.stdout.write(json.dumps(stats, indent=2))
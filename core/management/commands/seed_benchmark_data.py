@@ -0,0 +1,254 @@
+"""
+Seeds a large dataset for benchmark_endpoints.
+
+    python manage.py seed_benchmark_data --users 100000 --properties 50000 \
+        --bookings 1000000 --payments 1000000
+    python manage.py seed_benchmark_data --flush
+
+Rows are written with bulk inserts and kept, so the same dataset can be
+benchmarked at several commits. Seeded user ids start with SEED_PREFIX
+from core/benchmarks.py: the first user is an admin, every tenth a host
+and the rest are guests. Properties are spread over the hosts, bookings
+over the properties without overlapping, and payments over the bookings,
+made by one of their guests. ``--flush`` deletes everything seeded.
+
+bulk_create skips model signals, so the availability index and cached
+responses only see the new rows once their cache entries expire; clear
+the cache after seeding when that matters.
+"""
+
+import random
+import time
+from datetime import date, timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from core.benchmarks import SEED_PREFIX
+from core.models import Booking, Payment, Property
+
+
+CustomUser = get_user_model()
+
+TOWNS = [
+    ("Nairobi", -1.29, 36.82), ("Mombasa", -4.04, 39.67), ("Kisumu", -0.09, 34.77),
+    ("Nakuru", -0.30, 36.07), ("Eldoret", 0.51, 35.27), ("Malindi", -3.22, 40.12),
+    ("Naivasha", -0.72, 36.43), ("Nanyuki", 0.02, 37.07), ("Diani", -4.32, 39.58),
+    ("Lamu", -2.27, 40.90),
+]
+KINDS = ["apartment", "cottage", "villa", "studio", "bungalow", "cabin", "loft"]
+AMENITIES = ["wifi", "pool", "parking", "kitchen", "garden", "gym", "balcony", "workspace"]
+WORDS = ["quiet", "spacious", "modern", "cozy", "bright", "family", "central", "view", "ocean"]
+
+BOOKING_STATUSES = [
+    (Booking.BookingStatus.CONFIRMED, 60),
+    (Booking.BookingStatus.PENDING, 20),
+    (Booking.BookingStatus.PROCESSING, 10),
+    (Booking.BookingStatus.CANCELED, 10),
+]
+PAYMENT_STATUSES = [
+    (Payment.Status.SUCCESSFUL, 80),
+    (Payment.Status.FAILED, 15),
+    (Payment.Status.PROCESSING, 5),
+]
+
+# Days between the check-ins of consecutive bookings of a property; stays
+# are shorter, so bookings of a property never overlap
+SLOT_DAYS = 5
+
+
+def user_id(index):
+    return f"{SEED_PREFIX}{index:07d}"
+
+
+def user_role(index):
+    if index == 0:
+        return CustomUser.Roles.ADMIN
+    if index % 10 == 1:
+        return CustomUser.Roles.HOST
+    return CustomUser.Roles.GUEST
+
+
+class Command(BaseCommand):
+    help = "Seed a large dataset for the endpoint benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100000)
+        parser.add_argument("--properties", type=int, default=50000)
+        parser.add_argument("--bookings", type=int, default=1000000)
+        parser.add_argument("--payments", type=int, default=1000000)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--flush", action="store_true", help="Delete the seeded rows instead")
+
+    def handle(self, *args, **options):
+        if options["flush"]:
+            self._flush()
+            return
+
+        if CustomUser.objects.filter(id__startswith=SEED_PREFIX).exists():
+            self.stdout.write("Seeded rows already exist, run with --flush first to reseed.")
+            return
+
+        rng = random.Random(42)
+        self.batch_size = options["batch_size"]
+        users = options["users"]
+        hosts = [index for index in range(users) if user_role(index) == CustomUser.Roles.HOST]
+        guests = [index for index in range(users) if user_role(index) == CustomUser.Roles.GUEST]
+        if not hosts or not guests:
+            self.stderr.write("Need at least 12 users to seed hosts and guests.")
+            return
+
+        self._step("users", users, self._users(users))
+        property_ids = []
+        self._step("properties", options["properties"], self._properties(options["properties"], hosts, property_ids, rng))
+        bookings = []
+        self._step("bookings", options["bookings"], self._bookings(options["bookings"], property_ids, guests, bookings, rng))
+        self._step("payments", options["payments"], self._payments(options["payments"], bookings, rng))
+
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                for model in (CustomUser, Property, Booking, Booking.guests.through, Payment):
+                    cursor.execute(f"ANALYZE {model._meta.db_table}")
+
+    def _step(self, name, count, batches):
+        """Insert each batch in its own transaction, reporting progress"""
+        started = time.perf_counter()
+        written = 0
+        for insert in batches:
+            with transaction.atomic():
+                written += insert()
+            self.stdout.write(f"\r{name}: {written}/{count}", ending="")
+            self.stdout.flush()
+        self.stdout.write(f"\r{name}: {written} in {time.perf_counter() - started:.1f}s")
+
+    def _chunks(self, count):
+        for start in range(0, count, self.batch_size):
+            yield range(start, min(start + self.batch_size, count))
+
+    def _users(self, count):
+        for chunk in self._chunks(count):
+            rows = [
+                CustomUser(
+                    id=user_id(index),
+                    name=f"Seed User {index}",
+                    phone_number=f"+2547{index:08d}",
+                    email=f"{user_id(index)}@example.com",
+                    id_photo="users/photos/seed.jpg",
+                    # Unusable; benchmarks authenticate with tokens
+                    password="!",
+                    role=user_role(index),
+                    is_staff=index == 0,
+                )
+                for index in chunk
+            ]
+            yield lambda rows=rows: len(CustomUser.objects.bulk_create(rows))
+
+    def _properties(self, count, hosts, property_ids, rng):
+        for chunk in self._chunks(count):
+            rows = []
+            for index in chunk:
+                town, latitude, longitude = rng.choice(TOWNS)
+                latitude = round(latitude + rng.uniform(-0.2, 0.2), 6)
+                longitude = round(longitude + rng.uniform(-0.2, 0.2), 6)
+                kind = rng.choice(KINDS)
+                rows.append(Property(
+                    owner_id=user_id(hosts[index % len(hosts)]),
+                    name=f"{rng.choice(WORDS).title()} {kind} in {town}",
+                    description=" ".join(rng.choices(WORDS, k=20)),
+                    location=f"{town}, Kenya",
+                    amenities=", ".join(rng.sample(AMENITIES, 4)),
+                    price_per_night=rng.randint(20, 500),
+                    latitude=latitude,
+                    longitude=longitude,
+                ))
+            property_ids.extend((row.pk, row.price_per_night) for row in rows)
+            yield lambda rows=rows: len(Property.objects.bulk_create(rows))
+
+    def _bookings(self, count, property_ids, guests, bookings, rng):
+        statuses = [status for status, _ in BOOKING_STATUSES]
+        weights = [weight for _, weight in BOOKING_STATUSES]
+        # The oldest stays are about two years ago, the newest in the future
+        first_day = date.today() - timedelta(days=730)
+        Membership = Booking.guests.through
+
+        for chunk in self._chunks(count):
+            rows = []
+            members = []
+            for index in chunk:
+                property_id, price = property_ids[index % len(property_ids)]
+                check_in = first_day + timedelta(days=index // len(property_ids) * SLOT_DAYS)
+                nights = rng.randint(1, SLOT_DAYS - 1)
+                total = price * nights
+                booking_status = rng.choices(statuses, weights)[0]
+                booking = Booking(
+                    property_id=property_id,
+                    status=booking_status,
+                    check_in=check_in,
+                    check_out=check_in + timedelta(days=nights),
+                    price_per_night=price,
+                    total_price=total,
+                    balance_due=0 if booking_status == Booking.BookingStatus.CONFIRMED else total,
+                )
+                rows.append(booking)
+                guest = user_id(guests[index % len(guests)])
+                members.append(Membership(booking_id=booking.pk, customuser_id=guest))
+                if rng.random() < 0.2:
+                    other = user_id(rng.choice(guests))
+                    if other != guest:
+                        members.append(Membership(booking_id=booking.pk, customuser_id=other))
+                bookings.append((booking.pk, guest, total))
+
+            def insert(rows=rows, members=members):
+                Booking.objects.bulk_create(rows)
+                Membership.objects.bulk_create(members)
+                return len(rows)
+
+            yield insert
+
+    def _payments(self, count, bookings, rng):
+        statuses = [status for status, _ in PAYMENT_STATUSES]
+        weights = [weight for _, weight in PAYMENT_STATUSES]
+        for chunk in self._chunks(count):
+            rows = []
+            for index in chunk:
+                booking_id, payer_id, total = bookings[index % len(bookings)]
+                payment_status = rng.choices(statuses, weights)[0]
+                rows.append(Payment(
+                    booking_id=booking_id,
+                    payer_id=payer_id,
+                    amount=total,
+                    status=payment_status,
+                    payment_method="mpesa",
+                    checkout_request_id=f"ws_CO_seed_{index:08d}",
+                    mpesa_ref=f"SEED{index:08d}" if payment_status == Payment.Status.SUCCESSFUL else "",
+                ))
+            yield lambda rows=rows: len(Payment.objects.bulk_create(rows))
+
+    def _flush(self):
+        """
+        Delete the seeded rows with plain DELETEs; the ORM would load every
+        row to run delete signals and cascades.
+        """
+        users = CustomUser._meta.db_table
+        properties = Property._meta.db_table
+        bookings = Booking._meta.db_table
+        members = Booking.guests.through._meta.db_table
+        payments = Payment._meta.db_table
+        seeded_properties = f"SELECT id FROM {properties} WHERE owner_id LIKE %s"
+        seeded_bookings = f"SELECT id FROM {bookings} WHERE property_id IN ({seeded_properties})"
+        statements = [
+            f"DELETE FROM {payments} WHERE payer_id LIKE %s",
+            f"DELETE FROM {payments} WHERE booking_id IN ({seeded_bookings})",
+            f"DELETE FROM {members} WHERE customuser_id LIKE %s",
+            f"DELETE FROM {members} WHERE booking_id IN ({seeded_bookings})",
+            f"DELETE FROM {bookings} WHERE property_id IN ({seeded_properties})",
+            f"DELETE FROM {properties} WHERE owner_id LIKE %s",
+            f"DELETE FROM {users} WHERE id LIKE %s",
+        ]
+        pattern = SEED_PREFIX + "%"
+        started = time.perf_counter()
+        with transaction.atomic(), connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement, [pattern])
+        self.stdout.write(f"Deleted the seeded rows in {time.perf_counter() - started:.1f}s")
@@ -1,4 +1,70 @@
 from django.contrib.auth.models import BaseUserManager
+from django.db import models
+from django.db.models import Exists, OuterRef
+
+from .geo import cell_for
+
+
+def guest_membership(booking_model, booking, user):
+    """
+    EXISTS over the booking's guest table, answered from the unique
+    (booking_id, customuser_id) index however many guests the booking has
+    """
+    return Exists(
+        booking_model.guests.through.objects.filter(booking_id=booking, customuser_id=user.pk)
+    )
+
+
+class PropertyQuerySet(models.QuerySet):
+    """Fills in ``geo_cell`` where Property.save doesn't run"""
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.geo_cell = cell_for(obj.latitude, obj.longitude)
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        if {'latitude', 'longitude'} & set(fields):
+            objs = list(objs)
+            for obj in objs:
+                obj.geo_cell = cell_for(obj.latitude, obj.longitude)
+            fields = [*fields, 'geo_cell']
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+
+class BookingQuerySet(models.QuerySet):
+    def with_guest(self, user):
+        """Bookings ``user`` is a guest of, one row each"""
+        return self.filter(guest_membership(self.model, OuterRef('pk'), user))
+
+    def restore_balances(self, payments):
+        """
+        Give the bookings of failed ``payments`` back the balance those
+        payments took when they were created. The bookings are locked, and
+        each payment is pointed at its updated booking.
+        """
+        payments = list(payments)
+        amounts = {}
+        for payment in payments:
+            amounts[payment.booking_id] = amounts.get(payment.booking_id, 0) + payment.amount
+        if not amounts:
+            return
+        bookings = {
+            booking.pk: booking
+            for booking in self.select_for_update().filter(pk__in=amounts).order_by('pk')
+        }
+        for booking_id, amount in amounts.items():
+            bookings[booking_id].restore_balance_due(amount)
+        for payment in payments:
+            payment.booking = bookings[payment.booking_id]
+
+
+class PaymentQuerySet(models.QuerySet):
+    def for_guest(self, user):
+        """Payments for bookings ``user`` is a guest of, one row each"""
+        booking_model = self.model._meta.get_field('booking').related_model
+        return self.filter(guest_membership(booking_model, OuterRef('booking_id'), user))
 
 
 class CustomUserManager(BaseUserManager):
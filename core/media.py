@@ -0,0 +1,144 @@
+"""
+Serving files from MEDIA_ROOT once ProtectedMediaView has checked access.
+
+With MEDIA_ACCEL_REDIRECT set, the response only carries an
+``X-Accel-Redirect`` header to that internal nginx location (see
+docker/nginx/nginx.conf). nginx then sends the file itself, including
+Range and conditional requests, and the Django worker is free as soon as
+the permission check is done.
+
+Without it, as in local runs, the file goes out as a FileResponse, which
+servers with ``wsgi.file_wrapper`` send with sendfile(). Single byte
+ranges and If-None-Match/If-Modified-Since are handled here in that case.
+
+Both ways the response is ``Cache-Control: private`` for
+MEDIA_CACHE_MAX_AGE seconds, so browsers may keep an ID photo but shared
+caches may not.
+"""
+
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe
+
+
+CHUNK_SIZE = 64 * 1024
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def accel_redirect_prefix():
+    return getattr(settings, "MEDIA_ACCEL_REDIRECT", None)
+
+
+def cache_max_age():
+    return getattr(settings, "MEDIA_CACHE_MAX_AGE", 60 * 60)
+
+
+def _content_type(path):
+    content_type, encoding = mimetypes.guess_type(path)
+    return content_type or "application/octet-stream"
+
+
+def _cache_headers(response):
+    response["Cache-Control"] = f"private, max-age={cache_max_age()}"
+    return response
+
+
+def byte_range(header, size):
+    """
+    ``(start, end)`` of a single ``bytes=`` range, inclusive. None when the
+    whole file should be sent, for no range or one this doesn't serve
+    (several ranges); False when the range lies outside the file.
+    """
+    match = _RANGE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # The last N bytes
+        length = int(last)
+        if not length:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, end
+
+
+def _read(file, start, length):
+    with file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def serve(request, path):
+    """The response sending MEDIA_ROOT/``path``, or Http404"""
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404("No such file.")
+
+    prefix = accel_redirect_prefix()
+    if prefix:
+        response = HttpResponse(content_type=_content_type(path))
+        response["X-Accel-Redirect"] = prefix.rstrip("/") + "/" + quote(path)
+        return _cache_headers(response)
+
+    try:
+        stat = os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404("No such file.")
+    if not os.path.isfile(full_path):
+        raise Http404("No such file.")
+
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    last_modified = http_date(stat.st_mtime)
+    if_none_match = request.headers.get("If-None-Match")
+    if_modified_since = parse_http_date_safe(request.headers.get("If-Modified-Since") or "")
+    if (if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]) or (
+        not if_none_match and if_modified_since and int(stat.st_mtime) <= if_modified_since
+    ):
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+        return _cache_headers(response)
+
+    requested = byte_range(request.headers.get("Range"), stat.st_size)
+    # A range of an older version of the file isn't wanted
+    if_range = request.headers.get("If-Range")
+    if if_range and if_range not in (etag, last_modified):
+        requested = None
+
+    if requested is False:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{stat.st_size}"
+    elif requested is None:
+        response = FileResponse(open(full_path, "rb"), content_type=_content_type(path))
+    else:
+        start, end = requested
+        response = StreamingHttpResponse(
+            _read(open(full_path, "rb"), start, end - start + 1),
+            status=206,
+            content_type=_content_type(path),
+        )
+        response["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+        response["Content-Length"] = str(end - start + 1)
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    response["Last-Modified"] = last_modified
+    return _cache_headers(response)
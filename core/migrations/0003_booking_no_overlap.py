@@ -0,0 +1,21 @@
+# Generated by Django 5.2.10 on 2026-10-17 06:05
+
+import core.constraints
+from django.contrib.postgres.operations import BtreeGistExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_payment_checkout_request_id_payment_mpesa_ref_and_more'),
+    ]
+
+    operations = [
+        # GiST needs btree_gist for the uuid equality part of the constraint
+        BtreeGistExtension(),
+        migrations.AddConstraint(
+            model_name='booking',
+            constraint=core.constraints.PostgresExclusionConstraint(condition=models.Q(('status', 'canceled'), _negated=True), expressions=[('property', '='), (core.constraints.DateRange('check_in', 'check_out'), '&&')], name='booking_no_overlap', violation_error_message='Property is not available for the selected dates.'),
+        ),
+    ]
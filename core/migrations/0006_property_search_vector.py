@@ -0,0 +1,60 @@
+# Generated by Django 5.2.10 on 2026-10-17 06:08
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+# Keeps core_property.search_vector in sync on every insert/update. Name
+# ranks above location, then amenities, then description.
+CREATE_SEARCH_VECTOR_SQL = """
+CREATE OR REPLACE FUNCTION core_property_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(NEW.location, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(NEW.amenities, '')), 'C') ||
+        setweight(to_tsvector('english', coalesce(NEW.description, '')), 'D');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER core_property_search_vector_trigger
+    BEFORE INSERT OR UPDATE ON core_property
+    FOR EACH ROW EXECUTE FUNCTION core_property_search_vector_update();
+
+UPDATE core_property SET name = name;
+
+CREATE INDEX property_search_idx ON core_property USING gin (search_vector);
+"""
+
+DROP_SEARCH_VECTOR_SQL = """
+DROP INDEX IF EXISTS property_search_idx;
+DROP TRIGGER IF EXISTS core_property_search_vector_trigger ON core_property;
+DROP FUNCTION IF EXISTS core_property_search_vector_update();
+"""
+
+
+def create_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_SEARCH_VECTOR_SQL)
+
+
+def drop_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_SEARCH_VECTOR_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='property',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_vector, drop_search_vector),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.10 on 2026-10-17 06:17
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def drop_duplicate_callbacks(apps, schema_editor):
+    # Keep the first callback stored for each CheckoutRequestID
+    MpesaCallback = apps.get_model('core', 'MpesaCallback')
+    first_ids = (
+        MpesaCallback.objects
+        .values('checkout_request_id')
+        .annotate(first_id=Min('id'))
+        .values('first_id')
+    )
+    MpesaCallback.objects.exclude(id__in=first_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_mpesa_callback'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_callbacks, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='mpesacallback',
+            name='checkout_request_id',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='mpesacallback',
+            index=models.Index(condition=models.Q(('processed_at__isnull', True)), fields=['received_at'], name='mpesa_callback_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.10 on 2026-10-17 06:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_stk_push_request'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('status', 'processing')), fields=['payment_date', 'id'], name='payment_processing_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.10 on 2026-10-17 06:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_customuser_token_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='id_photo_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('rejected', 'Rejected')], default='pending', editable=False, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='id_photo_thumbnail',
+            field=models.ImageField(blank=True, editable=False, upload_to='users/thumbnails/'),
+        ),
+    ]
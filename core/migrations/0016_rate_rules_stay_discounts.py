@@ -0,0 +1,46 @@
+# Generated by Django 5.2.10 on 2026-10-17 06:53
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_customuser_id_photo_processing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LengthOfStayDiscount',
+            fields=[
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('min_nights', models.PositiveIntegerField(validators=[django.core.validators.MinValueValidator(2)])),
+                ('percent', models.DecimalField(decimal_places=2, max_digits=5, validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(100)])),
+                ('property', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stay_discounts', to='core.property')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('property', 'min_nights'), name='stay_discount_property_nights_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='RateRule',
+            fields=[
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(blank=True, max_length=100)),
+                ('start_date', models.DateField(blank=True, null=True)),
+                ('end_date', models.DateField(blank=True, null=True)),
+                ('weekdays', models.PositiveSmallIntegerField(default=0, help_text='Bit mask of the nights it applies to, Monday = 1 to Sunday = 64; 0 for every night', validators=[django.core.validators.MaxValueValidator(127)])),
+                ('price_per_night', models.DecimalField(decimal_places=2, max_digits=10, validators=[django.core.validators.MinValueValidator(0)])),
+                ('priority', models.IntegerField(default=0)),
+                ('property', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rate_rules', to='core.property')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['property', 'start_date'], name='rate_rule_property_start_idx')],
+                'constraints': [models.CheckConstraint(condition=models.Q(('start_date__isnull', True), ('end_date__isnull', True), ('end_date__gt', models.F('start_date')), _connector='OR'), name='rate_rule_end_after_start')],
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.10 on 2026-10-17 07:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_rate_rules_stay_discounts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledTask',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('queued_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-17 07:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_email_notification_claimed_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='property',
+            name='pricing_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
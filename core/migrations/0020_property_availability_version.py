@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-17 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_property_pricing_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='property',
+            name='availability_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
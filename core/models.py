@@ -6,26 +6,77 @@ retireved and saved.
 """
 
 import uuid
-from django.db import models
+from django.conf import settings
+from django.contrib.postgres.fields import RangeOperators
+from django.contrib.postgres.search import SearchVectorField
+from django.core.validators import MinValueValidator, MaxValueValidator
+from django.db import models, connections
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import (
     AbstractBaseUser,
     PermissionsMixin,
 )
-from .managers import CustomUserManager
+from .managers import BookingQuerySet, CustomUserManager, PaymentQuerySet, PropertyQuerySet
+from .constraints import DateRange, PostgresExclusionConstraint
+from .geo import cell_for
 
 
-class CustomUser(AbstractBaseUser, PermissionsMixin):
+def overlap_precheck_enabled(using='default'):
+    """
+    Whether double bookings should be checked in Python before saving.
+
+    PostgreSQL enforces the booking_no_overlap constraint itself, so the
+    pre-checks default to off there. Set BOOKING_OVERLAP_PRECHECK to force
+    them either way.
+    """
+    return getattr(
+        settings,
+        'BOOKING_OVERLAP_PRECHECK',
+        connections[using].vendor != 'postgresql',
+    )
+
+
+class UpdatedAtModel(models.Model):
+    """
+    Adds an ``updated_at`` timestamp, used for Last-Modified/ETag headers.
+    Saves limited with ``update_fields`` still move it forward.
+    """
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'updated_at'}
+        super().save(*args, **kwargs)
+
+
+class CustomUser(UpdatedAtModel, AbstractBaseUser, PermissionsMixin):
 
     class Roles(models.TextChoices):
         ADMIN = "admin", "Admin"
         GUEST = "guest", "Guest"
         HOST = "host", "Host"
+
+    class PhotoStatus(models.TextChoices):
+        PENDING = "pending", "Pending"
+        READY = "ready", "Ready"
+        REJECTED = "rejected", "Rejected"
     #Required fields
     id = models.CharField(primary_key=True, editable=False, unique=True, max_length=100)
     name = models.CharField(max_length=150)
     id_photo = models.ImageField(upload_to="users/photos/", blank=False, null=False)
+    # Filled in by the process_id_photo task, see core/photos.py
+    id_photo_thumbnail = models.ImageField(upload_to="users/thumbnails/", blank=True, editable=False)
+    id_photo_status = models.CharField(
+        max_length=10,
+        choices=PhotoStatus.choices,
+        default=PhotoStatus.PENDING,
+        editable=False,
+    )
     phone_number = models.CharField(
         max_length=20,
         unique=True,
@@ -41,6 +92,10 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     credit_score = models.IntegerField(default=0)
     role = models.CharField(max_length=20, choices=Roles.choices, default=Roles.GUEST)
     date_joined = models.DateTimeField(auto_now_add=True)
+    # Carried in access tokens; bumped when the role, active flag or
+    # password changes so tokens issued before stop working (see
+    # core/authentication.py)
+    token_version = models.PositiveIntegerField(default=0, editable=False)
     objects = CustomUserManager()
 
     USERNAME_FIELD = "id"
@@ -48,11 +103,66 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
 
     
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # What CustomUserSummarySerializer shows, so signals can tell
+        # whether responses embedding this user went stale
+        instance._loaded_summary = (
+            instance.__dict__.get('name'),
+            instance.__dict__.get('role'),
+        )
+        instance._loaded_claims = (
+            instance.__dict__.get('role'),
+            instance.__dict__.get('is_active'),
+        )
+        return instance
+
+    def check_password(self, raw_password):
+        # A hash upgraded on login holds the same password, so it keeps
+        # the tokens already issued
+        self._upgrading_hash = True
+        try:
+            return super().check_password(raw_password)
+        finally:
+            self._upgrading_hash = False
+
+    def set_password(self, raw_password):
+        super().set_password(raw_password)
+        if not getattr(self, '_upgrading_hash', False):
+            self._password_changed = True
+
+    def revokes_tokens(self, update_fields=None):
+        """Whether saving ``update_fields`` changes a claim tokens carry"""
+        fields = set()
+        if getattr(self, '_password_changed', False):
+            fields.add('password')
+        loaded = getattr(self, '_loaded_claims', None)
+        if loaded is not None:
+            for name, value in zip(('role', 'is_active'), loaded):
+                if value is not None and self.__dict__.get(name, value) != value:
+                    fields.add(name)
+        if update_fields is not None:
+            fields &= set(update_fields)
+        return bool(fields)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if not self._state.adding and self.revokes_tokens(update_fields):
+            self.token_version += 1
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'token_version'}
+            # core/signals.py drops the cached version once this commits
+            self._token_version_changed = True
+        super().save(*args, **kwargs)
+        self._password_changed = False
+        self._loaded_claims = (self.__dict__.get('role'), self.__dict__.get('is_active'))
+
     def __str__(self):
         return f"{self.name} {self.phone_number}"
 
 
-class Property(models.Model):
+class Property(UpdatedAtModel):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     owner = models.ForeignKey(
         CustomUser, 
@@ -65,24 +175,150 @@ class Property(models.Model):
     amenities = models.TextField()
     price_per_night = models.DecimalField(max_digits=10, decimal_places=2)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Weighted name/location/amenities/description document, filled in by a
+    # database trigger on PostgreSQL and GIN indexed (see migration 0006)
+    search_vector = SearchVectorField(null=True, editable=False)
+    latitude = models.FloatField(
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(-90), MaxValueValidator(90)],
+    )
+    longitude = models.FloatField(
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(-180), MaxValueValidator(180)],
+    )
+    # Grid cell of the coordinates used by radius/box searches, see core/geo.py
+    geo_cell = models.IntegerField(null=True, editable=False)
+    # Moves when a RateRule or LengthOfStayDiscount of the property changes;
+    # part of the pricing cache key, see core/pricing.py
+    pricing_version = models.PositiveIntegerField(default=0, editable=False)
+    # Moves when a booking of the property changes the nights it holds;
+    # part of the availability index key, see core/availability.py
+    availability_version = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = PropertyQuerySet.as_manager()
     
     #TODO: adding type
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['price_per_night'], name='property_price_idx'),
+            models.Index(fields=['geo_cell'], name='property_geo_cell_idx'),
+            models.Index(fields=['latitude', 'longitude'], name='property_lat_lng_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        """
+        Override save to keep geo_cell in step with the coordinates. Saves
+        of an existing property leave pricing_version and
+        availability_version as they are in the database, which an
+        instance loaded before a rule or booking changed would otherwise
+        put back.
+        """
+        self.geo_cell = cell_for(self.latitude, self.longitude)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None and not self._state.adding and not kwargs.get('force_insert'):
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in ('pricing_version', 'availability_version')
+            ]
+            kwargs['update_fields'] = update_fields
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'geo_cell'}
+        super().save(*args, **kwargs)
+
     def is_available(self, start_date, end_date):  
         """Check if property is available for the given date range"""
-        overlapping_bookings = Booking.objects.filter(
-            property=self,
-            check_in__lt=end_date,
-            check_out__gt=start_date
-        )
-        return not overlapping_bookings.exists()
+        from .availability import is_available
+
+        return is_available(self.pk, start_date, end_date, self.availability_version)
 
     def __str__(self):
         return f"{self.title} - {self.address}"
-    
 
 
-class Booking(models.Model):
+class RateRule(UpdatedAtModel):
+    """
+    A nightly price overriding Property.price_per_night for some nights:
+    those between start_date and end_date (end exclusive, like check_out;
+    either may be open) that fall on one of ``weekdays``. Where rules
+    overlap, the one with the highest priority sets the price. Quoted by
+    core/pricing.py.
+    """
+    # Bits of ``weekdays``, by date.weekday()
+    MONDAY, TUESDAY, WEDNESDAY, THURSDAY, FRIDAY, SATURDAY, SUNDAY = (1 << day for day in range(7))
+    EVERY_NIGHT = 0
+    # Friday and Saturday nights
+    WEEKEND = FRIDAY | SATURDAY
+
+    id = models.BigAutoField(primary_key=True)
+    property = models.ForeignKey(
+        Property,
+        on_delete=models.CASCADE,
+        related_name="rate_rules"
+    )
+    name = models.CharField(max_length=100, blank=True)
+    start_date = models.DateField(null=True, blank=True)
+    end_date = models.DateField(null=True, blank=True)
+    weekdays = models.PositiveSmallIntegerField(
+        default=EVERY_NIGHT,
+        validators=[MaxValueValidator(0b1111111)],
+        help_text="Bit mask of the nights it applies to, Monday = 1 to Sunday = 64; 0 for every night",
+    )
+    price_per_night = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(0)])
+    priority = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['property', 'start_date'], name='rate_rule_property_start_idx'),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                check=(
+                    models.Q(start_date__isnull=True)
+                    | models.Q(end_date__isnull=True)
+                    | models.Q(end_date__gt=models.F("start_date"))
+                ),
+                name="rate_rule_end_after_start",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.name or 'Rate'} {self.price_per_night} for {self.property_id}"
+
+
+class LengthOfStayDiscount(UpdatedAtModel):
+    """
+    A percentage off stays of at least ``min_nights``. Only the discount
+    with the largest ``min_nights`` a stay reaches applies.
+    """
+    id = models.BigAutoField(primary_key=True)
+    property = models.ForeignKey(
+        Property,
+        on_delete=models.CASCADE,
+        related_name="stay_discounts"
+    )
+    min_nights = models.PositiveIntegerField(validators=[MinValueValidator(2)])
+    percent = models.DecimalField(
+        max_digits=5,
+        decimal_places=2,
+        validators=[MinValueValidator(0), MaxValueValidator(100)],
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['property', 'min_nights'],
+                name='stay_discount_property_nights_uniq',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.percent}% off {self.min_nights}+ nights for {self.property_id}"
+
+
+class Booking(UpdatedAtModel):
     class BookingStatus(models.TextChoices):
         PENDING = 'pending', 'Pending'
         PROCESSING = 'processing', 'Processing'
@@ -107,6 +343,56 @@ class Booking(models.Model):
     balance_due = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = BookingQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored property and status so the availability
+        # index can tell which saves change the nights held, see
+        # core/signals.py
+        instance._loaded_property_id = instance.__dict__.get('property_id')
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
+
+    def has_guest(self, user):
+        """
+        Whether ``user`` is one of the guests. Uses the prefetched guest
+        list when there is one, else a single EXISTS query.
+        """
+        prefetched = getattr(self, '_prefetched_objects_cache', {}).get('guests')
+        if prefetched is not None:
+            return any(guest.pk == user.pk for guest in prefetched)
+        return Booking.guests.through.objects.filter(
+            booking_id=self.pk, customuser_id=user.pk
+        ).exists()
+
+    def holds_new_nights(self, update_fields):
+        """
+        Whether saving ``update_fields`` can make the booking overlap
+        another one: it moves, or a canceled booking becomes active again.
+        """
+        if {'property', 'property_id', 'check_in', 'check_out'} & set(update_fields):
+            return True
+        return (
+            'status' in update_fields
+            and getattr(self, '_loaded_status', None) == self.BookingStatus.CANCELED
+            and self.status != self.BookingStatus.CANCELED
+        )
+
+    def changes_nights(self, update_fields):
+        """
+        Whether saving ``update_fields`` can change the nights the booking
+        holds: it moves, or it is canceled or made active again.
+        """
+        if {'property', 'property_id', 'check_in', 'check_out'} & set(update_fields):
+            return True
+        canceled = self.BookingStatus.CANCELED
+        return (
+            'status' in update_fields
+            and (getattr(self, '_loaded_status', None) == canceled) != (self.status == canceled)
+        )
+
     def clean(self):
         """Validate booking dates and availability"""
         from django.core.exceptions import ValidationError
@@ -124,6 +410,8 @@ class Booking(models.Model):
             })
         
         # Check property availability (exclude current booking if updating)
+        if not overlap_precheck_enabled():
+            return
         if not self.property.is_available(self.check_in, self.check_out):
             if self._state.adding or not Booking.objects.filter(
                 check_in=self.check_in,
@@ -134,9 +422,17 @@ class Booking(models.Model):
                 })
     
     def save(self, *args, **kwargs):
-        """Override save to run validation"""
-        self.full_clean()
+        """
+        Override save to run validation. Saves limited to fields that don't
+        touch the booked nights, such as a payment's balance and status
+        update, skip it rather than re-checking availability.
+        """
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or self.holds_new_nights(update_fields):
+            self.full_clean(validate_constraints=overlap_precheck_enabled())
         super().save(*args, **kwargs)
+        self._loaded_property_id = self.property_id
+        self._loaded_status = self.status
     
     def get_number_of_nights(self):
         """Get number of nights for this booking"""
@@ -147,8 +443,12 @@ class Booking(models.Model):
         return self.status in ['pending'] and self.check_in > timezone.now().date()
 
     def calculate_total_price(self):
-        delta = self.check_out - self.check_in
-        self.total_price = delta.days * self.property.price_per_night
+        """Price the stay with the property's rates and discounts, see core/pricing.py"""
+        from .pricing import quote
+
+        price = quote(self.property, self.check_in, self.check_out)
+        self.price_per_night = price.average_per_night
+        self.total_price = price.total
         self.balance_due = self.total_price
     
     def calculate_balance_due(self, amount_paid):
@@ -157,17 +457,48 @@ class Booking(models.Model):
             self.status = self.BookingStatus.PROCESSING
         else:
             self.status = self.BookingStatus.CONFIRMED
-        self.save(update_fields=['status'])
+        self.save(update_fields=['balance_due', 'status'])
+        return self.balance_due
+
+    def restore_balance_due(self, amount_paid):
+        """Undo calculate_balance_due for a payment that failed"""
+        self.balance_due = min(self.balance_due + amount_paid, self.total_price)
+        if self.status != self.BookingStatus.CANCELED:
+            if self.balance_due >= self.total_price:
+                self.status = self.BookingStatus.PENDING
+            else:
+                self.status = self.BookingStatus.PROCESSING
+        self.save(update_fields=['balance_due', 'status'])
         return self.balance_due
 
     
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            # Overlap checks: property = ? AND check_in < ? AND check_out > ?
+            models.Index(
+                fields=['property', 'check_in', 'check_out'],
+                name='booking_property_dates_idx',
+            ),
+            # Default ordering and keyset pagination of the booking lists
+            models.Index(fields=['-created_at', '-id'], name='booking_created_id_idx'),
+            models.Index(fields=['status'], name='booking_status_idx'),
+        ]
         constraints = [
             models.CheckConstraint(
                 check=models.Q(check_out__gt=models.F("check_in")),
                 name="check_out_after_check_in"
-            )
+            ),
+            # No two active bookings of a property may share a night
+            PostgresExclusionConstraint(
+                name="booking_no_overlap",
+                expressions=[
+                    ("property", RangeOperators.EQUAL),
+                    (DateRange("check_in", "check_out"), RangeOperators.OVERLAPS),
+                ],
+                condition=~models.Q(status="canceled"),
+                violation_error_message="Property is not available for the selected dates.",
+            ),
         ]
     
     def __str__(self):
@@ -175,7 +506,7 @@ class Booking(models.Model):
 
 
     
-class Payment(models.Model):
+class Payment(UpdatedAtModel):
     class Status(models.TextChoices):
         PROCESSING = "processing", "Processing"
         SUCCESSFUL = "successful", "Successful"
@@ -210,14 +541,144 @@ class Payment(models.Model):
     payment_date = models.DateTimeField(auto_now_add=True)
     payment_method = models.CharField(max_length=100)
 
+    objects = PaymentQuerySet.as_manager()
+
     def get_checkout_request_id(self, response):
         self.checkout_request_id = response.get("CheckoutRequestID")
 
     class Meta:
-        indexes=[
-            models.Index(fields=['booking', 'payer', 'checkout_request_id'])
+        ordering = ["-payment_date"]
+        # booking and payer are covered by their foreign key indexes and
+        # checkout_request_id by its unique constraint
+        indexes = [
+            # Default ordering and keyset pagination of the payment lists
+            models.Index(fields=['-payment_date', '-id'], name='payment_date_id_idx'),
+            # Reconciliation walks the few payments still waiting on Mpesa
+            models.Index(
+                fields=['payment_date', 'id'],
+                condition=models.Q(status='processing'),
+                name='payment_processing_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f"Payment {self.id} for Booking {self.booking_id} amount: {self.amount}"
+    
+
+class MpesaCallback(models.Model):
+    """
+    Inbox of STK push callbacks as Safaricom posted them, one row per
+    CheckoutRequestID.
+
+    The callback view inserts into it and ignores conflicts, so Daraja's
+    retries of a callback we already have are dropped at the door. The
+    drain_mpesa_callbacks task applies pending rows to their payments in
+    batches and sets processed_at once per row. A row whose payment doesn't
+    have the CheckoutRequestID yet stays pending for a while, see
+    core/tasks.py.
+    """
+    id = models.BigAutoField(primary_key=True)
+    checkout_request_id = models.CharField(max_length=100, unique=True)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["received_at"]
+        indexes = [
+            # The drain only ever reads rows that are still pending
+            models.Index(
+                fields=['received_at'],
+                condition=models.Q(processed_at__isnull=True),
+                name='mpesa_callback_pending_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f"Mpesa callback {self.checkout_request_id}"
+
+
+class ScheduledTask(models.Model):
+    """
+    Whether a run of a debounced task is already queued, one row per task.
+
+    A sender claims the row with a conditional UPDATE before queueing the
+    task, and the task clears queued_at when it starts, so every process
+    sees the same flag whatever cache it is configured with.
+    """
+    name = models.CharField(max_length=100, primary_key=True)
+    queued_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+class EmailNotification(models.Model):
+    """
+    Outbox of emails waiting to be sent.
+
+    Rows are written in the same transaction as the change they report,
+    and the send_email_notifications task delivers them in batches over a
+    single mail connection. sent_at is set once a message is delivered;
+    failed ones keep their last error and are retried by a later run.
+    No run picks a row up before claimed_until: while another run is
+    sending it, and after a failure until its retry is due.
+    """
+    id = models.BigAutoField(primary_key=True)
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["created_at"]
+        indexes = [
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(sent_at__isnull=True),
+                name='email_pending_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {self.recipient}"
+
+
+class StkPushRequest(models.Model):
+    """
+    Outbox row for an STK push that still has to be sent to Daraja.
+
+    It is committed together with its payment, and the send_stk_push task
+    makes the HTTP call outside of any transaction, so no lock is held
+    while Safaricom answers. claimed_until stops two workers from pushing
+    the same payment at once; sent_at is set once Daraja has replied.
+    """
+    id = models.BigAutoField(primary_key=True)
+    payment = models.OneToOneField(
+        Payment,
+        on_delete=models.CASCADE,
+        related_name="stk_push",
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    response = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["created_at"]
+        indexes = [
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(sent_at__isnull=True),
+                name='stk_push_pending_idx',
+            ),
         ]
 
     def __str__(self):
-        return f"Payment {self.id} for Booking {self.booking.id} amount: {self.amount}"
-    
\ No newline at end of file
+        return f"STK push for payment {self.payment_id}"
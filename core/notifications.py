@@ -0,0 +1,141 @@
+"""
+Outgoing email goes through the EmailNotification outbox rather than
+``send_mail``.
+
+``queue_email`` only writes a row, so it can sit inside the transaction
+of the change it reports. ``deliver_pending`` sends what is waiting in
+batches over one mail connection, which for SMTP means one TLS session
+for the whole run instead of one per message. The Celery side lives in
+core/tasks.py.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import EmailNotification
+
+
+def batch_size():
+    return getattr(settings, "EMAIL_NOTIFICATION_BATCH_SIZE", 100)
+
+
+def max_attempts():
+    return getattr(settings, "EMAIL_NOTIFICATION_MAX_ATTEMPTS", 5)
+
+
+def claim_timeout():
+    """How long a run owns the rows it is sending, in seconds"""
+    return getattr(settings, "EMAIL_NOTIFICATION_CLAIM_TIMEOUT", 60 * 5)
+
+
+def retry_delay():
+    return getattr(settings, "EMAIL_NOTIFICATION_RETRY_DELAY", 30)
+
+
+def queue_emails(emails):
+    """
+    Add ``(recipient, subject, body)`` tuples to the outbox in one insert,
+    skipping those without a recipient. Returns how many were queued.
+    """
+    rows = [
+        EmailNotification(recipient=recipient, subject=subject, body=body)
+        for recipient, subject, body in emails
+        if recipient
+    ]
+    EmailNotification.objects.bulk_create(rows)
+    return len(rows)
+
+
+def queue_email(recipient, subject, body):
+    """Add a single email to the outbox"""
+    return queue_emails([(recipient, subject, body)])
+
+
+def payment_confirmation_email(payment, amount=None):
+    """``(recipient, subject, body)`` confirming a successful payment"""
+    body = f"Payment of KES {amount if amount is not None else payment.amount} received."
+    if payment.mpesa_ref:
+        body += f" Receipt: {payment.mpesa_ref}"
+    return (
+        payment.payer.email,
+        f"Payment Confirmation for Booking: {payment.booking_id}",
+        body,
+    )
+
+
+def _claim(size):
+    """
+    Take up to ``size`` pending rows for this run in a short transaction.
+    SKIP LOCKED keeps concurrent runs apart while the rows are picked, and
+    claimed_until keeps them off the others' hands while they are sent.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(
+            EmailNotification.objects
+            .select_for_update(skip_locked=True)
+            .filter(sent_at__isnull=True, attempts__lt=max_attempts())
+            .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lte=now))
+            .order_by("created_at")[:size]
+        )
+        for row in rows:
+            row.attempts += 1
+            row.claimed_until = now + timedelta(seconds=claim_timeout())
+        EmailNotification.objects.bulk_update(rows, ["attempts", "claimed_until"])
+    return rows
+
+
+def deliver_pending(connection=None, limit=None):
+    """
+    Send pending notifications over a single connection, a batch at a time.
+
+    Each batch is claimed in one short transaction, sent with none open,
+    and its results saved in another, so a slow SMTP server holds no
+    locks. A run stops after the first batch with a failure. Failed rows
+    wait EMAIL_NOTIFICATION_RETRY_DELAY seconds, doubled for every earlier
+    attempt, before a run picks them up again. Returns ``(sent, failed)``.
+    """
+    connection = connection or get_connection(fail_silently=False)
+    sent = failed = 0
+
+    with connection:
+        while limit is None or sent + failed < limit:
+            size = batch_size() if limit is None else min(batch_size(), limit - sent - failed)
+            rows = _claim(size)
+            if not rows:
+                break
+
+            batch_failed = 0
+            for row in rows:
+                message = EmailMessage(
+                    subject=row.subject,
+                    body=row.body,
+                    to=[row.recipient],
+                    connection=connection,
+                )
+                try:
+                    connection.send_messages([message])
+                except Exception as error:
+                    row.last_error = str(error)[:1000]
+                    row.claimed_until = timezone.now() + timedelta(
+                        seconds=retry_delay() * 2 ** (row.attempts - 1),
+                    )
+                    batch_failed += 1
+                else:
+                    row.sent_at = timezone.now()
+                    row.last_error = ""
+                    row.claimed_until = None
+
+            with transaction.atomic():
+                EmailNotification.objects.bulk_update(rows, ["sent_at", "last_error", "claimed_until"])
+            sent += len(rows) - batch_failed
+            failed += batch_failed
+            if batch_failed:
+                break
+
+    return sent, failed
@@ -0,0 +1,207 @@
+"""
+Keyset (cursor) pagination for the large booking and payment lists.
+
+Pages are fetched with ``WHERE (created_at, id) < (last seen) ORDER BY
+created_at DESC, id DESC LIMIT n`` instead of OFFSET, so page 10,000 costs
+the same index range scan as page 1, and no ``COUNT(*)`` is run unless an
+admin asks for one.
+"""
+
+import base64
+import json
+
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .permissions import is_admin
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginates on a unique ``ordering`` such as ``('-created_at', '-id')``.
+
+    - ``?cursor=`` is an opaque token taken from the ``next``/``previous`` links
+    - ``?page_size=`` picks the page size, up to ``max_page_size``
+    - admins can add ``?count=estimate`` for an ``X-Total-Count-Estimate``
+      header from the query planner, or ``?count=exact`` for ``X-Total-Count``
+    """
+    ordering = ('-created_at', '-id')
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # ConditionalGetMixin paginates a request once to version the page
+        # and again to build it; the count only has to be taken once
+        if getattr(self, 'request', None) is not request:
+            self.count_headers = self.get_count_headers(queryset, request)
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+
+        position, reverse = self.decode_cursor(request, queryset.model)
+        results = list(self.get_page_queryset(queryset, position, reverse)[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        if reverse:
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+        self.page = results
+        return results
+
+    def get_page_queryset(self, queryset, position=None, reverse=False):
+        """Order ``queryset`` on the keyset and keep the rows after ``position``"""
+        fields = [field.lstrip('-') for field in self.ordering]
+        descending = [field.startswith('-') for field in self.ordering]
+        if reverse:
+            descending = [not desc for desc in descending]
+
+        queryset = queryset.order_by(*[
+            f'-{field}' if desc else field for field, desc in zip(fields, descending)
+        ])
+        if position is None:
+            return queryset
+
+        # (a, b) after (x, y) is a > x OR (a = x AND b > y), per direction
+        after = Q()
+        for index, field in enumerate(fields):
+            lookup = 'lt' if descending[index] else 'gt'
+            condition = Q(**{f'{field}__{lookup}': position[index]})
+            for previous in range(index):
+                condition &= Q(**{fields[previous]: position[previous]})
+            after |= condition
+        return queryset.filter(after)
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def get_position(self, instance):
+        return [getattr(instance, field.lstrip('-')) for field in self.ordering]
+
+    def encode_cursor(self, position, reverse):
+        # isoformat() keeps the microseconds DjangoJSONEncoder would drop
+        payload = json.dumps(
+            [position, reverse],
+            default=lambda value: value.isoformat() if hasattr(value, 'isoformat') else str(value),
+        )
+        token = base64.urlsafe_b64encode(payload.encode()).decode()
+        url = replace_query_param(self.base_url, self.cursor_query_param, token)
+        return remove_query_param(url, self.count_query_param)
+
+    def decode_cursor(self, request, model):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None, False
+        try:
+            position, reverse = json.loads(base64.urlsafe_b64decode(token.encode()))
+            if len(position) != len(self.ordering):
+                raise ValueError
+            position = [
+                model._meta.get_field(field.lstrip('-')).to_python(value)
+                for field, value in zip(self.ordering, position)
+            ]
+            # None can't be compared with in get_page_queryset
+            if None in position:
+                raise ValueError
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+        return position, bool(reverse)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.get_position(self.page[-1]), False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.get_position(self.page[0]), True)
+
+    def get_count_headers(self, queryset, request):
+        mode = request.query_params.get(self.count_query_param)
+        if mode not in ('estimate', 'exact') or not is_admin(request.user):
+            return {}
+        if mode == 'exact':
+            return {'X-Total-Count': str(queryset.count())}
+        return {'X-Total-Count-Estimate': str(estimate_count(queryset))}
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                'next': self.get_next_link(),
+                'previous': self.get_previous_link(),
+                'results': data,
+            },
+            headers=self.count_headers,
+        )
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'The pagination cursor value.',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Number of results to return per page.',
+                'schema': {'type': 'integer'},
+            },
+            {
+                'name': self.count_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Admins only: "estimate" or "exact" total count header.',
+                'schema': {'type': 'string', 'enum': ['estimate', 'exact']},
+            },
+        ]
+
+
+def estimate_count(queryset):
+    """
+    Row estimate for ``queryset`` from the PostgreSQL planner, which costs a
+    plan instead of a scan. Other databases fall back to ``count()``.
+    """
+    if connections[queryset.db].vendor != 'postgresql':
+        return queryset.count()
+    plan = json.loads(queryset.order_by().explain(format='json'))
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class BookingCursorPagination(KeysetPagination):
+    ordering = ('-created_at', '-id')
+
+
+class PaymentCursorPagination(KeysetPagination):
+    ordering = ('-payment_date', '-id')
@@ -41,9 +41,25 @@ class UsersPermission(BasePermission):
             return False
 
     def has_object_permission(self, request, view, obj):
-        return is_admin(request.user) or obj == request.user
+        return is_admin(request.user) or obj.pk == request.user.pk
         
 
+# for uploaded files such as ID photos (admin/owner only)
+class MediaPermission(BasePermission):
+    """
+    Uploaded files get the same protection as the user they belong to
+
+    - Only authenticated users can download files
+    - Only admins or the user the file belongs to can download it
+
+    """
+    def has_permission(self, request, view):
+        return is_authenticated(request.user)
+
+    def has_object_permission(self, request, view, obj):
+        return is_admin(request.user) or obj.pk == request.user.pk
+
+
 # for property creation/update/deletion (admin/host only)
 class PropertyPermissions(BasePermission):
     """
@@ -51,20 +67,22 @@ class PropertyPermissions(BasePermission):
 
     - Only admins and hosts can create properties
     - Only admins and the host who owns the property can update/delete it
-    - Anyone can view properties
+    - Anyone can view properties and quote stays
 
     """
     def has_permission(self, request, view):
-        if view.action in ['list', 'retrieve']:
+        if view.action in ['list', 'retrieve', 'quote']:
             return True
         
         if view.action not in ['list', 'retrieve']:
             return is_admin(request.user) or is_host(request.user)
 
     def has_object_permission(self, request, view, obj):
-        if request.user.role == 'admin':
+        if view.action in ['list', 'retrieve']:
+            return True
+        if is_admin(request.user):
             return True
-        return request.user.role == 'host' and obj.owner == request.user
+        return is_host(request.user) and obj.owner_id == request.user.pk
 
 # for booking creation (guest only)
 class BookingPermissions(BasePermission):
@@ -87,7 +105,11 @@ class BookingPermissions(BasePermission):
             return False
 
     def has_object_permission(self, request, view, obj):
-            return is_guest(request.user) and request.user in obj.guests.all() and obj.status == 'pending'
+            return (
+                is_guest(request.user)
+                and obj.status == 'pending'
+                and obj.has_guest(request.user)
+            )
    
 # for payment creation (guest only)
 class IsGuestForPayment(BasePermission):
@@ -0,0 +1,109 @@
+"""
+Processing of the ID photos users sign up with.
+
+Uploads are streamed to a temporary file by the upload handler in
+FILE_UPLOAD_HANDLERS and stored as they were sent, so a registration
+only pays for moving the file into storage. The process_id_photo task in
+core/tasks.py then calls ``process_id_photo`` here, which:
+
+- decodes the original, rejecting files that aren't a readable image,
+- turns it upright according to its EXIF orientation,
+- downscales it to fit ID_PHOTO_MAX_SIZE pixels,
+- stores it as a JPEG without the EXIF data (location, camera, times),
+- writes an ID_PHOTO_THUMBNAIL_SIZE thumbnail next to it.
+
+JPEGs are decoded with ``Image.draft`` at the smallest of 1/2, 1/4 or 1/8
+scale that still covers ID_PHOTO_MAX_SIZE, so a large phone photo is never
+held in memory at full resolution.
+"""
+
+import io
+import uuid
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .models import CustomUser
+
+
+# What Pillow raises for files it can't decode
+DECODE_ERRORS = (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError, ValueError)
+
+
+def max_size():
+    return getattr(settings, "ID_PHOTO_MAX_SIZE", 1600)
+
+
+def thumbnail_size():
+    return getattr(settings, "ID_PHOTO_THUMBNAIL_SIZE", 256)
+
+
+def jpeg_quality():
+    return getattr(settings, "ID_PHOTO_JPEG_QUALITY", 85)
+
+
+def downscaled(file, size):
+    """The image in ``file``, upright, RGB and no larger than ``size`` on a side"""
+    image = Image.open(file)
+    image.draft("RGB", (size, size))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((size, size))
+    return image.convert("RGB")
+
+
+def as_jpeg(image):
+    # Saved without exif=, so none of the original metadata is carried over
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=jpeg_quality(), optimize=True)
+    return ContentFile(buffer.getvalue())
+
+
+def process_id_photo(user_id):
+    """
+    Replace a pending ID photo with its processed version and thumbnail.
+    Returns the new status, or None when there was nothing to do.
+    """
+    user = CustomUser.objects.filter(
+        pk=user_id, id_photo_status=CustomUser.PhotoStatus.PENDING,
+    ).only("id", "id_photo", "id_photo_thumbnail").first()
+    if user is None or not user.id_photo:
+        return None
+    original = user.id_photo.name
+    old_thumbnail = user.id_photo_thumbnail.name
+    # Only the upload that was processed; a newer one gets its own task
+    current = CustomUser.objects.filter(
+        pk=user_id, id_photo=original, id_photo_status=CustomUser.PhotoStatus.PENDING,
+    )
+
+    with user.id_photo.open("rb") as file:
+        try:
+            photo = downscaled(file, max_size())
+        except DECODE_ERRORS:
+            current.update(id_photo_status=CustomUser.PhotoStatus.REJECTED, updated_at=timezone.now())
+            return CustomUser.PhotoStatus.REJECTED
+    thumbnail = photo.copy()
+    thumbnail.thumbnail((thumbnail_size(), thumbnail_size()))
+
+    name = f"{uuid.uuid4().hex}.jpg"
+    photo_field = CustomUser._meta.get_field("id_photo")
+    thumbnail_field = CustomUser._meta.get_field("id_photo_thumbnail")
+    storage = photo_field.storage
+    photo_name = storage.save(photo_field.generate_filename(user, name), as_jpeg(photo))
+    thumbnail_name = thumbnail_field.storage.save(thumbnail_field.generate_filename(user, name), as_jpeg(thumbnail))
+
+    updated = current.update(
+        id_photo=photo_name,
+        id_photo_thumbnail=thumbnail_name,
+        id_photo_status=CustomUser.PhotoStatus.READY,
+        updated_at=timezone.now(),
+    )
+    if not updated:
+        storage.delete(photo_name)
+        thumbnail_field.storage.delete(thumbnail_name)
+        return None
+    storage.delete(original)
+    if old_thumbnail:
+        thumbnail_field.storage.delete(old_thumbnail)
+    return CustomUser.PhotoStatus.READY
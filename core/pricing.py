@@ -0,0 +1,205 @@
+"""
+Prices of stays, from each property's nightly rate, its RateRules and its
+LengthOfStayDiscounts.
+
+``quote_many`` prices any number of (property, check_in, check_out)
+requests together. Each property's requests are split into windows of
+overlapping stays, and each window lays the nightly prices of the nights
+it covers out in one list, in integer cents: the base price, overwritten by each rule in priority order through slice
+assignment (a step of 7 for weekday rules). A running total of that list
+then gives the price of any stay as the difference of two entries, so a
+request costs the same however many nights it has, and nothing loops
+over nights in Python. Stays far apart land in windows of their own, so
+the nights priced never add up to more than the nights requested.
+
+The rules and discounts of a property are cached under its
+``pricing_version``, which the signal handlers in core/signals.py move
+forward in the transaction that changes one. The version is read from
+the database with the nightly rate, so every process sees a change as
+soon as it commits, whatever cache it uses; a warm quote runs that one
+query, or none when the caller already has the property.
+"""
+
+from bisect import bisect_right
+from decimal import ROUND_HALF_UP, Decimal
+from itertools import accumulate
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+
+from .models import LengthOfStayDiscount, Property, RateRule
+
+
+KEY_PREFIX = "pricing"
+CENT = Decimal("0.01")
+
+
+class Quote(NamedTuple):
+    property_id: object
+    check_in: object
+    check_out: object
+    nights: int
+    subtotal: Decimal
+    discount: Decimal
+    total: Decimal
+
+    @property
+    def average_per_night(self):
+        """The nightly price before discounts, averaged over the stay"""
+        return (self.subtotal / self.nights).quantize(CENT, ROUND_HALF_UP)
+
+
+def _cache():
+    return caches[getattr(settings, "PRICING_CACHE_ALIAS", "default")]
+
+
+def _timeout():
+    return getattr(settings, "PRICING_CACHE_TIMEOUT", 60 * 60)
+
+
+def _key(property_id, version):
+    return f"{KEY_PREFIX}:{property_id}:{version}"
+
+
+def bump_version(property_id):
+    """Retire the cached rules of a property after they changed"""
+    Property.objects.filter(pk=property_id).update(pricing_version=F("pricing_version") + 1)
+
+
+def _cents(amount):
+    return int((Decimal(amount) * 100).to_integral_value(ROUND_HALF_UP))
+
+
+def _amount(cents):
+    return (Decimal(cents) / 100).quantize(CENT)
+
+
+def _load(versions):
+    """
+    ``{property_id: (rules, discounts)}`` for ``{property_id: version}``,
+    from the cache or two queries
+    """
+    cache = _cache()
+    keys = {_key(pk, version): pk for pk, version in versions.items()}
+    found = {keys[key]: value for key, value in cache.get_many(list(keys)).items()}
+    missing = [pk for pk in versions if pk not in found]
+    if missing:
+        loaded = {pk: ([], []) for pk in missing}
+        rules = (
+            RateRule.objects
+            .filter(property_id__in=missing)
+            .order_by("priority", "id")
+            .values_list("property_id", "start_date", "end_date", "weekdays", "price_per_night")
+        )
+        for property_id, start, end, weekdays, price in rules:
+            loaded[property_id][0].append((start, end, weekdays, _cents(price)))
+        discounts = (
+            LengthOfStayDiscount.objects
+            .filter(property_id__in=missing)
+            .order_by("min_nights")
+            .values_list("property_id", "min_nights", "percent")
+        )
+        for property_id, min_nights, percent in discounts:
+            loaded[property_id][1].append((min_nights, percent))
+        cache.set_many({_key(pk, versions[pk]): value for pk, value in loaded.items()}, _timeout())
+        found.update(loaded)
+    return found
+
+
+def nightly_cents(base_cents, rules, first_night, nights):
+    """The price of each of ``nights`` nights from ``first_night``, in cents"""
+    prices = [base_cents] * nights
+    for start, end, weekdays, cents in rules:
+        begin = 0 if start is None else max((start - first_night).days, 0)
+        stop = nights if end is None else min((end - first_night).days, nights)
+        if begin >= stop:
+            continue
+        if not weekdays:
+            prices[begin:stop] = [cents] * (stop - begin)
+            continue
+        first_weekday = (first_night.weekday() + begin) % 7
+        for day in range(7):
+            if weekdays & (1 << day):
+                offset = begin + (day - first_weekday) % 7
+                if offset < stop:
+                    prices[offset:stop:7] = [cents] * len(range(offset, stop, 7))
+    return prices
+
+
+def _discount_cents(subtotal, nights, discounts):
+    index = bisect_right([min_nights for min_nights, _ in discounts], nights)
+    if not index:
+        return 0
+    percent = discounts[index - 1][1]
+    return int((subtotal * percent / 100).to_integral_value(ROUND_HALF_UP))
+
+
+def _windows(requests, indexes):
+    """``indexes`` in groups of overlapping or adjoining stays, by check_in"""
+    windows = []
+    end = None
+    for index in sorted(indexes, key=lambda index: requests[index][1]):
+        _, check_in, check_out = requests[index]
+        if end is None or check_in > end:
+            windows.append([])
+            end = check_out
+        windows[-1].append(index)
+        end = max(end, check_out)
+    return windows
+
+
+def quote_many(requests, properties=None):
+    """
+    Quotes for ``(property_id, check_in, check_out)`` requests, in order;
+    None for properties that don't exist. ``properties`` maps property ids
+    to a ``(price_per_night, pricing_version)`` already at hand, saving
+    the query for them.
+    """
+    requests = list(requests)
+    by_property = {}
+    for index, (property_id, check_in, check_out) in enumerate(requests):
+        by_property.setdefault(property_id, []).append(index)
+
+    properties = dict(properties or {})
+    unpriced = [pk for pk in by_property if pk not in properties]
+    if unpriced:
+        properties.update(
+            (pk, (price, version))
+            for pk, price, version in (
+                Property.objects.filter(pk__in=unpriced).values_list("pk", "price_per_night", "pricing_version")
+            )
+        )
+    priced = [pk for pk in by_property if pk in properties]
+    tables = _load({pk: properties[pk][1] for pk in priced})
+
+    quotes = [None] * len(requests)
+    for property_id in priced:
+        rules, discounts = tables[property_id]
+        base_cents = _cents(properties[property_id][0])
+        for window in _windows(requests, by_property[property_id]):
+            first_night = requests[window[0]][1]
+            last_day = max(requests[index][2] for index in window)
+            nightly = nightly_cents(base_cents, rules, first_night, (last_day - first_night).days)
+            running = [0, *accumulate(nightly)]
+
+            for index in window:
+                _, check_in, check_out = requests[index]
+                nights = (check_out - check_in).days
+                start = (check_in - first_night).days
+                subtotal = running[start + nights] - running[start]
+                discount = _discount_cents(subtotal, nights, discounts)
+                quotes[index] = Quote(
+                    property_id, check_in, check_out, nights,
+                    _amount(subtotal), _amount(discount), _amount(subtotal - discount),
+                )
+    return quotes
+
+
+def quote(property, check_in, check_out):
+    """The Quote of one stay at a Property instance"""
+    return quote_many(
+        [(property.pk, check_in, check_out)],
+        properties={property.pk: (property.price_per_night, property.pricing_version)},
+    )[0]
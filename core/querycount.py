@@ -0,0 +1,175 @@
+"""
+Query budgets for views, to keep N+1 queries from creeping back in.
+
+Views declare how many SQL queries each action may run::
+
+    class BookingViewSet(viewsets.ModelViewSet):
+        query_budgets = {'list': 6, 'retrieve': 5}
+
+With QueryBudgetMiddleware installed, every query a request runs is
+recorded through ``connection.execute_wrapper``. The request fails with
+QueryBudgetExceeded when it runs more queries than its action's budget,
+or when one SQL shape (the statement with its literals and ``IN`` lists
+collapsed) runs more than QUERY_REPEAT_LIMIT times, which is what a query
+issued from inside a loop looks like. Budgets count every query of the
+request, authentication and response caching included.
+
+The middleware is meant for tests and local development, it isn't in
+MIDDLEWARE by default. Tests add it with ``modify_settings``; set
+QUERY_BUDGET_RAISE = False to log violations instead of raising.
+"""
+
+import logging
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN \((?:\s*(?:%s|\?)\s*,?)+\)", re.IGNORECASE)
+_VALUES_LIST = re.compile(r"\bVALUES \((?:[^()]|\([^()]*\))*\)(?:\s*,\s*\((?:[^()]|\([^()]*\))*\))*", re.IGNORECASE)
+_SPACE = re.compile(r"\s+")
+
+# Transaction bookkeeping, not queries a view chose to run
+_IGNORED = ("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+# Type lookups psycopg runs once per new connection
+_CATALOG = re.compile(r"\bFROM pg_type\b")
+
+
+def repeat_limit():
+    """How often one SQL shape may run in a request before it counts as N+1"""
+    return getattr(settings, "QUERY_REPEAT_LIMIT", 2)
+
+
+def raise_on_violation():
+    return getattr(settings, "QUERY_BUDGET_RAISE", True)
+
+
+def sql_shape(sql):
+    """``sql`` with literals, placeholders and IN/VALUES lists collapsed"""
+    shape = _STRING.sub("?", sql)
+    shape = _NUMBER.sub("?", shape)
+    shape = shape.replace("%s", "?")
+    shape = _IN_LIST.sub("IN (...)", shape)
+    shape = _VALUES_LIST.sub("VALUES (...)", shape)
+    return _SPACE.sub(" ", shape).strip()
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A request ran more queries than its budget, or repeated one in a loop"""
+
+
+class QueryRecorder:
+    """
+    Records the queries run on the given database aliases while it's
+    active::
+
+        with QueryRecorder() as recorder:
+            ...
+        recorder.count, recorder.repeated()
+    """
+
+    def __init__(self, using=None):
+        self.aliases = [using] if using else list(connections)
+        self.queries = []
+        self._wrappers = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if not sql.lstrip().upper().startswith(_IGNORED) and not _CATALOG.search(sql):
+            self.queries.append((sql, params))
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        for alias in self.aliases:
+            wrapper = connections[alias].execute_wrapper(self)
+            wrapper.__enter__()
+            self._wrappers.append(wrapper)
+        return self
+
+    def __exit__(self, *exc_info):
+        while self._wrappers:
+            self._wrappers.pop().__exit__(*exc_info)
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    def shapes(self):
+        return Counter(sql_shape(sql) for sql, _ in self.queries)
+
+    def repeated(self, limit=None):
+        """``{shape: times}`` for the shapes run more than ``limit`` times"""
+        limit = repeat_limit() if limit is None else limit
+        return {shape: times for shape, times in self.shapes().items() if times > limit}
+
+    def violations(self, budget=None, limit=None):
+        """Messages describing how this recording broke ``budget``"""
+        problems = []
+        if budget is not None and self.count > budget:
+            problems.append(f"{self.count} queries, budget is {budget}")
+        for shape, times in self.repeated(limit).items():
+            problems.append(f"{times}x {shape}")
+        return problems
+
+    def report(self):
+        return "\n".join(f"  {index}. {sql}" for index, (sql, _) in enumerate(self.queries, 1))
+
+
+def _view_budgets(view_func):
+    """The ``query_budgets`` of a DRF view and, for viewsets, its actions"""
+    view_class = getattr(view_func, "cls", None)
+    budgets = getattr(view_class, "query_budgets", None)
+    if not budgets:
+        return None, None
+    # ViewSet.as_view() keeps its {method: action} map on the function
+    actions = getattr(view_func, "actions", None)
+    return budgets, actions
+
+
+class QueryBudgetMiddleware:
+    """Checks every request against the query budget of its view action"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request._query_budget = None
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+        self.check(request, recorder)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        budgets, actions = _view_budgets(view_func)
+        if budgets is None:
+            return None
+        method = request.method.lower()
+        if actions is not None:
+            action = actions.get(method)
+            # DRF answers HEAD with the GET action
+            if action is None and method == "head":
+                action = actions.get("get")
+        else:
+            action = method
+        request._query_budget = (action, budgets.get(action))
+        return None
+
+    def check(self, request, recorder):
+        action, budget = request._query_budget or (None, None)
+        problems = recorder.violations(budget)
+        if not problems:
+            return
+        message = (
+            f"{request.method} {request.get_full_path()} ({action or 'no budget'}): "
+            + "; ".join(problems)
+            + "\n"
+            + recorder.report()
+        )
+        if raise_on_violation():
+            raise QueryBudgetExceeded(message)
+        logger.warning("Query budget exceeded: %s", message)
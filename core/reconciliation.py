@@ -0,0 +1,148 @@
+"""
+Settles payments whose Mpesa callback never arrived.
+
+Payments still PROCESSING some time after their STK push are read in
+keyset batches over the payment_processing_idx partial index. Their
+status is queried from Daraja by a bounded pool of threads, and the
+outcomes of each batch are written with one bulk_update. Pushes Daraja
+still reports as in progress are left for the next run.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import service
+from .events import publish_payment_status
+from .models import Booking, Payment
+from .notifications import payment_confirmation_email, queue_emails
+
+
+def stale_after():
+    """Seconds a payment may wait for its callback before it's queried"""
+    return getattr(settings, "MPESA_RECONCILE_AFTER", 120)
+
+
+def concurrency():
+    return getattr(settings, "MPESA_RECONCILE_CONCURRENCY", 10)
+
+
+def batch_size():
+    return getattr(settings, "MPESA_RECONCILE_BATCH_SIZE", 200)
+
+
+def run_limit():
+    """Most payments one run checks, so a backlog can't make it run forever"""
+    return getattr(settings, "MPESA_RECONCILE_LIMIT", 5000)
+
+
+def query_outcome(checkout_request_id):
+    """
+    Final status Daraja reports for a push, or None while it's still in
+    progress or the query itself failed.
+    """
+    try:
+        response = service.stk_query(checkout_request_id)
+    except Exception:
+        return None
+    result_code = response.get("ResultCode")
+    if result_code is None or result_code == "":
+        # e.g. errorCode 500.001.1001, "The transaction is being processed"
+        return None
+    if str(result_code) == "0":
+        return Payment.Status.SUCCESSFUL
+    return Payment.Status.FAILED
+
+
+def _stale_batches(cutoff, size, limit):
+    """Keyset batches of ``(pk, checkout_request_id, payment_date)``, oldest first"""
+    queryset = (
+        Payment.objects
+        .filter(
+            status=Payment.Status.PROCESSING,
+            checkout_request_id__isnull=False,
+            payment_date__lt=cutoff,
+        )
+        .order_by("payment_date", "id")
+        .values_list("pk", "checkout_request_id", "payment_date")
+    )
+    seen = 0
+    last = None
+    while seen < limit:
+        page = queryset
+        if last is not None:
+            page = page.filter(
+                Q(payment_date__gt=last[2]) | Q(payment_date=last[2], pk__gt=last[0])
+            )
+        rows = list(page[:min(size, limit - seen)])
+        if not rows:
+            return
+        yield rows
+        seen += len(rows)
+        last = rows[-1]
+
+
+def _apply(outcomes):
+    """Write a batch of ``{payment_pk: status}``; returns ``(successful, failed)``"""
+    if not outcomes:
+        return 0, 0
+
+    now = timezone.now()
+    with transaction.atomic():
+        # Only payments no callback has settled in the meantime
+        payments = list(
+            Payment.objects
+            .select_for_update(of=("self",))
+            .select_related("payer", "booking")
+            .filter(pk__in=outcomes, status=Payment.Status.PROCESSING)
+        )
+        for payment in payments:
+            payment.status = outcomes[payment.pk]
+            payment.updated_at = now
+        Payment.objects.bulk_update(payments, ["status", "updated_at"])
+        Booking.objects.restore_balances(payment for payment in payments if payment.status == Payment.Status.FAILED)
+        publish_payment_status(payments)
+
+        successful = [payment for payment in payments if payment.status == Payment.Status.SUCCESSFUL]
+        queue_emails(payment_confirmation_email(payment) for payment in successful)
+
+    return len(successful), len(payments) - len(successful)
+
+
+def reconcile_stale_payments(max_age=None, size=None, workers=None, limit=None):
+    """
+    Query and settle stale PROCESSING payments. Returns metrics for the
+    run, including how many payments it checked per minute.
+    """
+    max_age = stale_after() if max_age is None else max_age
+    size = size or batch_size()
+    workers = workers or concurrency()
+    limit = limit or run_limit()
+
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    metrics = {"checked": 0, "successful": 0, "failed": 0, "pending": 0}
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for rows in _stale_batches(cutoff, size, limit):
+            results = pool.map(query_outcome, [checkout_id for _, checkout_id, _ in rows])
+            outcomes = {
+                pk: outcome
+                for (pk, _, _), outcome in zip(rows, results)
+                if outcome is not None
+            }
+            successful, failed = _apply(outcomes)
+            metrics["checked"] += len(rows)
+            metrics["successful"] += successful
+            metrics["failed"] += failed
+            metrics["pending"] += len(rows) - len(outcomes)
+
+    elapsed = time.perf_counter() - started
+    metrics["elapsed_s"] = round(elapsed, 3)
+    metrics["per_minute"] = round(metrics["checked"] / elapsed * 60, 1) if elapsed else 0.0
+    return metrics
@@ -7,6 +7,9 @@ database or sent in API responses.
 
 from rest_framework.serializers import ModelSerializer, ValidationError
 from rest_framework import serializers
+from rest_framework.relations import MANY_RELATION_KWARGS, ManyRelatedField
+from rest_framework.settings import api_settings
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError as DValidationError
@@ -16,13 +19,81 @@ from .models import (
     Property,
     Booking,
     Payment,
+    StkPushRequest,
+    overlap_precheck_enabled,
 )
+from .tasks import schedule_id_photo_processing, send_stk_push
+
+
+BOOKING_UNAVAILABLE_MESSAGE = "Property is not available for the selected dates."
+
+
+def is_overlap_violation(error):
+    """Whether an IntegrityError came from the booking_no_overlap constraint"""
+    # psycopg reports the constraint by name; the message is a fallback
+    diag = getattr(error.__cause__, 'diag', None)
+    constraint_name = getattr(diag, 'constraint_name', None)
+    if constraint_name:
+        return constraint_name == 'booking_no_overlap'
+    return 'booking_no_overlap' in str(error)
+
+
+def booking_unavailable_error():
+    """The same 400 body validate() returns when the property is taken"""
+    return ValidationError({
+        api_settings.NON_FIELD_ERRORS_KEY: [BOOKING_UNAVAILABLE_MESSAGE]
+    })
+
+
+class ManyPrimaryKeyRelatedField(ManyRelatedField):
+    """Looks up every primary key of the list in one query instead of one each"""
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+
+        child = self.child_relation
+        pks = [child.pk_field.to_internal_value(pk) if child.pk_field else pk for pk in data]
+        try:
+            found = {str(obj.pk): obj for obj in child.get_queryset().filter(pk__in=pks)}
+        except (TypeError, ValueError, DValidationError):
+            child.fail('incorrect_type', data_type=type(pks[0]).__name__)
+        for pk in pks:
+            if str(pk) not in found:
+                child.fail('does_not_exist', pk_value=pk)
+        return [found[str(pk)] for pk in pks]
+
+
+class BulkPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """PrimaryKeyRelatedField whose ``many=True`` form is ManyPrimaryKeyRelatedField"""
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return ManyPrimaryKeyRelatedField(**list_kwargs)
 
 
 """Dynamically get the CustomUser model"""
 CustomUser = get_user_model()
 
 
+def validate_id_photo_size(photo):
+    """
+    Reject ID photos over ID_PHOTO_MAX_UPLOAD_SIZE bytes. The upload is on
+    disk by now, see FILE_UPLOAD_HANDLERS; the rest of the processing
+    happens in core/photos.py once it is stored.
+    """
+    limit = getattr(settings, 'ID_PHOTO_MAX_UPLOAD_SIZE', 15 * 1024 * 1024)
+    if photo.size > limit:
+        raise ValidationError(f"The photo is larger than {limit // (1024 * 1024)} MB.")
+    return photo
+
+
 """
 Creating serializers for different methods of data representation for the 
 models defined in core/models.py
@@ -74,20 +145,24 @@ class CustomUserCreateSerializer(ModelSerializer):
         except DValidationError as e:
             raise ValidationError(e.messages)
         return password
+
+    def validate_id_photo(self, photo):
+        return validate_id_photo_size(photo)
     
     
     @transaction.atomic
     def create(self, validated_data):
         password = validated_data.pop('password')
         try:
-            user = CustomUser.objects.create(**validated_data)
+            user = CustomUser(**validated_data)
             user.set_password(password)
-            user.save()
+            user.save(force_insert=True)
         except IntegrityError as e:
             if 'unique constraint' in str(e).lower():
                 raise ValidationError("A user with this email or phone number already exists.")
             else:
                 raise ValidationError("An error occurred while creating the user.")
+        schedule_id_photo_processing(user.pk)
         return user
 
 
@@ -112,6 +187,9 @@ class CustomUserUpdateSerializer(ModelSerializer):
         except DValidationError as e:
             raise ValidationError(e.messages)
         return password
+
+    def validate_id_photo(self, photo):
+        return validate_id_photo_size(photo)
     
     @transaction.atomic
     def update(self, instance, validated_data):
@@ -119,6 +197,9 @@ class CustomUserUpdateSerializer(ModelSerializer):
         try:
             for attr, value in validated_data.items():
                 setattr(instance, attr, value)
+            if 'id_photo' in validated_data:
+                instance.id_photo_status = CustomUser.PhotoStatus.PENDING
+                schedule_id_photo_processing(instance.pk)
             instance.full_clean()
             instance.save()
             if password:
@@ -141,12 +222,17 @@ class CustomUserSummarySerializer(ModelSerializer):
 Used when fetching a list of properties with limited details
 """
 class PropertyListSerializer(ModelSerializer):
+    # Only present when the list is filtered with ?near=
+    distance_km = serializers.FloatField(source='distance', read_only=True)
     class Meta:
         model = Property
         fields = [
             'name',
             'description',
             'location',
+            'latitude',
+            'longitude',
+            'distance_km',
             'price_per_night',
         ]
 
@@ -163,6 +249,8 @@ class PropertyDetailSerializer(ModelSerializer):
             'name',
             'description',
             'location',
+            'latitude',
+            'longitude',
             'price_per_night',
             'created_at',
         ]
@@ -182,6 +270,46 @@ class PropertySummarySerializer(ModelSerializer):
         ]
 
 
+"""
+Used for pricing many stays at once, e.g. every property of a search result
+"""
+class QuoteItemSerializer(serializers.Serializer):
+    property = serializers.UUIDField()
+    check_in = serializers.DateField()
+    check_out = serializers.DateField()
+
+    def validate(self, data):
+        nights = (data['check_out'] - data['check_in']).days
+        if nights <= 0:
+            raise serializers.ValidationError(
+                "Check-out date must be after check-in date."
+            )
+        max_nights = getattr(settings, 'PRICING_MAX_NIGHTS', 365)
+        if nights > max_nights:
+            raise serializers.ValidationError(
+                f"Stays can be quoted for at most {max_nights} nights."
+            )
+        return data
+
+
+class QuoteRequestSerializer(serializers.Serializer):
+    items = QuoteItemSerializer(
+        many=True,
+        allow_empty=False,
+        max_length=getattr(settings, 'PRICING_MAX_QUOTES', 200),
+    )
+
+
+class QuoteSerializer(serializers.Serializer):
+    property = serializers.UUIDField(source='property_id')
+    check_in = serializers.DateField()
+    check_out = serializers.DateField()
+    nights = serializers.IntegerField()
+    subtotal = serializers.DecimalField(max_digits=12, decimal_places=2)
+    discount = serializers.DecimalField(max_digits=12, decimal_places=2)
+    total = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+
 """
 Used when fetching a list of bookings, includes nested details about the property"""
 class BookingListSerializer(ModelSerializer):
@@ -221,7 +349,7 @@ class BookingDetailSerializer(ModelSerializer):
 Used for creating new bookings, includes validation to ensure booking dates are valid and property is available
 """  
 class BookingCreateSerializer(ModelSerializer):
-    guests = serializers.PrimaryKeyRelatedField(
+    guests = BulkPrimaryKeyRelatedField(
         many=True, queryset=CustomUser.objects.all()
     )
     class Meta:
@@ -233,6 +361,8 @@ class BookingCreateSerializer(ModelSerializer):
             'check_out',
             'price_per_night',
         ]
+        # Priced from the property's rates, see core/pricing.py
+        read_only_fields = ['price_per_night']
 
     def validate(self, data):
         check_in = data.get('check_in')
@@ -250,10 +380,12 @@ class BookingCreateSerializer(ModelSerializer):
                 "Check-in date cannot be in the past."
             )
         
-        if property and not property.is_available(check_in, check_out):
-            raise serializers.ValidationError(
-                "Property is not available for the selected dates."
-            )
+        if (
+            property
+            and overlap_precheck_enabled()
+            and not property.is_available(check_in, check_out)
+        ):
+            raise serializers.ValidationError(BOOKING_UNAVAILABLE_MESSAGE)
 
         return data
     
@@ -261,18 +393,24 @@ class BookingCreateSerializer(ModelSerializer):
     def create(self, validated_data):
         guests=validated_data.pop('guests')
 
-        booking = Booking.objects.create(**validated_data)
-        booking.guests.set(guests)
-        nights = booking.get_number_of_nights()
-        booking.total_price = nights * booking.price_per_night
-        booking.save(update_fields=['total_price'])
+        booking = Booking(**validated_data)
+        booking.calculate_total_price()
+        try:
+            # Savepoint so a rejected overlap doesn't break the outer transaction
+            with transaction.atomic():
+                booking.save()
+        except IntegrityError as e:
+            if is_overlap_violation(e):
+                raise booking_unavailable_error()
+            raise
+        booking.guests.add(*guests)
         return booking
     
 
 
 # Used for updating existing bookings 
 class BookingUpdateSerializer(ModelSerializer):
-    guests = serializers.PrimaryKeyRelatedField(
+    guests = BulkPrimaryKeyRelatedField(
         many=True, queryset=CustomUser.objects.all()
     )
     class Meta:
@@ -284,7 +422,9 @@ class BookingUpdateSerializer(ModelSerializer):
             'check_out',
             'price_per_night',
         ]
-    
+        # Priced from the property's rates, see core/pricing.py
+        read_only_fields = ['price_per_night']
+
     def validate(self, data):
         check_in = data.get('check_in')
         check_out = data.get('check_out')
@@ -301,10 +441,12 @@ class BookingUpdateSerializer(ModelSerializer):
                 "Check-in date cannot be in the past."
             )
         
-        if property and not property.is_available(check_in, check_out):
-            raise serializers.ValidationError(
-                "Property is not available for the selected dates."
-            )
+        if (
+            property
+            and overlap_precheck_enabled()
+            and not property.is_available(check_in, check_out)
+        ):
+            raise serializers.ValidationError(BOOKING_UNAVAILABLE_MESSAGE)
 
         return data
 
@@ -314,18 +456,21 @@ class BookingUpdateSerializer(ModelSerializer):
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
 
-        instance.full_clean()
-        instance.save()
+        if(any(field in validated_data for field in [
+            'property', 'check_in', 'check_out'])):
+            instance.calculate_total_price()
+
+        try:
+            with transaction.atomic():
+                instance.save()
+        except IntegrityError as e:
+            if is_overlap_violation(e):
+                raise booking_unavailable_error()
+            raise
 
         if guests is not None:
             instance.guests.set(guests)
 
-        if(any(field in validated_data for field in [
-            'check_in', 'check_out', 'price_per_night'])):
-            nights = (instance.check_out - instance.check_in).days
-            instance.total_price = instance.calculate_total_price(nights)
-            instance.save(update_fields=['total_price'])
-
         return instance
     
 
@@ -371,7 +516,9 @@ We only allow creating payments ans not updating to maintain payment integrity
 """
 class PaymentCreateSerializer(ModelSerializer):
     booking = serializers.PrimaryKeyRelatedField(
-        queryset=Booking.objects.filter(status=['pending','processing'])
+        queryset=Booking.objects.filter(
+            status__in=[Booking.BookingStatus.PENDING, Booking.BookingStatus.PROCESSING]
+        )
     )
     payer = serializers.PrimaryKeyRelatedField(
         queryset=CustomUser.objects.all()
@@ -391,7 +538,7 @@ class PaymentCreateSerializer(ModelSerializer):
         amount = data.get('amount')
         payer = data.get('payer')
 
-        if payer is None or not booking.guests.filter(id=payer.id).exists():
+        if payer is None or not booking.has_guest(payer):
             raise serializers.ValidationError(
                 "Payer is required and must be a guest of the booking."
             )
@@ -401,6 +548,12 @@ class PaymentCreateSerializer(ModelSerializer):
                 "Payment amount must be greater than zero."
             )
         
+        # Mpesa only charges whole shillings
+        if amount != amount.to_integral_value():
+            raise serializers.ValidationError(
+                "Payment amount must be a whole number of shillings."
+            )
+        
         #preventing overpayment
         if amount > booking.balance_due:
             raise serializers.ValidationError(
@@ -409,15 +562,29 @@ class PaymentCreateSerializer(ModelSerializer):
 
         return data
     
-    @transaction.atomic
     def create(self, validated_data):
-        booking = (
-            Booking.objects
-            .select_for_update()
-            .get(id=validated_data['booking'].id)
-        )
-        payment = Payment.objects.create(**validated_data)
-        booking = payment.booking
-        booking.balance_due = booking.calculate_balance_due(payment.amount)
-        booking.save(update_fields=['balance_due', 'status'])
+        """
+        Commits the payment and its STK push outbox row in one short
+        transaction. The push itself is sent by a worker once it commits.
+
+        The amount comes off the booking's balance right away, so payments
+        made at the same time can't add up to more than is due; whatever
+        fails the payment later gives it back (Booking.restore_balance_due).
+        """
+        with transaction.atomic():
+            booking = (
+                Booking.objects
+                .select_for_update()
+                .get(id=validated_data['booking'].id)
+            )
+            # validate() read the balance before the row was locked
+            if validated_data['amount'] > booking.balance_due:
+                raise serializers.ValidationError(
+                    "Payment amount cannot exceed the balance due."
+                )
+            validated_data['booking'] = booking
+            payment = Payment.objects.create(**validated_data)
+            booking.calculate_balance_due(payment.amount)
+            push = StkPushRequest.objects.create(payment=payment)
+            transaction.on_commit(lambda: send_stk_push.delay(push.pk))
         return payment
@@ -1,25 +1,255 @@
-from django_daraja.mpesa.core import MpesaClient
+"""
+Daraja (Mpesa) API calls.
 
+Every process shares one ``requests.Session`` whose connection pool keeps
+the TLS connections to Safaricom alive between payments. The OAuth token
+is kept in the Django cache, so all web and worker processes reuse a
+single token, and it is refreshed a few minutes before it expires rather
+than on the request that finds it stale.
+
+A request Daraja refuses with 401 gets a new token and is sent once more.
+5xx answers raise MpesaConnectionError like network errors do, so callers
+retry them rather than taking them as a final answer.
+
+Configuration is read the same way django_daraja reads it (settings, then
+the environment). MPESA_API_BASE_URL overrides the environment's base URL,
+e.g. to point at a local simulator.
+"""
+
+import base64
+import threading
+import time
+from datetime import datetime
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django_daraja.mpesa.exceptions import MpesaConnectionError, MpesaError, MpesaInvalidParameterException
+from django_daraja.mpesa.utils import api_base_url, format_phone_number, mpesa_config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+TOKEN_CACHE_KEY = "mpesa:access-token"
+TOKEN_LOCK_KEY = "mpesa:access-token:lock"
+TOKEN_LOCK_TIMEOUT = 10
+TOKEN_LOCK_WAIT = 5
+TOKEN_POLL_INTERVAL = 0.05
+
+_session = None
+_session_lock = threading.Lock()
+
+# Process-local copy of the cached token, so most calls skip the cache too
+_local_token = None
+
+
+def _timeout():
+    """(connect, read) timeout in seconds for Daraja requests"""
+    return getattr(settings, "MPESA_HTTP_TIMEOUT", (3.05, 30))
+
+
+def _refresh_margin():
+    """Seconds before expiry at which the token is replaced"""
+    return getattr(settings, "MPESA_TOKEN_REFRESH_MARGIN", 300)
+
+
+def base_url():
+    url = getattr(settings, "MPESA_API_BASE_URL", None) or api_base_url()
+    return url if url.endswith("/") else url + "/"
+
+
+def session():
+    """The process-wide pooled session for Daraja requests"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                pool_size = getattr(settings, "MPESA_HTTP_POOL_SIZE", 10)
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=pool_size,
+                    # Only retry failures to connect; a POST that reached
+                    # Safaricom must not be sent twice
+                    max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2),
+                )
+                new_session = requests.Session()
+                new_session.mount("https://", adapter)
+                new_session.mount("http://", adapter)
+                _session = new_session
+    return _session
+
+
+def reset_session():
+    """Drop the pooled session, e.g. after changing MPESA_HTTP_POOL_SIZE"""
+    global _session
+    with _session_lock:
+        old, _session = _session, None
+    if old is not None:
+        old.close()
+
+
+def _token_key():
+    # Tokens are only good for the server that issued them
+    return f"{TOKEN_CACHE_KEY}:{base_url()}"
+
+
+def _fresh(token):
+    return (
+        token is not None
+        and token["url"] == base_url()
+        and token["expires"] - _refresh_margin() > time.time()
+    )
+
+
+def _request_token():
+    try:
+        response = session().get(
+            base_url() + "oauth/v1/generate",
+            params={"grant_type": "client_credentials"},
+            auth=(mpesa_config("MPESA_CONSUMER_KEY"), mpesa_config("MPESA_CONSUMER_SECRET")),
+            timeout=_timeout(),
+        )
+    except requests.RequestException as error:
+        raise MpesaConnectionError(str(error))
+    if response.status_code >= 500:
+        raise MpesaConnectionError(f"Unable to generate access token ({response.status_code})")
+    if response.status_code != 200:
+        raise MpesaError("Unable to generate access token")
+
+    body = response.json()
+    expires_in = int(body.get("expires_in", 3599))
+    return {"token": body["access_token"], "expires": time.time() + expires_in, "url": base_url()}
+
+
+def access_token():
+    """
+    A valid OAuth token, shared through the cache by every process.
+
+    Only one process fetches a new token at a time; others keep using the
+    current one while it's still valid, or wait briefly for the new one.
+    """
+    global _local_token
+    if _fresh(_local_token):
+        return _local_token["token"]
+
+    token = cache.get(_token_key())
+    if not _fresh(token):
+        lock_key = f"{TOKEN_LOCK_KEY}:{base_url()}"
+        if cache.add(lock_key, 1, timeout=TOKEN_LOCK_TIMEOUT):
+            try:
+                token = _request_token()
+                cache.set(_token_key(), token, timeout=max(int(token["expires"] - time.time()), 1))
+            finally:
+                cache.delete(lock_key)
+        elif token is None or token["expires"] <= time.time():
+            deadline = time.time() + TOKEN_LOCK_WAIT
+            while not _fresh(token) and time.time() < deadline:
+                time.sleep(TOKEN_POLL_INTERVAL)
+                token = cache.get(_token_key())
+            if token is None:
+                token = _request_token()
+
+    _local_token = token
+    return token["token"]
+
+
+def forget_token(token):
+    """Drop ``token`` after Daraja refused it, unless it was replaced already"""
+    global _local_token
+    if _local_token is not None and _local_token["token"] == token:
+        _local_token = None
+    cached = cache.get(_token_key())
+    if cached is not None and cached["token"] == token:
+        cache.delete(_token_key())
+
+
+def _post(path, payload, reauthenticate=True):
+    token = access_token()
+    try:
+        response = session().post(
+            base_url() + path,
+            json=payload,
+            headers={"Authorization": "Bearer " + token},
+            timeout=_timeout(),
+        )
+    except requests.RequestException as error:
+        raise MpesaConnectionError(str(error))
+    if response.status_code == 401 and reauthenticate:
+        # Revoked or expired early; the request wasn't acted on
+        forget_token(token)
+        return _post(path, payload, reauthenticate=False)
+    if response.status_code >= 500:
+        raise MpesaConnectionError(f"Daraja answered {response.status_code}: {response.text[:200]}")
+    try:
+        return response.json()
+    except ValueError:
+        raise MpesaError(f"Unexpected Daraja response ({response.status_code})")
+
+
+def _shortcode():
+    if mpesa_config("MPESA_ENVIRONMENT") == "sandbox":
+        return str(mpesa_config("MPESA_EXPRESS_SHORTCODE"))
+    return str(mpesa_config("MPESA_SHORTCODE"))
+
+
+def _password(shortcode, timestamp):
+    raw = shortcode + mpesa_config("MPESA_PASSKEY") + timestamp
+    return base64.b64encode(raw.encode("ascii")).decode("utf-8")
+
+
+def stk_push(phone_number, amount, account_reference, transaction_desc, callback_url):
+    """Start an STK push; returns Daraja's JSON response as a dict"""
+    # Daraja only takes whole shillings, and rounding would charge another amount
+    if amount != int(amount):
+        raise MpesaInvalidParameterException(f"Amount must be whole shillings, not {amount}")
+    shortcode = _shortcode()
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    phone_number = format_phone_number(phone_number)
+    return _post("mpesa/stkpush/v1/processrequest", {
+        "BusinessShortCode": shortcode,
+        "Password": _password(shortcode, timestamp),
+        "Timestamp": timestamp,
+        "TransactionType": "CustomerPayBillOnline",
+        "Amount": int(amount),
+        "PartyA": phone_number,
+        "PartyB": shortcode,
+        "PhoneNumber": phone_number,
+        "CallBackURL": callback_url,
+        "AccountReference": account_reference,
+        "TransactionDesc": transaction_desc,
+    })
+
+
+def stk_query(checkout_request_id):
+    """Status of an STK push; returns Daraja's JSON response as a dict"""
+    shortcode = _shortcode()
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    return _post("mpesa/stkpushquery/v1/query", {
+        "BusinessShortCode": shortcode,
+        "Password": _password(shortcode, timestamp),
+        "Timestamp": timestamp,
+        "CheckoutRequestID": checkout_request_id,
+    })
 
 
 class MpesaService:
-    def __init__(self, phone_number: str, amount: int):
+    def __init__(self, phone_number: str, amount, reference: str = 'nexus'):
         self.phone_number = phone_number
         self.amount = amount
-        self.client = MpesaClient()
+        self.reference = reference
 
     def initiate_stk_push(self):
-        account_reference = 'nexus'
-        transaction_desc='booking payment'
-        callback_url='https://nexus-qura.onrender.com/mpesa/callback'#TODO: add callback url
-        response = self.cl.stk_push(
-            self, 
+        transaction_desc = 'booking payment'
+        callback_url = getattr(
+            settings,
+            'MPESA_CALLBACK_URL',
+            'https://nexus-qura.onrender.com/api/payments/mpesa/callback/',
+        )
+        return stk_push(
             self.phone_number,
             self.amount,
-            account_reference,
+            # Daraja caps the account reference at 12 characters
+            self.reference[:12],
             transaction_desc,
-            callback_url
-            )
-        return response 
-        
-    
+            callback_url,
+        )
@@ -0,0 +1,132 @@
+"""
+Signal handlers that keep derived data in sync with the models
+defined in core/models.py.
+"""
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.utils import timezone
+from django.dispatch import receiver
+
+from . import availability, pricing
+from .auth_backends import forget_unknown
+from .authentication import forget_token_version
+from .caching import bump_generation
+from .models import CustomUser, LengthOfStayDiscount, Property, Booking, RateRule
+
+
+# Booking fields that decide which nights a booking holds
+AVAILABILITY_FIELDS = {'property', 'check_in', 'check_out', 'status'}
+
+
+def _bump_availability(booking, property_ids):
+    # After the booking is written, in its transaction when there is one,
+    # so no process can build the entry of the new version without it
+    availability.bump_version(*property_ids)
+    if Booking.property.is_cached(booking):
+        # Reloaded on next access, so a later check through this instance
+        # doesn't read the entry of the old version
+        booking.property.__dict__.pop('availability_version', None)
+
+
+@receiver(post_save, sender=Booking)
+def update_availability_on_save(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and not instance.changes_nights(update_fields):
+        return
+
+    property_ids = {instance.property_id}
+    loaded_property_id = None if created else getattr(instance, '_loaded_property_id', None)
+    if loaded_property_id is not None:
+        property_ids.add(loaded_property_id)
+    _bump_availability(instance, property_ids)
+
+
+@receiver(post_delete, sender=Booking)
+def update_availability_on_delete(sender, instance, **kwargs):
+    _bump_availability(instance, {instance.property_id})
+
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+def invalidate_availability_responses(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not AVAILABILITY_FIELDS & set(update_fields):
+        return
+    transaction.on_commit(lambda: bump_generation('booking'))
+
+
+@receiver(post_save, sender=Property)
+@receiver(post_delete, sender=Property)
+def invalidate_property_responses(sender, instance, **kwargs):
+    names = ['property', f'property:{instance.pk}']
+    transaction.on_commit(lambda: bump_generation(*names))
+
+
+@receiver(post_save, sender=RateRule)
+@receiver(post_delete, sender=RateRule)
+@receiver(post_save, sender=LengthOfStayDiscount)
+@receiver(post_delete, sender=LengthOfStayDiscount)
+def bump_property_pricing(sender, instance, **kwargs):
+    # In the same transaction as the change, so no process can read the
+    # new rules under the old version
+    pricing.bump_version(instance.property_id)
+
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_owner_responses(sender, instance, created, **kwargs):
+    # Property responses embed the owner's CustomUserSummarySerializer
+    loaded = getattr(instance, '_loaded_summary', None)
+    instance._loaded_summary = (instance.name, instance.role)
+    if created or loaded is None or loaded == instance._loaded_summary:
+        return
+
+    def invalidate():
+        property_ids = Property.objects.filter(owner=instance).values_list('pk', flat=True)
+        names = ['property', *[f'property:{pk}' for pk in property_ids]]
+        bump_generation(*names)
+
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_save, sender=CustomUser)
+def revoke_outdated_tokens(sender, instance, **kwargs):
+    # CustomUser.save bumped token_version; tokens carrying the old one
+    # must stop passing core/authentication.py
+    if not getattr(instance, '_token_version_changed', False):
+        return
+    instance._token_version_changed = False
+    user_id = instance.pk
+    transaction.on_commit(lambda: forget_token_version(user_id))
+
+
+@receiver(post_save, sender=CustomUser)
+def forget_unknown_logins(sender, instance, created, update_fields=None, **kwargs):
+    # Logins with these were cached as matching nobody by core/auth_backends.py
+    if not created and update_fields is not None and 'phone_number' not in update_fields:
+        return
+    identifiers = (instance.pk, instance.phone_number)
+    transaction.on_commit(lambda: forget_unknown(*identifiers))
+
+
+@receiver(post_delete, sender=CustomUser)
+def revoke_deleted_user_tokens(sender, instance, **kwargs):
+    user_id = instance.pk
+    transaction.on_commit(lambda: forget_token_version(user_id))
+
+
+@receiver(m2m_changed, sender=Booking.guests.through)
+def touch_booking_on_guests_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # Booking ETags include the guest list, which doesn't go through save()
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            Booking.objects.filter(pk=instance.pk).update(updated_at=timezone.now())
+        return
+
+    # Changed from the guest's side: a clear doesn't pass the bookings it
+    # removes, so touch them before they're gone
+    if action == 'pre_clear':
+        bookings = Booking.objects.with_guest(instance)
+    elif action in ('post_add', 'post_remove'):
+        bookings = Booking.objects.filter(pk__in=pk_set)
+    else:
+        return
+    bookings.update(updated_at=timezone.now())
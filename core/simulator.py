@@ -0,0 +1,252 @@
+"""
+A local stand-in for the Daraja API, for tests and benchmarks.
+
+    with DarajaSimulator(latency=0.1, callback_delay=1, failure_rate=0.1) as daraja:
+        with override_settings(**daraja.settings()):
+            ...
+
+It issues OAuth tokens, accepts STK pushes and answers status queries.
+Every accepted push gets its callback POSTed to the push's CallBackURL
+after ``callback_delay`` seconds, failed (ResultCode 1032) with
+probability ``failure_rate`` and sent twice with probability
+``duplicate_rate``, like Daraja's own retries. The outcome of a push is
+kept in ``results`` (CheckoutRequestID to ResultCode), which status
+queries read; pushes with no entry are reported as still in progress.
+
+Run it standalone with ``python manage.py daraja_simulator``.
+"""
+
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from .benchmarks import summarize
+
+
+PENDING_RESPONSE = {
+    "errorCode": "500.001.1001",
+    "errorMessage": "The transaction is being processed",
+}
+
+
+class DarajaRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as separate writes; without this, delayed
+    # ACKs add ~40 ms to every keep-alive response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def simulator(self):
+        return self.server.simulator
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def authorized(self):
+        if self.headers.get("Authorization") == f"Bearer {self.simulator.token}":
+            return True
+        self.send_json({"errorCode": "404.001.03", "errorMessage": "Invalid Access Token"}, 401)
+        return False
+
+    def do_GET(self):
+        if self.path.startswith("/oauth/v1/generate"):
+            self.simulator.record("token")
+            self.send_json({"access_token": self.simulator.token, "expires_in": "3599"})
+        else:
+            self.send_json({"errorMessage": "Not found"}, 404)
+
+    def do_POST(self):
+        body = self.read_json()
+        if not self.authorized():
+            return
+        handler = self.simulator.routes.get(self.path.split("?")[0])
+        if handler is None:
+            self.send_json({"errorMessage": "Not found"}, 404)
+            return
+        time.sleep(self.simulator.latency)
+        self.send_json(handler(body))
+
+
+class DarajaSimulator:
+    """
+    Fake Daraja server on a background thread.
+
+    - ``latency`` is added to every API call, in seconds
+    - ``callback_delay`` is how long after a push its callback is sent
+    - ``failure_rate`` and ``duplicate_rate`` are probabilities per push
+    - ``results`` maps CheckoutRequestIDs to the ResultCode status queries
+      return
+    - ``calls`` counts requests per endpoint, and ``callback_latencies``
+      holds the seconds from each push to its callback being acknowledged
+    """
+    token = "simulated-access-token"
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, callback_delay=0.0,
+                 failure_rate=0.0, duplicate_rate=0.0, callback_workers=16, seed=None):
+        self.latency = latency
+        self.callback_delay = callback_delay
+        self.failure_rate = failure_rate
+        self.duplicate_rate = duplicate_rate
+        self.results = {}
+        self.calls = {}
+        self.callback_latencies = []
+        self.callback_errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._callbacks = ThreadPoolExecutor(max_workers=callback_workers)
+        self._callback_session = requests.Session()
+        self._pending_callbacks = 0
+        self._idle = threading.Condition(self._lock)
+        self.routes = {
+            "/mpesa/stkpush/v1/processrequest": self.stk_push,
+            "/mpesa/stkpushquery/v1/query": self.stk_query,
+        }
+        self.server = ThreadingHTTPServer((host, port), DarajaRequestHandler)
+        self.server.daemon_threads = True
+        self.server.simulator = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def settings(self):
+        """Settings overrides that point core.service at this server"""
+        return {
+            "MPESA_API_BASE_URL": self.url,
+            "MPESA_ENVIRONMENT": "sandbox",
+            "MPESA_CONSUMER_KEY": "simulator",
+            "MPESA_CONSUMER_SECRET": "simulator",
+            "MPESA_PASSKEY": "simulator",
+            "MPESA_EXPRESS_SHORTCODE": "174379",
+            "MPESA_SHORTCODE": "174379",
+        }
+
+    def record(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._callbacks.shutdown(wait=False, cancel_futures=True)
+        self._callback_session.close()
+
+    def wait_for_callbacks(self, timeout=None):
+        """Block until every scheduled callback has been sent; False on timeout"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending_callbacks == 0, timeout)
+
+    def stats(self):
+        """Call counts plus the push-to-acknowledged-callback latency summary"""
+        with self._lock:
+            return {
+                "calls": dict(self.calls),
+                "callback_errors": self.callback_errors,
+                "callback_latency": summarize(list(self.callback_latencies)),
+            }
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stk_push(self, body):
+        self.record("stk_push")
+        checkout_id = f"ws_CO_sim_{uuid.uuid4().hex}"
+        merchant_id = f"sim-{uuid.uuid4().hex[:12]}"
+        with self._lock:
+            failed = self._random.random() < self.failure_rate
+            copies = 2 if self._random.random() < self.duplicate_rate else 1
+            self._pending_callbacks += copies
+        result_code = 1032 if failed else 0
+        self.results[checkout_id] = result_code
+
+        callback = {"Body": {"stkCallback": {
+            "MerchantRequestID": merchant_id,
+            "CheckoutRequestID": checkout_id,
+            "ResultCode": result_code,
+            "ResultDesc": (
+                "Request cancelled by user" if failed
+                else "The service request is processed successfully."
+            ),
+        }}}
+        if not failed:
+            callback["Body"]["stkCallback"]["CallbackMetadata"] = {"Item": [
+                {"Name": "Amount", "Value": body.get("Amount")},
+                {"Name": "MpesaReceiptNumber", "Value": f"SIM{uuid.uuid4().hex[:7].upper()}"},
+                {"Name": "TransactionDate", "Value": int(time.strftime("%Y%m%d%H%M%S"))},
+                {"Name": "PhoneNumber", "Value": body.get("PhoneNumber")},
+            ]}
+
+        pushed_at = time.perf_counter()
+        for _ in range(copies):
+            self._callbacks.submit(self._send_callback, body.get("CallBackURL"), callback, pushed_at)
+
+        return {
+            "MerchantRequestID": merchant_id,
+            "CheckoutRequestID": checkout_id,
+            "ResponseCode": "0",
+            "ResponseDescription": "Success. Request accepted for processing",
+            "CustomerMessage": "Success. Request accepted for processing",
+        }
+
+    def _send_callback(self, url, callback, pushed_at):
+        try:
+            delay = self.callback_delay - (time.perf_counter() - pushed_at)
+            if delay > 0:
+                time.sleep(delay)
+            response = self._callback_session.post(url, json=callback, timeout=30)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        with self._lock:
+            if ok:
+                self.callback_latencies.append(time.perf_counter() - pushed_at)
+            else:
+                self.callback_errors += 1
+            self._pending_callbacks -= 1
+            self._idle.notify_all()
+
+    def stk_query(self, body):
+        self.record("stk_query")
+        checkout_id = body.get("CheckoutRequestID")
+        result_code = self.results.get(checkout_id)
+        if result_code is None:
+            return PENDING_RESPONSE
+        return {
+            "ResponseCode": "0",
+            "ResponseDescription": "The service request has been accepted successsfully",
+            "MerchantRequestID": f"sim-{checkout_id}",
+            "CheckoutRequestID": checkout_id,
+            "ResultCode": str(result_code),
+            "ResultDesc": (
+                "The service request is processed successfully."
+                if str(result_code) == "0" else "Request cancelled by user"
+            ),
+        }
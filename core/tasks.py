@@ -1,45 +1,337 @@
+import smtplib
+from datetime import timedelta
+
 from celery import shared_task
-from django.core.mail import send_mail
-from .models import Payment
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django_daraja.mpesa.exceptions import (
+    IllegalPhoneNumberException,
+    MpesaConnectionError,
+    MpesaError,
+    MpesaInvalidParameterException,
+)
+from .events import publish_payment_status
+from .models import Booking, MpesaCallback, Payment, ScheduledTask, StkPushRequest
+from .notifications import deliver_pending, payment_confirmation_email, queue_emails, retry_delay
+from .photos import process_id_photo as process_photo
+from .reconciliation import reconcile_stale_payments
+from .service import MpesaService
 
-@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=5, retry_kwargs={"max_retries": 3})
-def process_mpesa_callback(self, callback_data):
-    stk = callback_data["Body"]["stkCallback"]
 
-    payment = Payment.objects.get(
-        checkout_request_id=stk["CheckoutRequestID"]# Since checkoutrequestid is unique
-    )
+DRAIN_SCHEDULE = "mpesa:callbacks:drain"
+EMAIL_SCHEDULE = "notifications:email:delivery"
+RECONCILE_LOCK_KEY = "mpesa:reconcile:running"
+RECONCILE_LOCK_TIMEOUT = 60 * 15
+
 
-    if stk["ResultCode"] != 0:
-        payment.status = Payment.Status.FAILED
-        return {
-                "ResultCode": stk["ResultCode"],
-                "mpesa_ref": None
-            }
+def _callback_result(stk):
+    """The payment fields an stkCallback sets, as (status, receipt, amount)"""
+    if int(stk["ResultCode"]) != 0:
+        return Payment.Status.FAILED, "", None
 
     metadata = {
         item["Name"]: item.get("Value")
-        for item in stk["CallbackMetadata"]["Item"]
+        for item in stk.get("CallbackMetadata", {}).get("Item", [])
     }
+    return (
+        Payment.Status.SUCCESSFUL,
+        str(metadata.get("MpesaReceiptNumber") or ""),
+        metadata.get("Amount"),
+    )
+
 
-    receipt = metadata.get("MpesaReceiptNumber")
-    amount = metadata.get("Amount")
+def _batch_size():
+    return getattr(settings, "MPESA_CALLBACK_BATCH_SIZE", 500)
 
 
-    payment.status = Payment.Status.SUCCESSFUL
-    payment.mpesa_ref = receipt
+def _unmatched_timeout():
+    """How long a callback waits for a payment with its CheckoutRequestID, in seconds"""
+    return getattr(settings, "MPESA_CALLBACK_UNMATCHED_TIMEOUT", 60 * 10)
 
-    payment.save(update_fields=["status", "mpesa_ref"])
 
-    send_mail(
-        subject=f"Payment Confirmation for Booking: {payment.booking__id}",
-        message=f"Payment of KES {amount} received. Receipt: {receipt}",
-        from_email=None,
-        recipient_list=[payment.payer.email],
-        fail_silently=False,
+def claim_schedule(name, delay):
+    """
+    Whether the caller should queue a run of the task ``name``; False while
+    one is already queued. The flag is a ScheduledTask row, so it holds
+    across processes. A claim older than ``delay`` plus 30 seconds is taken
+    over, in case its task was lost.
+    """
+    now = timezone.now()
+    expired = now - timedelta(seconds=delay + 30)
+    claimed = (
+        ScheduledTask.objects
+        .filter(Q(queued_at__isnull=True) | Q(queued_at__lt=expired), name=name)
+        .update(queued_at=now)
     )
+    if claimed:
+        return True
+    # The first run of the task has no row yet
+    _, created = ScheduledTask.objects.get_or_create(name=name, defaults={"queued_at": now})
+    return created
+
+
+def release_schedule(name):
+    """Called by a debounced task as it starts, so later work queues a new run"""
+    ScheduledTask.objects.filter(name=name).update(queued_at=None)
+
+
+def schedule_callback_drain():
+    """
+    Queue a drain of the callback inbox unless one is already waiting.
+
+    Callbacks arriving within MPESA_CALLBACK_DRAIN_DELAY of each other
+    share a single drain instead of queueing one task each.
+    """
+    delay = getattr(settings, "MPESA_CALLBACK_DRAIN_DELAY", 1)
+    if claim_schedule(DRAIN_SCHEDULE, delay):
+        drain_mpesa_callbacks.apply_async(countdown=delay)
+
+
+def _apply_callbacks(callbacks):
+    """
+    Apply one batch of pending callbacks. Returns how many payments changed
+    and how many callbacks are done with.
+
+    A callback can arrive before send_stk_push has stored its
+    CheckoutRequestID on the payment. One that matches no payment stays
+    pending for MPESA_CALLBACK_UNMATCHED_TIMEOUT, and send_stk_push queues
+    a drain when it stores an ID that has a callback waiting.
+    """
+    results = {}
+    done = []
+    for callback in callbacks:
+        try:
+            results[callback.checkout_request_id] = _callback_result(
+                callback.payload["Body"]["stkCallback"]
+            )
+        except (KeyError, TypeError, ValueError):
+            # Malformed; marked processed so it can't block the inbox
+            done.append(callback.pk)
+    payments = list(
+        Payment.objects
+        .select_for_update(of=("self",))
+        .select_related("payer", "booking")
+        .filter(checkout_request_id__in=results)
+    )
+    matched = {payment.checkout_request_id for payment in payments}
+    # Payments reconcile_payments already settled are left as they are
+    payments = [payment for payment in payments if payment.status == Payment.Status.PROCESSING]
+
+    now = timezone.now()
+    confirmed = []
+    for payment in payments:
+        status, receipt, amount = results[payment.checkout_request_id]
+        payment.status = status
+        payment.mpesa_ref = receipt
+        payment.updated_at = now
+        if status == Payment.Status.SUCCESSFUL:
+            confirmed.append((payment, amount))
+
+    Payment.objects.bulk_update(payments, ["status", "mpesa_ref", "updated_at"])
+    Booking.objects.restore_balances(payment for payment in payments if payment.status == Payment.Status.FAILED)
+    publish_payment_status(payments)
+
+    expired = now - timedelta(seconds=_unmatched_timeout())
+    done += [
+        callback.pk
+        for callback in callbacks
+        if callback.checkout_request_id in matched
+        or (callback.checkout_request_id in results and callback.received_at < expired)
+    ]
+    MpesaCallback.objects.filter(pk__in=done).update(processed_at=now)
+
+    if queue_emails(payment_confirmation_email(payment, amount) for payment, amount in confirmed):
+        transaction.on_commit(schedule_email_delivery)
+    return len(payments), len(done)
+
+
+@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=5, retry_kwargs={"max_retries": 3})
+def drain_mpesa_callbacks(self):
+    """
+    Apply every pending Mpesa callback to its payment, a batch at a time.
+
+    Each batch is locked with SKIP LOCKED, so concurrent drains split the
+    inbox between them rather than waiting on or repeating each other.
+    """
+    # Cleared before reading, so a callback stored from here on queues a
+    # new drain rather than relying on this one to see it
+    release_schedule(DRAIN_SCHEDULE)
+
+    processed = updated = 0
+    last = None
+    while True:
+        with transaction.atomic():
+            pending = (
+                MpesaCallback.objects
+                .select_for_update(skip_locked=True)
+                .filter(processed_at__isnull=True)
+            )
+            if last is not None:
+                # Past the unmatched callbacks earlier batches left pending
+                pending = pending.filter(
+                    Q(received_at__gt=last.received_at) | Q(received_at=last.received_at, pk__gt=last.pk)
+                )
+            callbacks = list(pending.order_by("received_at", "pk")[:_batch_size()])
+            if not callbacks:
+                break
+            changed, done = _apply_callbacks(callbacks)
+            updated += changed
+            processed += done
+            last = callbacks[-1]
+
+    return {"callbacks": processed, "payments": updated}
+
+
+def schedule_email_delivery():
+    """
+    Queue a delivery run unless one is already waiting.
+
+    Emails queued within EMAIL_NOTIFICATION_DELAY seconds of each other go
+    out in the same run, which bounds both the wait and the batch count.
+    """
+    delay = getattr(settings, "EMAIL_NOTIFICATION_DELAY", 2)
+    if claim_schedule(EMAIL_SCHEDULE, delay):
+        send_email_notifications.apply_async(countdown=delay)
+
+
+@shared_task(bind=True, max_retries=5)
+def send_email_notifications(self):
+    """Deliver the email outbox; routed to the notifications queue"""
+    # Cleared before reading, like the callback drain
+    release_schedule(EMAIL_SCHEDULE)
+
+    countdown = retry_delay() * 2 ** self.request.retries
+    try:
+        sent, failed = deliver_pending()
+    except (OSError, smtplib.SMTPException) as error:
+        # Couldn't connect at all; nothing was claimed
+        raise self.retry(exc=error, countdown=countdown)
+    if failed:
+        # Whatever is left goes out on the retry, with a growing delay
+        raise self.retry(countdown=countdown)
+    return {"sent": sent, "failed": failed}
+
+
+def _claim_timeout():
+    """How long a worker owns an STK push it has claimed, in seconds"""
+    return getattr(settings, "STK_PUSH_CLAIM_TIMEOUT", 60)
+
+
+@shared_task(bind=True, max_retries=3)
+def send_stk_push(self, push_id):
+    """
+    Send the STK push for a queued payment and record its CheckoutRequestID.
+
+    The row is claimed with a conditional UPDATE and the HTTP call runs
+    with no transaction open, so neither the payment nor its booking stay
+    locked while Daraja answers.
+    """
+    now = timezone.now()
+    claimed = (
+        StkPushRequest.objects
+        .filter(pk=push_id, sent_at__isnull=True)
+        .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lt=now))
+        .update(claimed_until=now + timedelta(seconds=_claim_timeout()), attempts=F("attempts") + 1)
+    )
+    if not claimed:
+        # Already sent, or another worker is sending it
+        return None
+
+    push = StkPushRequest.objects.select_related("payment__payer").get(pk=push_id)
+    payment = push.payment
+    try:
+        response = MpesaService(
+            phone_number=payment.payer.phone_number,
+            amount=payment.amount,
+            reference=str(payment.id),
+        ).initiate_stk_push()
+    except MpesaConnectionError as error:
+        StkPushRequest.objects.filter(pk=push_id).update(
+            claimed_until=None, last_error=str(error)[:1000],
+        )
+        if push.attempts < getattr(settings, "STK_PUSH_MAX_ATTEMPTS", 3):
+            raise self.retry(exc=error, countdown=2 ** push.attempts)
+        response = {"errorMessage": str(error)}
+    except (MpesaError, MpesaInvalidParameterException, IllegalPhoneNumberException) as error:
+        response = {"errorMessage": str(error)}
+
+    checkout_id = response.get("CheckoutRequestID")
+    now = timezone.now()
+    with transaction.atomic():
+        StkPushRequest.objects.filter(pk=push_id).update(
+            sent_at=now,
+            claimed_until=None,
+            response=response,
+            last_error="" if checkout_id else str(response.get("errorMessage", response))[:1000],
+        )
+        if checkout_id:
+            Payment.objects.filter(pk=payment.pk).update(
+                checkout_request_id=checkout_id, updated_at=now,
+            )
+            # Its callback came in before the ID was stored and is waiting
+            if MpesaCallback.objects.filter(checkout_request_id=checkout_id, processed_at__isnull=True).exists():
+                transaction.on_commit(schedule_callback_drain)
+        else:
+            # Daraja turned the push down; nothing will call back for it
+            failed = Payment.objects.filter(pk=payment.pk, status=Payment.Status.PROCESSING).update(
+                status=Payment.Status.FAILED, updated_at=now,
+            )
+            if failed:
+                Booking.objects.restore_balances([payment])
+                publish_payment_status(Payment.objects.select_related("booking").filter(pk=payment.pk))
+
+    return {"payment_id": str(payment.pk), "checkout_request_id": checkout_id}
+
+
+@shared_task
+def dispatch_pending_stk_pushes():
+    """Re-queue STK pushes whose task was lost, e.g. while the broker was down"""
+    stale = timezone.now() - timedelta(seconds=_claim_timeout())
+    push_ids = list(
+        StkPushRequest.objects
+        .filter(sent_at__isnull=True, created_at__lt=stale)
+        .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lt=timezone.now()))
+        .values_list("pk", flat=True)[:500]
+    )
+    for push_id in push_ids:
+        send_stk_push.delay(push_id)
+    return len(push_ids)
+
+
+@shared_task
+def reconcile_payments():
+    """
+    Settle payments stuck in PROCESSING by asking Daraja for their status.
+    Scheduled by celery beat; overlapping runs are skipped.
+    """
+    if not cache.add(RECONCILE_LOCK_KEY, 1, timeout=RECONCILE_LOCK_TIMEOUT):
+        return None
+    try:
+        metrics = reconcile_stale_payments()
+    finally:
+        cache.delete(RECONCILE_LOCK_KEY)
+
+    if metrics["successful"]:
+        schedule_email_delivery()
+    return metrics
+
+
+@shared_task(bind=True, max_retries=3)
+def process_id_photo(self, user_id):
+    """
+    Validate, downscale and strip a newly stored ID photo and thumbnail it,
+    see core/photos.py. Routed to the media queue.
+    """
+    try:
+        return process_photo(user_id)
+    except OSError as error:
+        # Storage unreachable; the photo stays pending until a retry works
+        raise self.retry(exc=error, countdown=30 * 2 ** self.request.retries)
+
 
-    return {
-                "ResultCode": 0,
-                "mpesa_ref": receipt
-            }
\ No newline at end of file
+def schedule_id_photo_processing(user_id):
+    """Process the user's ID photo once the transaction storing it commits"""
+    transaction.on_commit(lambda: process_id_photo.delay(user_id))
@@ -1,3 +1,1540 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import smtplib
+import tempfile
+import unittest
+from base64 import urlsafe_b64encode
+from datetime import date, timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
+from uuid import UUID
 
-# Create your tests here.
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.mail.backends import locmem
+from django.db import connection
+from django.test import AsyncClient, TestCase, modify_settings, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_daraja.mpesa.exceptions import MpesaConnectionError, MpesaInvalidParameterException
+from PIL import Image
+import requests
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from . import availability, caching, events, geo, pricing, service, tasks
+from .authentication import access_token_for
+from .filters import PropertyFilter, PropertySearchFilter
+from .models import (
+    Booking, CustomUser, EmailNotification, LengthOfStayDiscount, MpesaCallback, Payment, Property,
+    RateRule, ScheduledTask, StkPushRequest,
+)
+from .pagination import BookingCursorPagination, PaymentCursorPagination
+from .photos import process_id_photo
+from .notifications import deliver_pending, queue_emails
+from .pricing import quote_many
+from .querycount import QueryBudgetExceeded, QueryRecorder, sql_shape
+from .serializers import BOOKING_UNAVAILABLE_MESSAGE
+from .simulator import DarajaSimulator
+from .views import BookingViewSet, PaymentViewSet, PropertyViewSet
+
+
+def view_queryset(viewset_class, user):
+    """The queryset a viewset would list for ``user``"""
+    view = viewset_class()
+    view.request = SimpleNamespace(user=user)
+    view.action = 'list'
+    return view.get_queryset()
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'EXPLAIN checks need PostgreSQL')
+class QueryPlanTests(TestCase):
+    """
+    Runs EXPLAIN on the hot Booking and Payment access paths and fails if
+    any of them has to scan a whole table.
+
+    Sequential scans are disabled for the session, so the planner only
+    falls back to one when no index can serve the query.
+    """
+    checked_tables = ['core_booking', 'core_payment', 'core_booking_guests']
+
+    @classmethod
+    def setUpTestData(cls):
+        def user(index, role):
+            return CustomUser(
+                id=f'{role}-{index}',
+                name=f'{role} {index}',
+                phone_number=f'+2547{role[0]}{index:07d}',
+                id_photo='users/photos/test.jpg',
+                role=role,
+            )
+
+        hosts = CustomUser.objects.bulk_create([user(i, 'host') for i in range(20)])
+        guests = CustomUser.objects.bulk_create([user(i, 'guest') for i in range(200)])
+        cls.admin = CustomUser.objects.create(
+            id='admin', name='admin', phone_number='+254700000000',
+            id_photo='users/photos/test.jpg', role='admin',
+        )
+        cls.host, cls.guest = hosts[0], guests[0]
+
+        properties = Property.objects.bulk_create([
+            Property(
+                owner=hosts[i % len(hosts)], name=f'Property {i}', description='',
+                location='Nairobi', amenities='', price_per_night=100,
+            )
+            for i in range(100)
+        ])
+        cls.property = properties[0]
+
+        start = date.today()
+        bookings = Booking.objects.bulk_create([
+            Booking(
+                property=properties[i % len(properties)],
+                check_in=start + timedelta(days=(i // len(properties)) * 3),
+                check_out=start + timedelta(days=(i // len(properties)) * 3 + 2),
+                price_per_night=100, total_price=200, balance_due=200,
+            )
+            for i in range(5000)
+        ])
+        Booking.guests.through.objects.bulk_create([
+            Booking.guests.through(booking=booking, customuser=guests[i % len(guests)])
+            for i, booking in enumerate(bookings)
+        ])
+        Payment.objects.bulk_create([
+            Payment(
+                booking=booking, payer=guests[i % len(guests)], amount=100,
+                payment_method='mpesa', checkout_request_id=f'ws_CO_{i}',
+            )
+            for i, booking in enumerate(bookings)
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+
+    def assertNoSeqScan(self, queryset):
+        plan = queryset.explain()
+        for table in self.checked_tables:
+            self.assertNotIn(f'Seq Scan on {table} ', plan + ' ', plan)
+
+    def test_overlap_check(self):
+        check_in = date.today() + timedelta(days=30)
+        self.assertNoSeqScan(
+            Booking.objects.filter(
+                property=self.property,
+                check_in__lt=check_in + timedelta(days=3),
+                check_out__gt=check_in,
+            ).exclude(status=Booking.BookingStatus.CANCELED)
+        )
+
+    def test_availability_index_rebuild(self):
+        self.assertNoSeqScan(
+            Booking.objects.filter(property_id__in=[self.property.pk])
+            .exclude(status=Booking.BookingStatus.CANCELED)
+            .values_list('property_id', 'check_in', 'check_out')
+        )
+
+    def test_available_properties_filter(self):
+        check_in = date.today() + timedelta(days=30)
+        queryset = PropertyFilter(
+            {'check_in': check_in, 'check_out': check_in + timedelta(days=3)},
+            queryset=Property.objects.all(),
+        ).qs
+        self.assertNoSeqScan(queryset[:20])
+
+    def test_booking_list_admin(self):
+        self.assertNoSeqScan(view_queryset(BookingViewSet, self.admin)[:20])
+
+    def test_booking_list_host(self):
+        self.assertNoSeqScan(view_queryset(BookingViewSet, self.host)[:20])
+
+    def test_booking_list_guest(self):
+        self.assertNoSeqScan(view_queryset(BookingViewSet, self.guest)[:20])
+
+    def test_booking_status_filter(self):
+        self.assertNoSeqScan(Booking.objects.filter(status=Booking.BookingStatus.PROCESSING)[:20])
+
+    def test_payment_list_admin(self):
+        self.assertNoSeqScan(view_queryset(PaymentViewSet, self.admin)[:20])
+
+    def test_payment_list_guest(self):
+        self.assertNoSeqScan(view_queryset(PaymentViewSet, self.guest)[:20])
+
+    def test_booking_keyset_page(self):
+        pagination = BookingCursorPagination()
+        last = Booking.objects.order_by('created_at', 'id')[2500]
+        for user in (self.admin, self.host, self.guest):
+            queryset = view_queryset(BookingViewSet, user)
+            self.assertNoSeqScan(
+                pagination.get_page_queryset(queryset, pagination.get_position(last))[:21]
+            )
+
+    def test_payment_keyset_page(self):
+        pagination = PaymentCursorPagination()
+        last = Payment.objects.order_by('payment_date', 'id')[2500]
+        for user in (self.admin, self.guest):
+            queryset = view_queryset(PaymentViewSet, user)
+            self.assertNoSeqScan(
+                pagination.get_page_queryset(queryset, pagination.get_position(last))[:21]
+            )
+
+    def test_payment_by_checkout_request_id(self):
+        self.assertNoSeqScan(Payment.objects.filter(checkout_request_id='ws_CO_42'))
+
+
+class PropertyFilterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        host = CustomUser.objects.create(id='host', name='host', phone_number='+254710000000', role='host')
+
+        def listing(name):
+            return Property.objects.create(
+                owner=host, name=name, description='', location='Nairobi', amenities='',
+                price_per_night=100,
+            )
+
+        cls.free = listing('Free')
+        cls.booked = listing('Booked')
+        cls.partly_booked = listing('Partly booked')
+        cls.canceled_only = listing('Canceled only')
+        cls.check_in = date.today() + timedelta(days=30)
+
+        def booking(property, start, end, status=Booking.BookingStatus.CONFIRMED):
+            return Booking(
+                property=property, status=status,
+                check_in=cls.check_in + timedelta(days=start),
+                check_out=cls.check_in + timedelta(days=end),
+                price_per_night=100, total_price=100, balance_due=100,
+            )
+
+        Booking.objects.bulk_create([
+            booking(cls.free, -3, 0),
+            booking(cls.free, 3, 5),
+            booking(cls.booked, -1, 4),
+            booking(cls.partly_booked, 2, 3, Booking.BookingStatus.PENDING),
+            booking(cls.canceled_only, 0, 3, Booking.BookingStatus.CANCELED),
+        ])
+
+    def available(self, start, end):
+        return set(PropertyFilter(
+            {'check_in': self.check_in + timedelta(days=start), 'check_out': self.check_in + timedelta(days=end)},
+            queryset=Property.objects.all(),
+        ).qs)
+
+    def test_availability(self):
+        # Stays ending on the check-in day or starting on the check-out day don't overlap
+        self.assertEqual(self.available(0, 3), {self.free, self.canceled_only})
+        self.assertEqual(self.available(0, 2), {self.free, self.partly_booked, self.canceled_only})
+        self.assertEqual(
+            self.available(5, 6), {self.free, self.booked, self.partly_booked, self.canceled_only},
+        )
+
+    def test_needs_both_dates(self):
+        with self.assertRaises(ValidationError):
+            PropertyFilter({'check_in': self.check_in}, queryset=Property.objects.all()).qs
+        with self.assertRaises(ValidationError):
+            self.available(2, 2)
+
+
+    @unittest.skipIf(connection.vendor == 'postgresql', 'PostgreSQL searches search_vector, see PropertySearchTests')
+    def test_search_falls_back_to_icontains(self):
+        response = APIClient().get('/api/properties/', {'search': 'BOOKED'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {item['name'] for item in response.data['results']}, {'Booked', 'Partly booked'},
+        )
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'search_vector is filled on PostgreSQL only')
+@override_settings(RESPONSE_CACHE_TIMEOUT=0)
+class PropertySearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        host = CustomUser.objects.create(id='host', name='host', phone_number='+254710000000', role='host')
+
+        def listing(name, location='Nairobi', amenities='', description=''):
+            return Property.objects.create(
+                owner=host, name=name, description=description, location=location,
+                amenities=amenities, price_per_night=100,
+            )
+
+        # "pool" in each weight class: name, then amenities, then description
+        cls.villa = listing('Pool Villa')
+        cls.cottage = listing('Garden Cottage', amenities='wifi, pools')
+        cls.loft = listing('City Loft', description='Five minutes from the public pool')
+        cls.cabin = listing('Forest Cabin', location='Nanyuki')
+
+    def search(self, terms):
+        response = APIClient().get('/api/properties/', {'search': terms})
+        self.assertEqual(response.status_code, 200)
+        return [item['name'] for item in response.data['results']]
+
+    def test_trigger_fills_search_vector(self):
+        self.cabin.refresh_from_db()
+        self.assertIsNotNone(self.cabin.search_vector)
+        self.assertEqual(self.search('nanyuki'), ['Forest Cabin'])
+
+        self.cabin.location = 'Naivasha'
+        self.cabin.save()
+        self.assertEqual(self.search('nanyuki'), [])
+        self.assertEqual(self.search('naivasha'), ['Forest Cabin'])
+
+        Property.objects.filter(pk=self.cabin.pk).update(amenities='sauna')
+        self.assertEqual(self.search('sauna'), ['Forest Cabin'])
+
+    def test_ranked(self):
+        # Stemmed, so "pools" matches too, and the name outranks amenities
+        # and then the description whatever order they were created in
+        self.assertEqual(self.search('pool'), ['Pool Villa', 'Garden Cottage', 'City Loft'])
+        self.assertEqual(self.search('"garden cottage"'), ['Garden Cottage'])
+
+    def test_uses_gin_index(self):
+        request = Request(APIRequestFactory().get('/api/properties/', {'search': 'pool'}))
+        queryset = PropertySearchFilter().filter_queryset(request, Property.objects.all(), PropertyViewSet())
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+        self.assertIn('property_search_idx', queryset.explain())
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'Budgets are counted on PostgreSQL')
+@modify_settings(MIDDLEWARE={'append': 'core.querycount.QueryBudgetMiddleware'})
+class QueryBudgetTests(TestCase):
+    """
+    Sends each API action through QueryBudgetMiddleware, which fails the
+    request if it runs more queries than the view's ``query_budgets`` or
+    repeats a query per row.
+
+    Other databases also run the overlap pre-checks PostgreSQL leaves to
+    the booking_no_overlap constraint, so they need more queries.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        def user(id, role, index):
+            return CustomUser.objects.create(
+                id=id, name=id, phone_number=f'+25471000000{index}',
+                email=f'{id}@example.com', id_photo='users/photos/test.jpg', role=role,
+                password='!',
+            )
+
+        cls.admin = user('admin', 'admin', 0)
+        cls.host = user('host', 'host', 1)
+        cls.guest = user('guest', 'guest', 2)
+        cls.other_guest = user('other-guest', 'guest', 3)
+
+        cls.properties = [
+            Property.objects.create(
+                owner=cls.host, name=f'Property {i}', description='', location='Nairobi',
+                amenities='', price_per_night=100,
+            )
+            for i in range(3)
+        ]
+        start = date.today() + timedelta(days=10)
+        cls.bookings = []
+        for i in range(5):
+            booking = Booking.objects.create(
+                property=cls.properties[i % 3],
+                check_in=start + timedelta(days=i * 3),
+                check_out=start + timedelta(days=i * 3 + 2),
+                price_per_night=100, total_price=200, balance_due=200,
+            )
+            booking.guests.set([cls.guest, cls.other_guest])
+            cls.bookings.append(booking)
+        cls.booking = cls.bookings[0]
+        cls.payments = [
+            Payment.objects.create(
+                booking=booking, payer=cls.guest, amount=50,
+                payment_method='mpesa', checkout_request_id=f'ws_CO_{i}',
+            )
+            for i, booking in enumerate(cls.bookings)
+        ]
+
+    def setUp(self):
+        cache.clear()
+
+    def request(self, user, method, path, data=None):
+        client = APIClient()
+        if user is not None:
+            client.credentials(HTTP_AUTHORIZATION=f'Bearer {access_token_for(user)}')
+        response = getattr(client, method)(path, data, format='json')
+        self.assertLess(response.status_code, 400, response.content)
+        return response
+
+    def test_user_actions(self):
+        self.request(self.admin, 'get', '/api/users/')
+        self.request(self.guest, 'get', f'/api/users/{self.guest.pk}/')
+        self.request(self.guest, 'patch', f'/api/users/{self.guest.pk}/', {'name': 'Renamed'})
+        self.request(self.admin, 'delete', f'/api/users/{self.other_guest.pk}/')
+
+    def test_property_actions(self):
+        for user in (self.admin, self.host, self.guest):
+            with self.subTest(role=user.role):
+                self.request(user, 'get', '/api/properties/')
+                self.request(user, 'get', '/api/properties/?search=property&check_in='
+                             f'{date.today()}&check_out={date.today() + timedelta(days=2)}')
+                self.request(user, 'get', f'/api/properties/{self.properties[0].pk}/')
+        self.request(self.host, 'patch', f'/api/properties/{self.properties[0].pk}/', {'name': 'Renamed'})
+        self.request(self.host, 'post', '/api/properties/', {
+            'name': 'New', 'description': 'A new listing', 'location': 'Nairobi',
+            'amenities': 'wifi', 'price_per_night': '80.00',
+        })
+        response = self.request(None, 'post', '/api/properties/quote/', {'items': [
+            {'property': str(prop.pk), 'check_in': str(date.today()), 'check_out': str(date.today() + timedelta(days=3))}
+            for prop in self.properties
+        ]})
+        self.assertEqual([quote['total'] for quote in response.data['quotes']], ['300.00'] * 3)
+        # Cascades to its bookings and their payments
+        self.request(self.host, 'delete', f'/api/properties/{self.properties[2].pk}/')
+
+    def test_booking_actions(self):
+        for user in (self.admin, self.host, self.guest):
+            with self.subTest(role=user.role):
+                self.request(user, 'get', '/api/bookings/')
+        self.request(self.guest, 'get', f'/api/bookings/{self.booking.pk}/')
+        check_in = date.today() + timedelta(days=100)
+        self.request(self.guest, 'post', '/api/bookings/', {
+            'property': str(self.properties[0].pk), 'guests': [self.guest.pk, self.other_guest.pk],
+            'check_in': str(check_in), 'check_out': str(check_in + timedelta(days=2)),
+            'price_per_night': '100.00',
+        })
+        self.request(self.guest, 'patch', f'/api/bookings/{self.booking.pk}/', {
+            'property': str(self.booking.property_id), 'guests': [self.guest.pk],
+            'check_in': str(self.booking.check_in), 'check_out': str(self.booking.check_out),
+        })
+        self.request(self.guest, 'delete', f'/api/bookings/{self.bookings[1].pk}/')
+
+    def test_payment_actions(self):
+        for user in (self.admin, self.guest):
+            with self.subTest(role=user.role):
+                self.request(user, 'get', '/api/payments/')
+                self.request(user, 'get', f'/api/payments/{self.payments[0].pk}/')
+        self.request(self.guest, 'post', '/api/payments/', {
+            'payer': self.guest.pk, 'booking': str(self.booking.pk),
+            'amount': '50.00', 'payment_method': 'mpesa',
+        })
+
+    def test_mpesa_callback(self):
+        self.request(None, 'post', '/api/payments/mpesa/callback/', {
+            'Body': {'stkCallback': {'CheckoutRequestID': 'ws_CO_0', 'ResultCode': 0}},
+        })
+
+    def test_guest_membership(self):
+        booking = Booking.objects.get(pk=self.booking.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(booking.has_guest(self.guest))
+        prefetched = Booking.objects.prefetch_related('guests').get(pk=self.booking.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(prefetched.has_guest(self.host))
+        self.assertEqual(Booking.objects.with_guest(self.guest).count(), len(self.bookings))
+        self.assertEqual(Payment.objects.for_guest(self.other_guest).count(), len(self.payments))
+
+    def test_token_claims(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {access_token_for(self.guest)}')
+        # Only the user being retrieved; the requester comes from the token
+        with self.assertNumQueries(1):
+            self.assertEqual(client.get(f'/api/users/{self.guest.pk}/').status_code, 200)
+
+        guest = CustomUser.objects.get(pk=self.guest.pk)
+        guest.role = 'host'
+        with self.captureOnCommitCallbacks(execute=True):
+            guest.save(update_fields=['role'])
+        self.assertEqual(client.get(f'/api/users/{self.guest.pk}/').status_code, 401)
+
+        # Logging in again doesn't revoke anything
+        guest.check_password('secret')
+        self.request(guest, 'get', '/api/properties/')
+
+    def test_login(self):
+        guest = CustomUser.objects.get(pk=self.guest.pk)
+        with self.settings(PASSWORD_PBKDF2_ITERATIONS=1000):
+            guest.set_password('Secret-pass-1')
+        guest.save(update_fields=['password'])
+        version = guest.token_version
+        client = APIClient()
+
+        # Rehashed with the configured cost, without revoking tokens
+        with self.settings(PASSWORD_PBKDF2_ITERATIONS=2000):
+            response = client.post('/api/auth/login/', {'id': guest.phone_number, 'password': 'Secret-pass-1'})
+        self.assertEqual(response.status_code, 200, response.content)
+        guest.refresh_from_db()
+        self.assertTrue(guest.password.startswith('pbkdf2_sha256$2000$'))
+        self.assertEqual(guest.token_version, version)
+
+        self.assertEqual(client.post('/api/auth/login/', {'id': 'nobody', 'password': 'x'}).status_code, 401)
+        # Cached as matching nobody
+        with self.assertNumQueries(0):
+            self.assertEqual(client.post('/api/auth/login/', {'id': 'nobody', 'password': 'x'}).status_code, 401)
+
+        # Locked out after AUTH_LOGIN_MAX_FAILURES
+        for _ in range(3):
+            client.post('/api/auth/login/', {'id': 'nobody', 'password': 'x'})
+        self.assertEqual(client.post('/api/auth/login/', {'id': 'nobody', 'password': 'x'}).status_code, 429)
+
+    def test_over_budget_fails(self):
+        with mock.patch.object(PaymentViewSet, 'query_budgets', {'list': 1}):
+            with self.assertRaisesMessage(QueryBudgetExceeded, 'budget is 1'):
+                self.request(self.admin, 'get', '/api/payments/')
+
+    def test_repeated_query_fails(self):
+        # What the payment list did before it selected the booking's property
+        queryset = Payment.objects.select_related('booking', 'payer')
+        with mock.patch.object(PaymentViewSet, 'get_queryset', lambda view: queryset):
+            with self.assertRaisesMessage(QueryBudgetExceeded, '5x SELECT'):
+                self.request(self.admin, 'get', '/api/payments/')
+
+    def test_recorder_groups_query_shapes(self):
+        with QueryRecorder() as recorder:
+            for payment in Payment.objects.all():
+                str(payment)
+                payment.booking.status
+        self.assertEqual(recorder.count, 6)
+        self.assertEqual(list(recorder.repeated().values()), [5])
+        self.assertEqual(
+            sql_shape("SELECT * FROM t WHERE a = %s AND b IN (%s, %s) AND c = 'x' LIMIT 21"),
+            "SELECT * FROM t WHERE a = ? AND b IN (...) AND c = ? LIMIT ?",
+        )
+
+
+class ResponseCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.host = CustomUser.objects.create(id='host', name='host', phone_number='+254710000000', role='host')
+        cls.property = Property.objects.create(
+            owner=cls.host, name='Cottage', description='', location='Nairobi', amenities='',
+            price_per_night=100,
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def name(self, path):
+        response = APIClient().get(path)
+        self.assertEqual(response.status_code, 200, response.content)
+        if 'results' in response.data:
+            return response.data['results'][0]['name']
+        return response.data['name']
+
+    def test_hit_and_invalidated_on_save(self):
+        paths = [
+            '/api/properties/',
+            f'/api/properties/{self.property.pk}/',
+            f'/api/properties/{str(self.property.pk).upper()}/',
+        ]
+        for path in paths:
+            self.name(path)
+        # Bypasses the signals, so the cached responses are still served
+        Property.objects.filter(pk=self.property.pk).update(name='Chalet')
+        for path in paths:
+            self.assertEqual(self.name(path), 'Cottage')
+
+        self.property.name = 'Cabin'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.property.save()
+        for path in paths:
+            with self.subTest(path=path):
+                self.assertEqual(self.name(path), 'Cabin')
+
+    @override_settings(RESPONSE_CACHE_TIMEOUT=0)
+    def test_stale_while_revalidate(self):
+        self.assertEqual(caching.get_or_build('key', lambda: 'first'), 'first')
+        # Past its soft expiry; another request is rebuilding it
+        cache.add('key:lock', 1)
+        self.assertEqual(caching.get_or_build('key', lambda: 'second'), 'first')
+        cache.delete('key:lock')
+        self.assertEqual(caching.get_or_build('key', lambda: 'second'), 'second')
+        # Errors aren't cached
+        self.assertIsNone(caching.get_or_build('other', lambda: None))
+        self.assertIsNone(cache.get('other'))
+
+
+class ConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        host = CustomUser.objects.create(id='host', name='host', phone_number='+254710000000', role='host')
+        cls.guest = CustomUser.objects.create(id='guest', name='guest', phone_number='+254710000001', role='guest')
+        cls.property = Property.objects.create(
+            owner=host, name='Cottage', description='', location='Nairobi', amenities='',
+            price_per_night=100,
+        )
+        check_in = date.today() + timedelta(days=30)
+        cls.booking = Booking.objects.create(
+            property=cls.property, check_in=check_in, check_out=check_in + timedelta(days=2),
+            price_per_night=100, total_price=200, balance_due=200,
+        )
+        cls.booking.guests.add(cls.guest)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access_token_for(self.guest)}')
+
+    def test_cached_responses(self):
+        for path in ('/api/properties/', f'/api/properties/{self.property.pk}/'):
+            with self.subTest(path=path):
+                response = self.client.get(path)
+                etag, last_modified = response['ETag'], response['Last-Modified']
+                # Answered from the cached entry
+                with self.assertNumQueries(0):
+                    self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+                    self.assertEqual(self.client.get(path, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+                    self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+                with self.captureOnCommitCallbacks(execute=True):
+                    Property.objects.get(pk=self.property.pk).save()
+                # Rebuilt with the same content
+                self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+                property = Property.objects.get(pk=self.property.pk)
+                property.name = path
+                with self.captureOnCommitCallbacks(execute=True):
+                    property.save()
+                response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response['ETag'], etag)
+
+    def test_versioned_responses(self):
+        path = f'/api/bookings/{self.booking.pk}/'
+        response = self.client.get(path)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(path, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEqual(self.client.get('/api/bookings/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        Booking.objects.filter(pk=self.booking.pk).update(updated_at=self.booking.updated_at + timedelta(seconds=5))
+        self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertEqual(self.client.get(path, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+
+
+class GeoSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        host = CustomUser.objects.create(id='host', name='host', phone_number='+254710000000', role='host')
+
+        def listing(name, latitude, longitude):
+            return Property(
+                owner=host, name=name, description='', location='', amenities='',
+                price_per_night=100, latitude=latitude, longitude=longitude,
+            )
+
+        # bulk_create doesn't go through Property.save
+        cls.taveuni, cls.savaii, cls.nairobi, cls.nowhere = Property.objects.bulk_create([
+            listing('Taveuni', -16.85, 179.95),
+            listing('Savaii', -16.85, -179.95),
+            listing('Nairobi', -1.29, 36.82),
+            listing('Nowhere', None, None),
+        ])
+
+    def search(self, **params):
+        return list(PropertyFilter(params, queryset=Property.objects.all()).qs)
+
+    def test_box_across_antimeridian(self):
+        min_lat, min_lng, max_lat, max_lng = geo.box_around(-16.85, 179.95, 20)
+        self.assertGreater(min_lng, max_lng)
+        self.assertAlmostEqual(min_lng, 179.762, places=3)
+        self.assertAlmostEqual(max_lng, -179.862, places=3)
+        self.assertEqual(geo.box_around(89.9, 0, 20)[1::2], (-180, 180))
+
+    def test_radius_across_antimeridian(self):
+        self.assertEqual(self.search(near='-16.85,179.95', radius_km=20), [self.taveuni, self.savaii])
+        self.assertEqual(self.search(near='-16.85,-179.99', radius_km=20), [self.savaii, self.taveuni])
+        self.assertEqual(self.search(near='-1.3,36.8', radius_km=5), [self.nairobi])
+
+    def test_bbox(self):
+        self.assertEqual(set(self.search(bbox='179,-17,-179,-16')), {self.taveuni, self.savaii})
+        self.assertEqual(self.search(bbox='-180,-17,-179,-16'), [self.savaii])
+
+    def test_bulk_paths_fill_cell(self):
+        self.assertEqual(
+            Property.objects.get(pk=self.nairobi.pk).geo_cell, geo.cell_for(-1.29, 36.82),
+        )
+        self.assertIsNone(Property.objects.get(pk=self.nowhere.pk).geo_cell)
+        self.nowhere.latitude, self.nowhere.longitude = -1.29, 36.82
+        Property.objects.bulk_update([self.nowhere], ['latitude', 'longitude'])
+        self.assertEqual(set(self.search(near='-1.3,36.8', radius_km=5)), {self.nairobi, self.nowhere})
+
+
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = CustomUser.objects.create(id='admin', name='admin', phone_number='+254710000000', role='admin')
+        host = CustomUser.objects.create(id='host', name='host', phone_number='+254710000001', role='host')
+        property = Property.objects.create(
+            owner=host, name='Cottage', description='', location='Nairobi', amenities='',
+            price_per_night=100,
+        )
+        start = date.today() + timedelta(days=30)
+        bookings = Booking.objects.bulk_create([
+            Booking(
+                property=property, check_in=start + timedelta(days=i * 2),
+                check_out=start + timedelta(days=i * 2 + 1),
+                price_per_night=100, total_price=100, balance_due=100,
+            )
+            for i in range(7)
+        ])
+        # Ties on created_at are broken by id
+        created_at = bookings[0].created_at
+        Booking.objects.filter(pk__in=[booking.pk for booking in bookings[:5]]).update(created_at=created_at)
+        cls.expected = list(
+            Booking.objects.order_by('-created_at', '-id').values_list('id', flat=True)
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access_token_for(self.admin)}')
+
+    def page(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.data, [UUID(booking['id']) for booking in response.data['results']]
+
+    def test_next_and_previous(self):
+        data, ids = self.page('/api/bookings/?page_size=3')
+        self.assertIsNone(data['previous'])
+        pages = [ids]
+        while data['next']:
+            data, ids = self.page(data['next'])
+            pages.append(ids)
+        self.assertEqual([len(ids) for ids in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), self.expected)
+        self.assertIsNone(data['next'])
+
+        pages.pop()
+        while data['previous']:
+            data, ids = self.page(data['previous'])
+            self.assertEqual(ids, pages.pop())
+        self.assertEqual(pages, [])
+
+    def test_last_page(self):
+        data, ids = self.page('/api/bookings/?page_size=7')
+        self.assertEqual(ids, self.expected)
+        self.assertIsNone(data['next'])
+        self.assertIsNone(data['previous'])
+
+    def test_count_taken_once(self):
+        for mode, header in [('exact', 'X-Total-Count'), ('estimate', 'X-Total-Count-Estimate')]:
+            with self.subTest(mode=mode), CaptureQueriesContext(connection) as queries:
+                response = self.client.get(f'/api/bookings/?page_size=3&count={mode}')
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(header, response)
+                counts = [
+                    query['sql'] for query in queries
+                    if 'COUNT(' in query['sql'] or query['sql'].startswith('EXPLAIN')
+                ]
+                self.assertEqual(len(counts), 1, counts)
+        self.assertEqual(self.client.get('/api/bookings/?count=exact')['X-Total-Count'], '7')
+
+    def test_invalid_cursor(self):
+        def cursor(value):
+            return urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+        for token in [
+            'not-base64!', cursor('garbage'), cursor([['2030-01-01T00:00:00', 'not-a-uuid'], False]),
+            cursor([[None, None], False]), cursor([['2030-01-01T00:00:00'], False]), cursor(5),
+        ]:
+            with self.subTest(token=token):
+                self.assertEqual(self.client.get(f'/api/bookings/?cursor={token}').status_code, 404)
+
+
+def has_constraint(name):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_constraint WHERE conname = %s', [name])
+        return cursor.fetchone() is not None
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'booking_no_overlap is PostgreSQL only')
+@override_settings(BOOKING_OVERLAP_PRECHECK=False)
+class BookingOverlapTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        host = CustomUser.objects.create(id='host', name='host', phone_number='+254710000000', role='host')
+        cls.guest = CustomUser.objects.create(id='guest', name='guest', phone_number='+254710000001', role='guest')
+        cls.properties = [
+            Property.objects.create(
+                owner=host, name=f'Property {i}', description='', location='Nairobi', amenities='',
+                price_per_night=100,
+            )
+            for i in range(2)
+        ]
+        cls.check_in = date.today() + timedelta(days=30)
+
+    def setUp(self):
+        if not has_constraint('booking_no_overlap'):
+            self.skipTest('booking_no_overlap needs the btree_gist extension')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access_token_for(self.guest)}')
+
+    def book(self, property, start, end):
+        return self.client.post('/api/bookings/', {
+            'property': str(property.pk), 'guests': [self.guest.pk],
+            'check_in': str(self.check_in + timedelta(days=start)),
+            'check_out': str(self.check_in + timedelta(days=end)),
+        }, format='json')
+
+    def test_overlapping_create_is_400(self):
+        self.assertEqual(self.book(self.properties[0], 0, 3).status_code, 201)
+        response = self.book(self.properties[0], 2, 4)
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(response.data['non_field_errors'], [BOOKING_UNAVAILABLE_MESSAGE])
+        self.assertEqual(Booking.objects.count(), 1)
+
+    def test_overlapping_update_is_400(self):
+        self.assertEqual(self.book(self.properties[0], 0, 3).status_code, 201)
+        self.assertEqual(self.book(self.properties[1], 0, 3).status_code, 201)
+        booking = Booking.objects.get(property=self.properties[1])
+        response = self.client.patch(f'/api/bookings/{booking.pk}/', {
+            'property': str(self.properties[0].pk), 'guests': [self.guest.pk],
+            'check_in': str(booking.check_in), 'check_out': str(booking.check_out),
+        }, format='json')
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(response.data['non_field_errors'], [BOOKING_UNAVAILABLE_MESSAGE])
+
+
+class IdPhotoTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name, ID_PHOTO_MAX_SIZE=400, ID_PHOTO_THUMBNAIL_SIZE=100))
+
+    def user(self, content):
+        user = CustomUser(id='guest', name='guest', phone_number='+254710000000', password='!')
+        user.id_photo.save('upload.jpg', ContentFile(content), save=False)
+        user.save()
+        return user
+
+    def test_processed(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90 degrees
+        exif[0x010F] = 'Camera maker'
+        buffer = io.BytesIO()
+        Image.new('RGB', (2000, 1000), 'red').save(buffer, 'JPEG', exif=exif)
+        user = self.user(buffer.getvalue())
+        original = user.id_photo.path
+
+        self.assertEqual(process_id_photo(user.pk), CustomUser.PhotoStatus.READY)
+        user.refresh_from_db()
+        with Image.open(user.id_photo.path) as photo:
+            # Turned upright, then scaled to fit 400 pixels
+            self.assertEqual(photo.size, (200, 400))
+            self.assertFalse(photo.getexif())
+        with Image.open(user.id_photo_thumbnail.path) as thumbnail:
+            self.assertEqual(thumbnail.size, (50, 100))
+        self.assertFalse(user.id_photo.storage.exists(original))
+        # Already done
+        self.assertIsNone(process_id_photo(user.pk))
+
+    def test_rejected(self):
+        user = self.user(b'not an image')
+        self.assertEqual(process_id_photo(user.pk), CustomUser.PhotoStatus.REJECTED)
+        user.refresh_from_db()
+        self.assertEqual(user.id_photo_status, CustomUser.PhotoStatus.REJECTED)
+        self.assertTrue(user.id_photo.storage.exists(user.id_photo.name))
+
+    def test_served_to_owner_and_admins(self):
+        user = self.user(b'0123456789')
+        other = CustomUser.objects.create(id='other', name='other', phone_number='+254710000001', role='guest')
+        admin = CustomUser.objects.create(id='admin', name='admin', phone_number='+254710000002', role='admin')
+        url = user.id_photo.url
+
+        def get(requester, **headers):
+            client = APIClient()
+            if requester is not None:
+                client.credentials(HTTP_AUTHORIZATION=f'Bearer {access_token_for(requester)}')
+            return client.get(url, **headers)
+
+        self.assertEqual(get(None).status_code, 401)
+        self.assertEqual(get(other).status_code, 403)
+        response = get(admin)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Cache-Control'], 'private, max-age=3600')
+
+        response = get(user, HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+        self.assertEqual(b''.join(response.streaming_content), b'234')
+        self.assertEqual(get(user, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(get(user, HTTP_RANGE='bytes=20-').status_code, 416)
+
+        with self.settings(MEDIA_ACCEL_REDIRECT='/protected-media/'):
+            response = get(user)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{user.id_photo.name}')
+        self.assertEqual(response.content, b'')
+
+
+class PricingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        host = CustomUser.objects.create(id='host', name='host', phone_number='+254710000000', role='host')
+        cls.property = Property.objects.create(
+            owner=host, name='Cottage', description='', location='Nairobi', amenities='',
+            price_per_night=100,
+        )
+        RateRule.objects.create(property=cls.property, weekdays=RateRule.WEEKEND, price_per_night=150)
+        # Over the holidays, weekends included
+        RateRule.objects.create(
+            property=cls.property, start_date=date(2030, 12, 20), end_date=date(2031, 1, 3),
+            price_per_night=200, priority=1,
+        )
+        LengthOfStayDiscount.objects.create(property=cls.property, min_nights=7, percent=10)
+        LengthOfStayDiscount.objects.create(property=cls.property, min_nights=28, percent=25)
+        cls.property.refresh_from_db()
+
+    def setUp(self):
+        cache.clear()
+
+    def nightly(self, night):
+        if date(2030, 12, 20) <= night < date(2031, 1, 3):
+            return 200
+        return 150 if night.weekday() in (4, 5) else 100
+
+    def test_matches_pricing_each_night(self):
+        first = date(2030, 11, 1)
+        stays = [
+            (first + timedelta(days=start), first + timedelta(days=start + nights))
+            for start in range(0, 90, 4) for nights in (1, 3, 7, 10, 30)
+        ]
+        with self.assertNumQueries(3):
+            quotes = quote_many((self.property.pk, check_in, check_out) for check_in, check_out in stays)
+        for (check_in, check_out), quote in zip(stays, quotes):
+            nights = (check_out - check_in).days
+            subtotal = sum(self.nightly(check_in + timedelta(days=night)) for night in range(nights))
+            percent = 25 if nights >= 28 else 10 if nights >= 7 else 0
+            with self.subTest(check_in=check_in, nights=nights):
+                self.assertEqual(quote.subtotal, subtotal)
+                self.assertEqual(quote.total, subtotal - subtotal * percent / 100)
+
+        # Rules and discounts are cached until one changes
+        with self.assertNumQueries(1):
+            quote_many([(self.property.pk, first, first + timedelta(days=2))])
+        RateRule.objects.create(property=self.property, price_per_night=90, priority=-1)
+        with self.assertNumQueries(3):
+            quote_many([(self.property.pk, first, first + timedelta(days=2))])
+
+    def test_change_seen_through_stale_cache(self):
+        stay = [(self.property.pk, date(2030, 11, 4), date(2030, 11, 5))]
+        self.assertEqual(quote_many(stay)[0].total, 100)
+        version = self.property.pricing_version
+        stale = cache.get(f'pricing:{self.property.pk}:{version}')
+        self.assertIsNotNone(stale)
+
+        # Another process changes the rules; nothing touches this cache
+        rule = RateRule.objects.create(property=self.property, price_per_night=120, priority=2)
+        self.assertEqual(cache.get(f'pricing:{self.property.pk}:{version}'), stale)
+        self.assertEqual(quote_many(stay)[0].total, 120)
+        rule.delete()
+        self.assertEqual(quote_many(stay)[0].total, 100)
+
+        # Saving an instance loaded before a change doesn't move the version back
+        loaded = Property.objects.get(pk=self.property.pk)
+        LengthOfStayDiscount.objects.filter(min_nights=7).get().delete()
+        loaded.name = 'Renamed'
+        loaded.save()
+        self.property.refresh_from_db()
+        self.assertEqual((self.property.name, self.property.pricing_version), ('Renamed', version + 3))
+        week = [(self.property.pk, date(2030, 11, 4), date(2030, 11, 11))]
+        self.assertEqual(quote_many(week)[0].discount, 0)
+
+    def test_unknown_property(self):
+        self.assertEqual(quote_many([(Booking().pk, date(2030, 1, 1), date(2030, 1, 2))]), [None])
+
+    def test_wide_span_priced_in_windows(self):
+        # Stays centuries apart mustn't price every night in between
+        items = [
+            ('2030-11-04', '2030-11-05'), ('2030-11-04', '2030-11-11'), ('2030-11-10', '2030-11-12'),
+            ('9999-12-29', '9999-12-31'),
+        ]
+        with mock.patch.object(pricing, 'nightly_cents', wraps=pricing.nightly_cents) as nightly_cents:
+            response = APIClient().post('/api/properties/quote/', {'items': [
+                {'property': str(self.property.pk), 'check_in': check_in, 'check_out': check_out}
+                for check_in, check_out in items
+            ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([call.args[3] for call in nightly_cents.call_args_list], [8, 2])
+        # The same as each stay quoted on its own
+        self.assertEqual(
+            [quote['total'] for quote in response.data['quotes']],
+            [
+                str(quote_many([(self.property.pk, date.fromisoformat(check_in), date.fromisoformat(check_out))])[0].total)
+                for check_in, check_out in items
+            ],
+        )
+
+
+class AvailabilityIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        host = CustomUser.objects.create(id='host', name='host', phone_number='+254710000000', role='host')
+        cls.property = Property.objects.create(
+            owner=host, name='Cottage', description='', location='Nairobi', amenities='',
+            price_per_night=100,
+        )
+        cls.start = date.today() + timedelta(days=30)
+
+    def setUp(self):
+        cache.clear()
+
+    def day(self, offset):
+        return self.start + timedelta(days=offset)
+
+    def book(self, check_in, check_out):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Booking.objects.create(
+                property=self.property, check_in=self.day(check_in), check_out=self.day(check_out),
+                price_per_night=100, total_price=100, balance_due=100,
+            )
+
+    def test_bits(self):
+        entry = availability._add_range((0, 0), self.day(5), self.day(7))
+        self.assertEqual(entry, (self.day(5).toordinal(), 0b11))
+        # An earlier stay moves the base back
+        entry = availability._add_range(entry, self.day(1), self.day(2))
+        self.assertEqual(entry, (self.day(1).toordinal(), 0b110001))
+        self.assertEqual(availability._add_range(entry, self.day(3), self.day(3)), entry)
+
+        for check_in, check_out, free in [
+            (-5, 1, True), (-5, 2, False), (2, 5, True), (4, 6, False),
+            (6, 9, False), (7, 20, True), (1, 2, False),
+        ]:
+            with self.subTest(check_in=check_in, check_out=check_out):
+                self.assertEqual(availability._is_free(entry, self.day(check_in), self.day(check_out)), free)
+        self.assertTrue(availability._is_free((0, 0), self.day(0), self.day(1)))
+
+    def version(self):
+        return Property.objects.values_list('availability_version', flat=True).get(pk=self.property.pk)
+
+    def test_warm_check_runs_no_query(self):
+        self.property.refresh_from_db()
+        with self.assertNumQueries(1):
+            self.assertTrue(self.property.is_available(self.day(0), self.day(3)))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.property.is_available(self.day(0), self.day(3)))
+            self.assertTrue(self.property.is_available(self.day(5), self.day(9)))
+        # Versions read in one query when the caller has only the ids
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                availability.available_property_ids([self.property.pk], self.day(2), self.day(4)),
+                {self.property.pk},
+            )
+
+    def test_version_moves_when_bookings_change(self):
+        self.property.refresh_from_db()
+        self.assertTrue(self.property.is_available(self.day(0), self.day(3)))
+        version = self.version()
+
+        booking = self.book(0, 2)
+        self.assertEqual(self.version(), version + 1)
+        property = Property.objects.get(pk=self.property.pk)
+        self.assertFalse(property.is_available(self.day(1), self.day(3)))
+        with self.assertNumQueries(0):
+            self.assertFalse(property.is_available(self.day(1), self.day(3)))
+            self.assertTrue(property.is_available(self.day(2), self.day(4)))
+
+        # Confirming holds the same nights
+        booking.status = Booking.BookingStatus.CONFIRMED
+        booking.save(update_fields=['status'])
+        self.assertEqual(self.version(), version + 1)
+
+        booking.status = Booking.BookingStatus.CANCELED
+        booking.save(update_fields=['status'])
+        self.assertEqual(self.version(), version + 2)
+        # The booking's own property reloads its version
+        self.assertTrue(booking.property.is_available(self.day(1), self.day(3)))
+
+        booking.status = Booking.BookingStatus.PENDING
+        booking.save(update_fields=['status'])
+        self.assertEqual(self.version(), version + 3)
+        booking.total_price = 200
+        booking.save(update_fields=['total_price'])
+        booking.delete()
+        self.assertEqual(self.version(), version + 4)
+
+    def test_change_seen_through_stale_cache(self):
+        property = Property.objects.get(pk=self.property.pk)
+        self.assertTrue(property.is_available(self.day(0), self.day(3)))
+        # Writes only touch the database, so a cache shared by no other
+        # process still holds the old entry
+        Booking.objects.bulk_create([Booking(
+            property=self.property, check_in=self.day(1), check_out=self.day(2),
+            price_per_night=100, total_price=100, balance_due=100,
+        )])
+        availability.bump_version(self.property.pk)
+        self.assertTrue(property.is_available(self.day(0), self.day(3)))
+
+        property = Property.objects.get(pk=self.property.pk)
+        self.assertFalse(property.is_available(self.day(0), self.day(3)))
+
+
+class MpesaCallbackTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        host = CustomUser.objects.create(id='host', name='host', phone_number='+254710000000', role='host')
+        cls.guest = CustomUser.objects.create(
+            id='guest', name='guest', phone_number='+254710000001', role='guest', email='guest@example.com',
+        )
+        property = Property.objects.create(
+            owner=host, name='Cottage', description='', location='Nairobi', amenities='',
+            price_per_night=100,
+        )
+        check_in = date.today() + timedelta(days=30)
+        cls.booking = Booking.objects.create(
+            property=property, check_in=check_in, check_out=check_in + timedelta(days=2),
+            price_per_night=100, total_price=200, balance_due=200,
+        )
+
+    def payment(self, checkout_request_id, status=Payment.Status.PROCESSING):
+        return Payment.objects.create(
+            booking=self.booking, payer=self.guest, amount=50, payment_method='mpesa',
+            checkout_request_id=checkout_request_id, status=status,
+        )
+
+    def callback(self, checkout_request_id, result_code=0):
+        return {'Body': {'stkCallback': {
+            'CheckoutRequestID': checkout_request_id, 'ResultCode': result_code, 'ResultDesc': '',
+            'CallbackMetadata': {'Item': [
+                {'Name': 'Amount', 'Value': 50}, {'Name': 'MpesaReceiptNumber', 'Value': f'R-{checkout_request_id}'},
+            ]},
+        }}}
+
+    def post(self, body):
+        response = APIClient().post('/api/payments/mpesa/callback/', body, format='json')
+        self.assertEqual(response.data['ResultCode'], 0)
+
+    def test_retries_dropped_and_drain_debounced(self):
+        with mock.patch.object(tasks.drain_mpesa_callbacks, 'apply_async') as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.post(self.callback('ws_CO_1'))
+                self.post(self.callback('ws_CO_1', 1032))
+                self.post(self.callback('ws_CO_2'))
+            self.assertEqual(MpesaCallback.objects.count(), 2)
+            self.assertEqual(MpesaCallback.objects.get(checkout_request_id='ws_CO_1').payload, self.callback('ws_CO_1'))
+            # One drain for the lot
+            self.assertEqual(apply_async.call_count, 1)
+
+            # A drain that started has to be followed by another
+            tasks.release_schedule(tasks.DRAIN_SCHEDULE)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.post(self.callback('ws_CO_3'))
+            self.assertEqual(apply_async.call_count, 2)
+
+            # A claim whose task got lost is taken over
+            ScheduledTask.objects.update(queued_at=timezone.now() - timedelta(minutes=5))
+            with self.captureOnCommitCallbacks(execute=True):
+                self.post(self.callback('ws_CO_4'))
+            self.assertEqual(apply_async.call_count, 3)
+
+    def test_drain(self):
+        successful = self.payment('ws_CO_ok')
+        failed = self.payment('ws_CO_failed')
+        settled = self.payment('ws_CO_settled', Payment.Status.SUCCESSFUL)
+        for checkout_request_id, result_code in [
+            ('ws_CO_ok', 0), ('ws_CO_failed', 1032), ('ws_CO_settled', 1), ('ws_CO_early', 0), ('ws_CO_gone', 0),
+        ]:
+            MpesaCallback.objects.create(
+                checkout_request_id=checkout_request_id, payload=self.callback(checkout_request_id, result_code),
+            )
+        MpesaCallback.objects.create(checkout_request_id='ws_CO_malformed', payload={'Body': {}})
+        MpesaCallback.objects.filter(checkout_request_id='ws_CO_gone').update(
+            received_at=timezone.now() - timedelta(hours=1),
+        )
+
+        with self.settings(MPESA_CALLBACK_BATCH_SIZE=2):
+            self.assertEqual(tasks.drain_mpesa_callbacks(), {'callbacks': 5, 'payments': 2})
+        successful.refresh_from_db()
+        self.assertEqual((successful.status, successful.mpesa_ref), (Payment.Status.SUCCESSFUL, 'R-ws_CO_ok'))
+        failed.refresh_from_db()
+        self.assertEqual(failed.status, Payment.Status.FAILED)
+        settled.refresh_from_db()
+        self.assertEqual(settled.status, Payment.Status.SUCCESSFUL)
+        self.assertEqual(EmailNotification.objects.get().recipient, 'guest@example.com')
+        # Waiting for send_stk_push to store its CheckoutRequestID
+        self.assertEqual(
+            list(MpesaCallback.objects.filter(processed_at__isnull=True).values_list('checkout_request_id', flat=True)),
+            ['ws_CO_early'],
+        )
+
+        early = self.payment('ws_CO_early')
+        self.assertEqual(tasks.drain_mpesa_callbacks(), {'callbacks': 1, 'payments': 1})
+        early.refresh_from_db()
+        self.assertEqual(early.status, Payment.Status.SUCCESSFUL)
+
+
+class MpesaServiceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        host = CustomUser.objects.create(id='host', name='host', phone_number='+254710000000', role='host')
+        cls.guest = CustomUser.objects.create(id='guest', name='guest', phone_number='+254710000001', role='guest')
+        property = Property.objects.create(
+            owner=host, name='Cottage', description='', location='Nairobi', amenities='',
+            price_per_night=100,
+        )
+        check_in = date.today() + timedelta(days=30)
+        cls.booking = Booking.objects.create(
+            property=property, check_in=check_in, check_out=check_in + timedelta(days=2),
+            price_per_night=100, total_price=200, balance_due=200,
+        )
+        cls.booking.guests.add(cls.guest)
+
+    def setUp(self):
+        cache.clear()
+        service._local_token = None
+        self.daraja = DarajaSimulator().start()
+        self.addCleanup(self.daraja.stop)
+        overrides = override_settings(**self.daraja.settings())
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def push(self, amount=1500):
+        return service.stk_push('0712345678', amount, 'nexus', 'booking payment', 'http://localhost/callback/')
+
+    def test_token_reused(self):
+        self.push()
+        # Another process finds the token in the cache
+        service._local_token = None
+        self.push()
+        self.assertEqual(self.daraja.stats()['calls'], {'token': 1, 'stk_push': 2})
+
+    def test_refused_token_replaced_once(self):
+        self.push()
+        self.daraja.token = 'rotated-access-token'
+        self.assertEqual(self.push()['ResponseCode'], '0')
+        self.assertEqual(self.daraja.stats()['calls'], {'token': 2, 'stk_push': 2})
+
+        # A fresh token being refused too is Daraja's answer, not retried again
+        with mock.patch.object(service, 'access_token', return_value='revoked-access-token'):
+            self.assertEqual(self.push()['errorCode'], '404.001.03')
+        self.assertEqual(self.daraja.stats()['calls'], {'token': 2, 'stk_push': 2})
+
+    def test_server_errors_are_connection_errors(self):
+        self.push()
+        unavailable = SimpleNamespace(status_code=503, text='Service Unavailable')
+        with mock.patch.object(service.session(), 'post', return_value=unavailable):
+            with self.assertRaises(MpesaConnectionError):
+                self.push()
+
+    def test_whole_shillings(self):
+        with mock.patch.object(service.session(), 'post', wraps=service.session().post) as post:
+            self.push(Decimal('1500.00'))
+        self.assertEqual(post.call_args.kwargs['json']['Amount'], 1500)
+        with self.assertRaises(MpesaInvalidParameterException):
+            self.push(Decimal('1500.50'))
+        self.assertEqual(self.daraja.stats()['calls'], {'token': 1, 'stk_push': 1})
+
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {access_token_for(self.guest)}')
+        response = client.post(
+            '/api/payments/',
+            {'payer': self.guest.pk, 'booking': str(self.booking.pk), 'amount': '50.50', 'payment_method': 'mpesa'},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('whole number of shillings', str(response.data))
+        self.assertFalse(Payment.objects.exists())
+
+
+class PaymentPushTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        host = CustomUser.objects.create(id='host', name='host', phone_number='+254710000000', role='host')
+        cls.guest = CustomUser.objects.create(id='guest', name='guest', phone_number='+254710000001', role='guest')
+        property = Property.objects.create(
+            owner=host, name='Cottage', description='', location='Nairobi', amenities='',
+            price_per_night=100,
+        )
+        check_in = date.today() + timedelta(days=30)
+        cls.booking = Booking.objects.create(
+            property=property, check_in=check_in, check_out=check_in + timedelta(days=2),
+            price_per_night=100, total_price=200, balance_due=200,
+        )
+        cls.booking.guests.add(cls.guest)
+
+    def setUp(self):
+        cache.clear()
+        service._local_token = None
+        self.daraja = DarajaSimulator().start()
+        self.addCleanup(self.daraja.stop)
+        overrides = override_settings(**self.daraja.settings())
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def create(self, amount=150):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {access_token_for(self.guest)}')
+        with mock.patch.object(tasks.send_stk_push, 'apply_async') as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = client.post(
+                    '/api/payments/',
+                    {'payer': self.guest.pk, 'booking': str(self.booking.pk), 'amount': amount, 'payment_method': 'mpesa'},
+                    format='json',
+                )
+        self.assertEqual(response.status_code, 202)
+        push = StkPushRequest.objects.get(payment_id=response.data['payment_id'])
+        apply_async.assert_called_once_with((push.pk,), {})
+        return push
+
+    def assertBalance(self, balance_due, status):
+        self.booking.refresh_from_db()
+        self.assertEqual((self.booking.balance_due, self.booking.status), (balance_due, status))
+
+    def test_sent(self):
+        push = self.create()
+        self.assertBalance(50, Booking.BookingStatus.PROCESSING)
+
+        result = tasks.send_stk_push(push.pk)
+        payment = Payment.objects.get()
+        self.assertEqual(result['checkout_request_id'], payment.checkout_request_id)
+        self.assertEqual(payment.status, Payment.Status.PROCESSING)
+        push.refresh_from_db()
+        self.assertIsNotNone(push.sent_at)
+        # Sent once, however often the task is delivered
+        self.assertIsNone(tasks.send_stk_push(push.pk))
+        self.assertEqual(self.daraja.stats()['calls']['stk_push'], 1)
+
+    def test_claimed_push_skipped(self):
+        push = self.create()
+        StkPushRequest.objects.update(claimed_until=timezone.now() + timedelta(minutes=1))
+        self.assertIsNone(tasks.send_stk_push(push.pk))
+        self.assertNotIn('stk_push', self.daraja.stats()['calls'])
+
+        # The worker that claimed it died
+        StkPushRequest.objects.update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertIsNotNone(tasks.send_stk_push(push.pk))
+        self.assertEqual(StkPushRequest.objects.get().attempts, 1)
+
+    def test_rejected(self):
+        push = self.create()
+        self.daraja.routes['/mpesa/stkpush/v1/processrequest'] = lambda body: {
+            'requestId': '1', 'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid PhoneNumber',
+        }
+        self.assertIsNone(tasks.send_stk_push(push.pk)['checkout_request_id'])
+        self.assertEqual(Payment.objects.get().status, Payment.Status.FAILED)
+        self.assertIn('Invalid PhoneNumber', StkPushRequest.objects.get().last_error)
+        self.assertBalance(200, Booking.BookingStatus.PENDING)
+
+    def test_retried_then_failed(self):
+        push = self.create(200)
+        self.assertBalance(0, Booking.BookingStatus.CONFIRMED)
+        with mock.patch.object(service.session(), 'post', side_effect=requests.ConnectionError('refused')):
+            for attempt in (1, 2):
+                # Called directly, retry() raises the error instead of queueing
+                with self.assertRaises(MpesaConnectionError):
+                    tasks.send_stk_push(push.pk)
+                push.refresh_from_db()
+                self.assertEqual((push.attempts, push.claimed_until, push.sent_at), (attempt, None, None))
+                self.assertEqual(Payment.objects.get().status, Payment.Status.PROCESSING)
+
+            # Out of attempts
+            tasks.send_stk_push(push.pk)
+        self.assertEqual(Payment.objects.get().status, Payment.Status.FAILED)
+        self.assertBalance(200, Booking.BookingStatus.PENDING)
+
+    def test_failed_callback_restores_balance(self):
+        self.create(120)
+        self.create(80)
+        self.assertBalance(0, Booking.BookingStatus.CONFIRMED)
+        for payment_id, checkout_request_id in zip(
+            Payment.objects.order_by('amount').values_list('pk', flat=True), ['ws_CO_80', 'ws_CO_120'],
+        ):
+            Payment.objects.filter(pk=payment_id).update(checkout_request_id=checkout_request_id)
+            MpesaCallback.objects.create(checkout_request_id=checkout_request_id, payload={'Body': {'stkCallback': {
+                'CheckoutRequestID': checkout_request_id, 'ResultCode': 1032, 'ResultDesc': 'Request cancelled by user',
+            }}})
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.drain_mpesa_callbacks()
+        self.assertBalance(200, Booking.BookingStatus.PENDING)
+
+    def test_reconciled(self):
+        for amount, checkout_request_id, result_code in [
+            (50, 'ws_CO_ok', 0), (60, 'ws_CO_cancelled', 1032), (70, 'ws_CO_waiting', None), (20, 'ws_CO_recent', 0),
+        ]:
+            push = self.create(amount)
+            Payment.objects.filter(stk_push=push).update(checkout_request_id=checkout_request_id)
+            if result_code is not None:
+                self.daraja.results[checkout_request_id] = result_code
+        Payment.objects.exclude(checkout_request_id='ws_CO_recent').update(
+            payment_date=timezone.now() - timedelta(minutes=5),
+        )
+        self.assertBalance(0, Booking.BookingStatus.CONFIRMED)
+
+        with mock.patch.object(tasks, 'schedule_email_delivery') as schedule_email_delivery:
+            metrics = tasks.reconcile_payments()
+        self.assertEqual(
+            {key: metrics[key] for key in ('checked', 'successful', 'failed', 'pending')},
+            {'checked': 3, 'successful': 1, 'failed': 1, 'pending': 1},
+        )
+        schedule_email_delivery.assert_called_once_with()
+        self.assertEqual(self.daraja.stats()['calls']['stk_query'], 3)
+        self.assertEqual(
+            dict(Payment.objects.values_list('checkout_request_id', 'status')),
+            {
+                'ws_CO_ok': Payment.Status.SUCCESSFUL,
+                'ws_CO_cancelled': Payment.Status.FAILED,
+                'ws_CO_waiting': Payment.Status.PROCESSING,
+                'ws_CO_recent': Payment.Status.PROCESSING,
+            },
+        )
+        self.assertBalance(60, Booking.BookingStatus.PROCESSING)
+
+        # Settled payments aren't asked about again
+        self.daraja.results['ws_CO_waiting'] = 0
+        with mock.patch.object(tasks, 'schedule_email_delivery'):
+            self.assertEqual(tasks.reconcile_payments()['checked'], 1)
+        self.assertEqual(Payment.objects.get(checkout_request_id='ws_CO_waiting').status, Payment.Status.SUCCESSFUL)
+
+    def test_reconcile_runs_one_at_a_time(self):
+        cache.add(tasks.RECONCILE_LOCK_KEY, 1)
+        self.assertIsNone(tasks.reconcile_payments())
+        self.assertNotIn('stk_query', self.daraja.stats()['calls'])
+
+
+@override_settings(EVENTS_REDIS_URL=None)
+class PaymentEventsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        host = CustomUser.objects.create(id='host', name='host', phone_number='+254710000000', role='host')
+        cls.guest = CustomUser.objects.create(id='guest', name='guest', phone_number='+254710000001', role='guest')
+        cls.other = CustomUser.objects.create(id='other', name='other', phone_number='+254710000002', role='guest')
+        property = Property.objects.create(
+            owner=host, name='Cottage', description='', location='Nairobi', amenities='',
+            price_per_night=100,
+        )
+        check_in = date.today() + timedelta(days=30)
+        booking = Booking.objects.create(
+            property=property, check_in=check_in, check_out=check_in + timedelta(days=2),
+            price_per_night=100, total_price=200, balance_due=150,
+        )
+        booking.guests.add(cls.guest)
+        cls.payment = Payment.objects.create(booking=booking, payer=cls.guest, amount=50, payment_method='mpesa')
+
+    def setUp(self):
+        # A fresh broker, built from the settings above
+        patcher = mock.patch.object(events, '_broker', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.broker = events.broker()
+        self.assertIs(type(self.broker), events.LocalBroker)
+
+    async def get(self, user, pk=None):
+        return await AsyncClient().get(
+            f'/api/payments/{pk or self.payment.pk}/events/',
+            headers={'authorization': f'Bearer {access_token_for(user)}'},
+        )
+
+    async def test_streams_until_settled(self):
+        response = await self.get(self.guest)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = aiter(response.streaming_content)
+        self.assertEqual(await anext(content), b'retry: 3000\n\n')
+        first = json.loads((await anext(content)).decode().split('data: ')[1])
+        self.assertEqual((first['status'], first['balance_due']), ('processing', '150.00'))
+        self.assertEqual(len(self.broker._subscribers), 1)
+
+        message = {**first, 'status': 'successful', 'mpesa_ref': 'R1'}
+        self.broker.publish(events.payment_channel(self.payment.pk), message)
+        self.assertEqual(await anext(content), f'event: payment\ndata: {json.dumps(message)}\n\n'.encode())
+        with self.assertRaises(StopAsyncIteration):
+            await anext(content)
+        self.assertEqual(self.broker._subscribers, {})
+
+    async def test_dropped_client_unsubscribes(self):
+        response = await self.get(self.guest)
+        received = []
+
+        async def consume():
+            async for chunk in response:
+                received.append(chunk)
+
+        task = asyncio.ensure_future(consume())
+        while len(received) < 2:
+            await asyncio.sleep(0)
+        self.assertEqual(len(self.broker._subscribers), 1)
+        # The client went away; the ASGI handler cancels the response
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(self.broker._subscribers, {})
+
+    async def test_refused_without_subscribing(self):
+        self.assertEqual((await self.get(self.other)).status_code, 404)
+        self.assertEqual((await self.get(self.guest, UUID(int=1))).status_code, 404)
+        response = await AsyncClient().get(f'/api/payments/{self.payment.pk}/events/')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.broker._subscribers, {})
+
+    async def test_failed_lookup_leaves_no_subscription(self):
+        with mock.patch('core.views._visible_payment', side_effect=RuntimeError('database went away')):
+            with self.assertRaises(RuntimeError):
+                await self.get(self.guest)
+        self.assertEqual(self.broker._subscribers, {})
+
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    """Delivers to mail.outbox, except to recipients at fail.example.com"""
+
+    def send_messages(self, messages):
+        for message in messages:
+            if any(recipient.endswith('@fail.example.com') for recipient in message.to):
+                raise smtplib.SMTPRecipientsRefused({message.to[0]: (550, b'No such user')})
+        return super().send_messages(messages)
+
+
+@override_settings(
+    EMAIL_BACKEND='core.tests.FlakyEmailBackend', EMAIL_NOTIFICATION_BATCH_SIZE=2,
+    EMAIL_NOTIFICATION_RETRY_DELAY=30, EMAIL_NOTIFICATION_MAX_ATTEMPTS=3,
+)
+class EmailOutboxTests(TestCase):
+    def queue(self, *recipients):
+        queue_emails((recipient, 'Subject', 'Body') for recipient in recipients)
+
+    def pending(self):
+        return list(
+            EmailNotification.objects.filter(sent_at__isnull=True).values_list('recipient', flat=True)
+        )
+
+    def test_sent(self):
+        self.queue('a@example.com', 'b@example.com', 'c@example.com', '')
+        self.assertEqual(deliver_pending(), (3, 0))
+        self.assertEqual([message.to for message in mail.outbox], [['a@example.com'], ['b@example.com'], ['c@example.com']])
+        self.assertEqual(self.pending(), [])
+        self.assertFalse(EmailNotification.objects.filter(claimed_until__isnull=False).exists())
+        self.assertEqual(deliver_pending(), (0, 0))
+
+    def test_partial_failure(self):
+        self.queue('a@example.com', 'x@fail.example.com', 'b@example.com')
+        # Stops after the batch with the failure
+        self.assertEqual(deliver_pending(), (1, 1))
+        self.assertEqual(self.pending(), ['x@fail.example.com', 'b@example.com'])
+        failed = EmailNotification.objects.get(recipient='x@fail.example.com')
+        self.assertEqual(failed.attempts, 1)
+        self.assertIn('No such user', failed.last_error)
+
+        # Not retried before its backoff is up, the rest goes out
+        self.assertEqual(deliver_pending(), (1, 0))
+        self.assertEqual(self.pending(), ['x@fail.example.com'])
+
+    def test_backoff(self):
+        self.queue('x@fail.example.com')
+        for attempt, delay in [(1, 30), (2, 60), (3, 120)]:
+            before = timezone.now()
+            self.assertEqual(deliver_pending(), (0, 1))
+            failed = EmailNotification.objects.get()
+            self.assertEqual(failed.attempts, attempt)
+            self.assertAlmostEqual((failed.claimed_until - before).total_seconds(), delay, delta=5)
+            self.assertEqual(deliver_pending(), (0, 0))
+            EmailNotification.objects.update(claimed_until=before)
+        # Out of attempts
+        self.assertEqual(deliver_pending(), (0, 0))
+
+    def test_claimed_rows_skipped(self):
+        self.queue('a@example.com')
+        EmailNotification.objects.update(claimed_until=timezone.now() + timedelta(minutes=1), attempts=1)
+        self.assertEqual(deliver_pending(), (0, 0))
+        # The run that claimed it died; it's picked up once the claim runs out
+        EmailNotification.objects.update(claimed_until=timezone.now())
+        self.assertEqual(deliver_pending(), (1, 0))
+        self.assertEqual(EmailNotification.objects.get().attempts, 2)
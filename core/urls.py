@@ -8,6 +8,7 @@ from .views import (
     BookingViewSet,
     PaymentViewSet,
     MpesaCallbackView,
+    payment_status_events,
 )
 
 router = DefaultRouter()
@@ -18,6 +19,7 @@ router.register(r'bookings', BookingViewSet, basename='booking')
 router.register(r'payments', PaymentViewSet, basename='payment')
 
 urlpatterns = [
+    path('payments/<uuid:pk>/events/', payment_status_events, name='payment-events'),
     path('', include(router.urls)),
-    path('payments/mpesa/callback/ ', MpesaCallbackView.as_view(), name='pay'),
+    path('payments/mpesa/callback/', MpesaCallbackView.as_view(), name='pay'),
 ]
@@ -1,4 +1,6 @@
 from rest_framework import viewsets, status
+from rest_framework.decorators import action
+from rest_framework.filters import OrderingFilter
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.views import APIView
 from rest_framework.response import Response
@@ -6,6 +8,9 @@ from rest_framework.response import Response
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.db import transaction
+from django.db.models import Q
+
+from django_filters.rest_framework import DjangoFilterBackend
 
 from drf_spectacular.utils import (
     extend_schema,
@@ -13,13 +18,21 @@ from drf_spectacular.utils import (
     OpenApiResponse,
 )
 
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.conf import settings
+
+from asgiref.sync import sync_to_async
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.views import TokenObtainPairView
+from rest_framework.exceptions import AuthenticationFailed
+
+import asyncio
+import json
 
 from django.contrib.auth import get_user_model
 
-from .service import MpesaService, MpesaClient
 
-from .models import Property, Booking, Payment
+from .models import Property, Booking, Payment, MpesaCallback
 from .serializers import (
     CustomUserListSerializer,
     CustomUserCreateSerializer,
@@ -28,21 +41,34 @@ from .serializers import (
 
     PropertyListSerializer,
     PropertyDetailSerializer,
+    QuoteRequestSerializer,
+    QuoteSerializer,
 
     BookingListSerializer,
     BookingDetailSerializer,
+    BookingCreateSerializer,
+    BookingUpdateSerializer,
 
     PaymentCreateSerializer,
     PaymentDetailSerializer,
 )
 
-from .tasks import process_mpesa_callback
+from .tasks import schedule_callback_drain
+from .filters import PropertyFilter, PropertySearchFilter
+from .pagination import BookingCursorPagination, PaymentCursorPagination
+from .caching import CachedResponseMixin
+from .conditional import ConditionalGetMixin
+from .pricing import quote_many
+from .authentication import ClaimsJWTAuthentication, QueryTokenJWTAuthentication
+from .auth_backends import LoginIdentifierThrottle
+from . import events, media
 
 from .permissions import (
     UsersPermission,
     PropertyPermissions,
     BookingPermissions,
     IsGuestForPayment,
+    MediaPermission,
 )
 
 CustomUser = get_user_model()
@@ -67,6 +93,8 @@ CustomUser = get_user_model()
 class UserViewSet(viewsets.ModelViewSet):
     queryset = CustomUser.objects.all()
     permission_classes = [UsersPermission]
+    # Enforced in tests by QueryBudgetMiddleware, see core/querycount.py
+    query_budgets = {'list': 2, 'retrieve': 1, 'create': 3, 'update': 4, 'partial_update': 4, 'destroy': 8}
 
     def get_serializer_class(self):
         if self.action == 'create':
@@ -76,6 +104,35 @@ class UserViewSet(viewsets.ModelViewSet):
         if self.action == 'list':
             return CustomUserListSerializer
         return CustomUserDetailSerializer
+
+
+class LoginView(TokenObtainPairView):
+    """simplejwt's login, turning away identifiers locked out by PhoneOrIDBackend"""
+    throttle_classes = [LoginIdentifierThrottle]
+    # The user lookup and, when the stored hash is upgraded, its save
+    query_budgets = {'post': 3}
+
+
+class ProtectedMediaView(APIView):
+    """
+    Files under MEDIA_URL, for the admins and the user they belong to.
+    The bytes are sent by nginx or a FileResponse, see core/media.py.
+    """
+    authentication_classes = [ClaimsJWTAuthentication, QueryTokenJWTAuthentication]
+    permission_classes = [MediaPermission]
+    query_budgets = {'get': 1}
+
+    def get(self, request, path):
+        owner = (
+            CustomUser.objects
+            .filter(Q(id_photo=path) | Q(id_photo_thumbnail=path))
+            .only('id')
+            .first()
+        )
+        if owner is None:
+            raise Http404("No such file.")
+        self.check_object_permissions(request, owner)
+        return media.serve(request, path)
     
 
 # ===========================
@@ -83,7 +140,14 @@ class UserViewSet(viewsets.ModelViewSet):
 # ===========================
 
 @extend_schema_view(
-    list=extend_schema(summary="List properties"),
+    list=extend_schema(
+        summary="List properties",
+        description=(
+            "Pass check_in and check_out to only list properties that are "
+            "free for those dates, optionally with location, min_price and max_price. "
+            "search runs a ranked full-text search over the listing."
+        ),
+    ),
     retrieve=extend_schema(summary="Retrieve property details"),
     create=extend_schema(
         summary="Create property",
@@ -93,8 +157,20 @@ class UserViewSet(viewsets.ModelViewSet):
     update=extend_schema(summary="Update property"),
     destroy=extend_schema(summary="Delete property"),
 )
-class PropertyViewSet(viewsets.ModelViewSet):
+class PropertyViewSet(CachedResponseMixin, viewsets.ModelViewSet):
     permission_classes = [PropertyPermissions]
+    query_budgets = {'list': 2, 'retrieve': 1, 'create': 2, 'update': 2, 'partial_update': 2, 'destroy': 11, 'quote': 3}
+    filter_backends = [DjangoFilterBackend, PropertySearchFilter, OrderingFilter]
+    filterset_class = PropertyFilter
+    search_fields = ['name', 'description', 'location', 'amenities']
+    cache_namespace = 'property'
+
+    def get_cache_dependencies(self, request):
+        dependencies = super().get_cache_dependencies(request)
+        # The availability filter reads bookings as well
+        if 'check_in' in request.query_params or 'check_out' in request.query_params:
+            dependencies.append('booking')
+        return dependencies
 
     def get_queryset(self):
         return Property.objects.select_related('owner')
@@ -105,7 +181,29 @@ class PropertyViewSet(viewsets.ModelViewSet):
         return PropertyDetailSerializer
 
     def perform_create(self, serializer):
-        serializer.save(owner=self.request.user)
+        serializer.save(owner_id=self.request.user.pk)
+
+    @extend_schema(
+        summary="Quote stays at several properties",
+        request=QuoteRequestSerializer,
+        responses={200: QuoteSerializer(many=True)},
+    )
+    @action(detail=False, methods=['post'])
+    def quote(self, request):
+        """
+        Prices every (property, check_in, check_out) item in one go, with
+        the rates and discounts of core/pricing.py. Quotes come back in
+        the order of the items, null for properties that don't exist.
+        """
+        serializer = QuoteRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        quotes = quote_many(
+            (item['property'], item['check_in'], item['check_out'])
+            for item in serializer.validated_data['items']
+        )
+        return Response({
+            'quotes': [QuoteSerializer(price).data if price else None for price in quotes],
+        })
 
 
 # ===========================
@@ -117,14 +215,18 @@ class PropertyViewSet(viewsets.ModelViewSet):
     retrieve=extend_schema(summary="Retrieve booking details"),
     create=extend_schema(
         summary="Create booking",
-        request=BookingDetailSerializer,
-        responses={201: BookingDetailSerializer},
+        request=BookingCreateSerializer,
+        responses={201: BookingCreateSerializer},
     ),
     update=extend_schema(summary="Update booking"),
     destroy=extend_schema(summary="Cancel booking"),
 )
-class BookingViewSet(viewsets.ModelViewSet):
+class BookingViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     permission_classes = [BookingPermissions]
+    query_budgets = {'list': 3, 'retrieve': 3, 'create': 12, 'update': 12, 'partial_update': 12, 'destroy': 8}
+    pagination_class = BookingCursorPagination
+    etag_fields = ('updated_at', 'property__updated_at')
+    etag_detail_fields = ('guests__updated_at',)
 
     def get_queryset(self):
         user = self.request.user
@@ -138,13 +240,17 @@ class BookingViewSet(viewsets.ModelViewSet):
             return qs
 
         if user.role == 'host':
-            return qs.filter(property__owner=user)
+            return qs.filter(property__owner_id=user.pk)
 
-        return qs.filter(guests=user)
+        return qs.with_guest(user)
 
     def get_serializer_class(self):
         if self.action == 'list':
             return BookingListSerializer
+        if self.action == 'create':
+            return BookingCreateSerializer
+        if self.action in ['update', 'partial_update']:
+            return BookingUpdateSerializer
         return BookingDetailSerializer
     
 
@@ -157,20 +263,24 @@ class BookingViewSet(viewsets.ModelViewSet):
     list=extend_schema(summary="List payments"),
     retrieve=extend_schema(summary="Retrieve payment details"),
 )
-class PaymentViewSet(viewsets.ModelViewSet):
+class PaymentViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated] #IsGuestForPayment]
+    query_budgets = {'list': 2, 'retrieve': 2, 'create': 7}
+    pagination_class = PaymentCursorPagination
+    etag_fields = ('updated_at', 'booking__updated_at', 'booking__property__updated_at', 'payer__updated_at')
+
     def get_queryset(self):
         user = self.request.user
 
         qs = Payment.objects.select_related(
-            'booking',
+            'booking__property',
             'payer'
         )
 
         if user.role == 'admin':
             return qs
 
-        return qs.filter(booking__guests=user)
+        return qs.for_guest(user)
 
     def get_serializer_class(self):
         if self.action == 'create':
@@ -178,54 +288,116 @@ class PaymentViewSet(viewsets.ModelViewSet):
         return PaymentDetailSerializer
     
     @extend_schema(
-        summary="Create payment and initiate Mpesa STK push",
+        summary="Create payment and queue an Mpesa STK push",
         description=(
-            "Creates a payment record and initiates an Mpesa STK push. "
-            "Mpesa callback will later confirm or fail the payment."
+            "Creates a payment record and queues an Mpesa STK push, which a "
+            "worker sends right after. Poll the payment for its status; the "
+            "Mpesa callback later confirms or fails it."
         ),
         request=PaymentCreateSerializer,
         responses={
-            201: PaymentDetailSerializer,
+            202: OpenApiResponse(description="Payment created, STK push queued"),
             400: OpenApiResponse(description="Invalid request"),
         },
     )
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-
-        with transaction.atomic():
-            payment = serializer.save()
-
-            # Initiate Mpesa STK push
-            mpesa_service = MpesaService(
-                phone_number=payment.payer.phone_number,
-                amount=payment.amount,
-                reference=str(payment.id),
-            )
-
-            mpesa_response = mpesa_service.initiate_stk_push()
-
-            checkout_id = mpesa_response.get("CheckoutRequestID")
-
-            if not checkout_id:
-                raise Exception("Mpesa did not return checkout ID")
-            
-            payment.checkout_request_id = checkout_id
-            payment.save()
+        payment = serializer.save()
 
         return Response(
             {
                 "payment_id": payment.id,
-                "message": "STK push sent to phone",
-                "mpesa_response": mpesa_response,
+                "status": payment.status,
+                "message": "STK push queued, check your phone shortly",
             },
-            status=status.HTTP_201_CREATED,
+            status=status.HTTP_202_ACCEPTED,
         )
     
 
+def _payment_events_user(request):
+    """The user a JWT in the header (or ``?token=``, for EventSource) belongs to"""
+    authenticator = ClaimsJWTAuthentication()
+    raw_token = request.GET.get('token')
+    try:
+        if raw_token:
+            token = authenticator.get_validated_token(raw_token)
+            return authenticator.get_user(token)
+        result = authenticator.authenticate(request)
+    except (InvalidToken, AuthenticationFailed):
+        return None
+    return result[0] if result else None
+
+
+def _visible_payment(user, pk):
+    payments = Payment.objects.select_related('booking')
+    if user.role != 'admin':
+        payments = payments.for_guest(user)
+    return payments.filter(pk=pk).first()
+
+
+PAYMENT_FINAL_STATUSES = {Payment.Status.SUCCESSFUL, Payment.Status.FAILED}
+
+
+def _sse(message):
+    return f"event: payment\ndata: {json.dumps(message)}\n\n"
+
+
+async def payment_status_events(request, pk):
+    """
+    Server-Sent Events stream of a payment's status.
+
+    Sends the current status straight away, then every change until the
+    payment succeeds or fails, or PAYMENT_EVENTS_TIMEOUT passes. Clients
+    wait here instead of polling the payment; serve it from an ASGI
+    server so a waiting client costs a queue rather than a thread.
+    """
+    user = await sync_to_async(_payment_events_user)(request)
+    if user is None or not user.is_active:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+
+    payment = await sync_to_async(_visible_payment)(user, pk)
+    if payment is None:
+        return JsonResponse({"detail": "No Payment matches the given query."}, status=404)
+
+    timeout = getattr(settings, 'PAYMENT_EVENTS_TIMEOUT', 120)
+    keepalive = getattr(settings, 'PAYMENT_EVENTS_KEEPALIVE', 15)
+
+    async def stream():
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        # Subscribed only once the response streams, so a request that
+        # fails or is dropped before then holds no subscription
+        async with events.broker().subscribe(events.payment_channel(pk)) as queue:
+            yield "retry: 3000\n\n"
+            # Read again now that changes are received, so none is missed
+            current = await sync_to_async(_visible_payment)(user, pk) or payment
+            yield _sse(events.payment_status(current))
+            current_status = current.status
+            while current_status not in PAYMENT_FINAL_STATUSES:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    message = await asyncio.wait_for(queue.get(), min(keepalive, remaining))
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                current_status = message["status"]
+                yield _sse(message)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @method_decorator(csrf_exempt, name="dispatch")
 class MpesaCallbackView(APIView):
     permission_classes = [AllowAny]
+    # The insert, and claiming the drain once the callback is stored
+    query_budgets = {'post': 4}
 
 
     @extend_schema(
@@ -238,31 +410,20 @@ class MpesaCallbackView(APIView):
         auth=None,
     )
     def post(self, request):
-        print("=== MPESA CALLBACK RECEIVED ===")
         data = request.data
+        try:
+            checkout_id = data["Body"]["stkCallback"]["CheckoutRequestID"]
+        except (KeyError, TypeError):
+            # Nothing we could ever match to a payment; acknowledge and drop
+            return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
+
+        # Store the payload and acknowledge straight away; the payment is
+        # updated by a worker so Safaricom never waits on it. Retries of a
+        # callback already in the inbox are ignored here.
+        MpesaCallback.objects.bulk_create(
+            [MpesaCallback(checkout_request_id=str(checkout_id)[:100], payload=data)],
+            ignore_conflicts=True,
+        )
+        transaction.on_commit(schedule_callback_drain)
 
-        response = process_mpesa_callback(data)# Allows handling of mpesa callbacks
-
-        # result_code = data["Body"]["stkCallback"]["ResultCode"]
-        # checkout_id = data["Body"]["stkCallback"]["CheckoutRequestID"]
-
-        # payment = Payment.objects.filter(
-        #     checkout_request_id=checkout_id
-        # ).first()
-
-        # if not payment:
-        #     return Response({"ResultCode": 0})
-
-        # if result_code == 0:
-        #     payment.status = Payment.Status.SUCCESSFUL
-        #     ref=self._extract_receipt(data)
-        #     print(f"****************************{ref}\n\n")
-        #     payment.mpesa_ref = ref
-        # else:
-        #     payment.status = Payment.Status.FAILED
-
-        # payment.save(update_fields=["status", "mpesa_ref"])
-
-        return Response(response)
-
-
+        return Response({"ResultCode": 0, "ResultDesc": "Accepted"})
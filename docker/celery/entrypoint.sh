@@ -4,5 +4,23 @@ set -e
 # Optionally run Django migrations (optional, if web handles it)
 # python manage.py migrate
 
-# Start Celery worker
-exec celery -A project worker -l info
+QUEUES=celery,notifications,media
+
+case "${1:-worker}" in
+  beat)
+    # Schedules reconcile_payments and dispatch_pending_stk_pushes (see
+    # CELERY_BEAT_SCHEDULE); run exactly one per deployment
+    exec celery -A config beat -l info
+    ;;
+  worker)
+    if [ "${CELERY_EMBED_BEAT:-1}" = "1" ]; then
+      # Single worker deployments run the scheduler inside the worker. Set
+      # CELERY_EMBED_BEAT=0 when running several workers or a beat container
+      exec celery -A config worker -B -l info -Q "$QUEUES"
+    fi
+    exec celery -A config worker -l info -Q "$QUEUES"
+    ;;
+  *)
+    exec "$@"
+    ;;
+esac